@@ -0,0 +1,715 @@
+"""
+
+Resolve a season of move orders and write the next status file
+
+Usage:
+  python adjudicate.py datafilesdir statusfile ordersfile newstatusfile
+
+Example:
+  python adjudicate.py ~/dipper_data_files 2371_Spring_Moves_status_full.txt \
+                       2371_Spring_Moves_orders_full.txt next_status.txt
+
+The orders file is in the same format splitdisp reads:
+
+  Season Spring Moves 2371
+
+  Russia (Klingon):
+    Mos - War
+    Liv S Mos - War
+    GoB C Stp - Swe
+    Sev H
+
+Anything after the order itself (Infiltrated, Cloaked, Knows(...)) is
+about who gets told, not what happens, and is ignored here.  Units
+with no order hold.
+
+Each order's success is a decision that depends on a few others (the
+moves into a province, the supports for a move, the convoys along its
+path).  Decisions are resolved on demand, remembering results, so
+most orders are looked at once.  Where decisions depend on each
+other in a loop we guess both ways, as described in Lucas
+Kruijswijk's "The Math of Adjudication": if both guesses agree we
+keep that, if they don't it's either circular movement (all the moves
+succeed) or a convoy paradox (the convoyed moves fail, Szykman rule).
+
+st02 units:
+  Flarmy       moves like either an army or a fleet, and can convoy
+               from water
+  Trader       shares provinces with other units, so it takes no part
+               in combat: it's never dislodged, doesn't block and
+               its supports don't count.  Its moves succeed if legal.
+  Cloaked, Infiltrated, Knows(...), Assimilated(...), Enterprise
+               only change who knows about the unit or how it's drawn;
+               they're carried over to the new status unchanged.
+
+"""
+
+import sys
+
+import disp
+import mapdata
+
+HOLD, MOVE, SUPPORT, CONVOY = "H", "-", "S", "C"
+
+COAST_ATTRS = ["(sc)", "(wc)", "(nc)", "(ec)"]
+SECONDARY_COASTS = ["(sc)", "(wc)"]
+
+# decision states
+UNRESOLVED, GUESSING, RESOLVED = 0, 1, 2
+
+# Decisions are resolved in an order that keeps chains short, but a
+# loop of decisions still has to be followed all the way round.  Past
+# this many nested it's an error, not a crashed interpreter.
+MAX_DEPTH = 400
+
+# python stack frames per nested decision, at most
+FRAMES_PER_DEPTH = 8
+
+class Unit(object):
+  """ one unit from the status file """
+
+  __slots__ = ["power", "prov", "mode", "coast", "trader", "attrs"]
+
+  def __init__(self, power, prov, attrs):
+    self.power = power # index into powers
+    self.prov = prov   # province id
+    self.attrs = attrs # as in the status file, for writing back out
+    self.mode = None
+    self.coast = None
+    self.trader = False
+    for attr in attrs:
+      lattr = attr.lower()
+      if lattr in ["army", "fleet", "flarmy"]:
+        self.mode = attr.capitalize()
+      elif lattr in SECONDARY_COASTS:
+        self.coast = "Secondary"
+      elif lattr == "trader":
+        self.trader = True
+
+class Order(object):
+  """ what one unit was told to do
+
+  For moves dst is where it's going.  For supports and convoys of_src
+  and of_dst are the move being supported or convoyed; of_dst is None
+  for a support to hold.
+
+  """
+
+  __slots__ = ["unit", "kind", "dst", "dst_coast", "of_src", "of_dst",
+               "convoyed"]
+
+  def __init__(self, unit, kind=HOLD, dst=None, dst_coast=None,
+               of_src=None, of_dst=None):
+    self.unit = unit
+    self.kind = kind
+    self.dst = dst
+    self.dst_coast = dst_coast
+    self.of_src = of_src
+    self.of_dst = of_dst
+    self.convoyed = False
+
+def split_coast(token):
+  """ 'Spa(sc)' -> ('Spa', '(sc)'), 'Spa' -> ('Spa', None) """
+
+  if "(" in token and token.endswith(")"):
+    i = token.index("(")
+    return token[:i], token[i:].lower()
+  return token, None
+
+def parse_order_line(tokens, bundle):
+  """ ['Liv', 'S', 'Mos', '-', 'War'] -> (src, kind, args) or None
+
+  args are (dst, dst_coast) for moves, (of_src, of_dst) for supports
+  and convoys and () for holds.  Province names become ids.
+
+  """
+
+  # stick separated coasts back on: 'Spa', '(sc)' -> 'Spa(sc)'
+  joined = []
+  for token in tokens:
+    if token.lower() in COAST_ATTRS and joined:
+      joined[-1] += token.lower()
+    else:
+      joined.append(token)
+  tokens = joined
+
+  def prov(token):
+    name, coast = split_coast(token)
+    return bundle.province(name), coast
+
+  try:
+    src, ignore = prov(tokens[0])
+    if len(tokens) == 1 or tokens[1].upper() == HOLD:
+      return src, HOLD, ()
+    if tokens[1] == MOVE:
+      dst, coast = prov(tokens[2])
+      return src, MOVE, (dst, coast)
+    if tokens[1].upper() in [SUPPORT, CONVOY]:
+      of_src, ignore = prov(tokens[2])
+      of_dst = None
+      if len(tokens) > 4 and tokens[3] == MOVE:
+        of_dst, ignore = prov(tokens[4])
+      return src, tokens[1].upper(), (of_src, of_dst)
+  except (KeyError, IndexError):
+    pass
+  return None
+
+def parse_orders(orders_fname, bundle):
+  """ [(country, src, kind, args)] from an orders file """
+
+  orders = []
+  country = None
+  for line in open(orders_fname):
+    line = line.strip()
+    if not line or not line[0].isalpha() or line.startswith("Season "):
+      continue
+    if line.endswith(":"):
+      country = line.split()[0]
+      continue
+    parsed = parse_order_line(line.split(), bundle)
+    if parsed is None:
+      print "Ignoring order I can't read:", line
+      continue
+    orders.append((country,) + parsed)
+  return orders
+
+class Resolver(object):
+  """ works out which of a season's orders succeed """
+
+  def __init__(self, bundle, units, orders):
+    """ units is a list of Unit, orders a list of Order, one per unit """
+
+    self.bundle = bundle
+    self.units = units
+    self.orders = orders
+
+    self.at = {}              # province -> order of the unit there
+    self.moves_to = {}        # province -> [orders moving there]
+    self.hold_supports = {}   # province -> [supports to hold it]
+    self.move_supports = {}   # (src, dst) -> [supports for that move]
+    self.convoys = {}         # (src, dst) -> [convoys of that move]
+    self.opposing = {}        # move -> head to head move, if any
+
+    self.state = [UNRESOLVED]*len(orders)
+    self.result = [False]*len(orders)
+    self.dep_list = []
+    self.dep_set = set()      # the same, for looking things up
+    self.depth = 0
+    self.paradox = set()      # convoyed moves failed by the Szykman rule
+
+    self.index()
+
+  def can_reach(self, unit, dst):
+    """ could unit move to dst without a convoy """
+
+    bundle = self.bundle
+    if unit.mode == "Flarmy":
+      return (dst in bundle.neighbours(unit.prov, "Army") or
+              dst in bundle.neighbours(unit.prov, "Fleet", unit.coast))
+    return dst in bundle.neighbours(unit.prov, unit.mode, unit.coast)
+
+  def index(self):
+    """ check orders are legal and build the lookups decisions use
+
+    Illegal moves, supports and convoys are turned into holds.
+
+    """
+
+    units, orders, bundle = self.units, self.orders, self.bundle
+
+    for i, order in enumerate(orders):
+      if not units[order.unit].trader:
+        self.at[units[order.unit].prov] = i
+
+    # moves first: supports and convoys need to know what's moving
+    for i, order in enumerate(orders):
+      if order.kind == MOVE:
+        unit = units[order.unit]
+        if self.can_reach(unit, order.dst):
+          pass
+        elif (unit.mode in ["Army", "Flarmy"] and
+              not bundle.is_water(unit.prov) and
+              bundle.convoy_path(unit.prov, order.dst) is not None):
+          order.convoyed = True
+        else:
+          order.kind = HOLD
+          continue
+        if not unit.trader:
+          self.moves_to.setdefault(order.dst, []).append(i)
+
+    for i, order in enumerate(orders):
+      unit = units[order.unit]
+      if order.kind == SUPPORT:
+        target = self.at.get(order.of_src)
+        if (unit.trader or target is None or
+            not self.can_reach(unit, order.of_dst or order.of_src)):
+          order.kind = HOLD
+        elif order.of_dst is None:
+          if orders[target].kind == MOVE:
+            order.kind = HOLD
+          else:
+            self.hold_supports.setdefault(order.of_src, []).append(i)
+        else:
+          if (orders[target].kind != MOVE or
+              orders[target].dst != order.of_dst):
+            order.kind = HOLD
+          else:
+            key = order.of_src, order.of_dst
+            self.move_supports.setdefault(key, []).append(i)
+      elif order.kind == CONVOY:
+        target = self.at.get(order.of_src)
+        if (unit.trader or unit.mode == "Army" or
+            not bundle.is_water(unit.prov) or target is None or
+            orders[target].kind != MOVE or
+            orders[target].dst != order.of_dst or
+            not orders[target].convoyed):
+          order.kind = HOLD
+        else:
+          key = order.of_src, order.of_dst
+          self.convoys.setdefault(key, []).append(i)
+
+    for i, order in enumerate(orders):
+      if order.kind != MOVE or order.convoyed or units[order.unit].trader:
+        continue
+      j = self.at.get(order.dst)
+      if (j is not None and orders[j].kind == MOVE and
+          not orders[j].convoyed and
+          orders[j].dst == units[order.unit].prov):
+        self.opposing[i] = j
+
+  # -- decisions
+
+  def resolve(self, i):
+    """ does order i succeed """
+
+    if self.state[i] == RESOLVED:
+      return self.result[i]
+    if self.state[i] == GUESSING:
+      self.add_dep(i)
+      return self.result[i]
+
+    if self.depth >= MAX_DEPTH:
+      raise Exception("More than %d orders depend on each other in a loop"
+                      % MAX_DEPTH)
+    self.depth += 1
+    try:
+      return self.resolve_unresolved(i)
+    finally:
+      self.depth -= 1
+
+  def resolve_unresolved(self, i):
+    old_count = len(self.dep_list)
+    self.result[i] = False
+    self.state[i] = GUESSING
+    first = self.adjudicate(i)
+
+    if len(self.dep_list) == old_count:
+      # didn't depend on any guess
+      if self.state[i] != RESOLVED:
+        self.result[i] = first
+        self.state[i] = RESOLVED
+      return first
+
+    if self.dep_list[old_count] != i:
+      # depends on a guess further up; let that one sort it out
+      self.add_dep(i)
+      self.result[i] = first
+      return first
+
+    # depends on its own guess: try the other one
+    self.reset_deps(old_count)
+    self.result[i] = True
+    self.state[i] = GUESSING
+    second = self.adjudicate(i)
+
+    if first == second:
+      self.reset_deps(old_count)
+      self.result[i] = first
+      self.state[i] = RESOLVED
+      return first
+
+    self.backup_rule(old_count)
+    return self.resolve(i)
+
+  def add_dep(self, i):
+    if i not in self.dep_set:
+      self.dep_list.append(i)
+      self.dep_set.add(i)
+
+  def drop_deps(self, old_count):
+    """ take the decisions after old_count off dep_list and return them """
+
+    deps = self.dep_list[old_count:]
+    del self.dep_list[old_count:]
+    self.dep_set.difference_update(deps)
+    return deps
+
+  def reset_deps(self, old_count):
+    for j in self.drop_deps(old_count):
+      self.state[j] = UNRESOLVED
+
+  def backup_rule(self, old_count):
+    """ settle a loop of decisions that has no single answer
+
+    If there's a convoy in the loop it's a paradox, and the moves
+    being convoyed fail and cut no supports (Szykman rule).  Otherwise
+    it's units moving in a circle, and they all succeed.
+
+    """
+
+    deps = self.drop_deps(old_count)
+
+    convoyed = []
+    for j in deps:
+      order = self.orders[j]
+      if order.kind == CONVOY:
+        move = self.at[order.of_src]
+        if move not in convoyed:
+          convoyed.append(move)
+
+    for j in deps:
+      self.state[j] = UNRESOLVED
+      if not convoyed and self.orders[j].kind == MOVE:
+        self.result[j] = True  # circular movement
+        self.state[j] = RESOLVED
+
+    for j in convoyed:
+      self.paradox.add(j)
+      self.result[j] = False
+      self.state[j] = RESOLVED
+
+  def adjudicate(self, i):
+    order = self.orders[i]
+    if order.kind == MOVE:
+      return self.move_succeeds(i)
+    if order.kind == SUPPORT:
+      return not self.support_cut(i)
+    if order.kind == CONVOY:
+      return not self.dislodged(i)
+    return True
+
+  def count_supports(self, supports, not_power=None):
+    n = 0
+    for s in supports:
+      if (not_power is None or
+          self.units[self.orders[s].unit].power != not_power):
+        if self.resolve(s):
+          n += 1
+    return n
+
+  def path(self, i):
+    """ can the moving unit get there: always, unless it's convoyed """
+
+    order = self.orders[i]
+    if not order.convoyed:
+      return True
+    if i in self.paradox:
+      return False
+    src = self.units[order.unit].prov
+    fleets = set()
+    for c in self.convoys.get((src, order.dst), []):
+      if self.resolve(c):
+        fleets.add(self.units[self.orders[c].unit].prov)
+    return self.bundle.convoy_path(src, order.dst, fleets) is not None
+
+  def hold_strength(self, prov):
+    j = self.at.get(prov)
+    if j is None:
+      return 0
+    if self.orders[j].kind == MOVE:
+      if self.resolve(j):
+        return 0
+      return 1
+    return 1 + self.count_supports(self.hold_supports.get(prov, []))
+
+  def attack_strength(self, i):
+    order = self.orders[i]
+    if not self.path(i):
+      return 0
+    src = self.units[order.unit].prov
+    supports = self.move_supports.get((src, order.dst), [])
+
+    j = self.at.get(order.dst)
+    if (j is None or
+        (i not in self.opposing and self.orders[j].kind == MOVE and
+         self.resolve(j))):
+      return 1 + self.count_supports(supports)
+
+    defender = self.units[self.orders[j].unit].power
+    if defender == self.units[order.unit].power:
+      return 0 # can't dislodge your own unit
+    return 1 + self.count_supports(supports, not_power=defender)
+
+  def defend_strength(self, i):
+    order = self.orders[i]
+    src = self.units[order.unit].prov
+    return 1 + self.count_supports(self.move_supports.get((src, order.dst), []))
+
+  def prevent_strength(self, i):
+    order = self.orders[i]
+    if not self.path(i):
+      return 0
+    if i in self.opposing and self.resolve(self.opposing[i]):
+      return 0
+    src = self.units[order.unit].prov
+    return 1 + self.count_supports(self.move_supports.get((src, order.dst), []))
+
+  def move_succeeds(self, i):
+    order = self.orders[i]
+    if self.units[order.unit].trader:
+      return True # nothing can stop a trader
+
+    attack = self.attack_strength(i)
+    if i in self.opposing:
+      if attack <= self.defend_strength(self.opposing[i]):
+        return False
+    elif attack <= self.hold_strength(order.dst):
+      return False
+
+    for j in self.moves_to[order.dst]:
+      if j != i and attack <= self.prevent_strength(j):
+        return False
+    return True
+
+  def support_cut(self, i):
+    order = self.orders[i]
+    supporter = self.units[order.unit]
+    for j in self.moves_to.get(supporter.prov, []):
+      attacker = self.units[self.orders[j].unit]
+      if attacker.power == supporter.power:
+        continue
+      if attacker.prov == order.of_dst:
+        # attacked from where we're supporting into: only cut if we
+        # get dislodged
+        if self.resolve(j):
+          return True
+      elif self.path(j):
+        return True
+    return False
+
+  def dislodged(self, i):
+    """ is the unit with order i dislodged """
+
+    order = self.orders[i]
+    if order.kind == MOVE and self.resolve(i):
+      return False
+    for j in self.moves_to.get(self.units[order.unit].prov, []):
+      if self.resolve(j):
+        return True
+    return False
+
+  def needs(self, i):
+    """ the decisions deciding order i might resolve """
+
+    order = self.orders[i]
+    src = self.units[order.unit].prov
+    if order.kind == SUPPORT or order.kind == CONVOY:
+      needs = []
+      for j in self.moves_to.get(src, []):
+        needs.append(j)
+        needs.extend(self.move_needs(j))
+      return needs
+    if order.kind != MOVE or self.units[order.unit].trader:
+      return []
+
+    needs = self.move_needs(i) + self.hold_supports.get(order.dst, [])
+    if order.dst in self.at:
+      needs.append(self.at[order.dst])
+    if i in self.opposing:
+      needs.extend(self.move_needs(self.opposing[i]))
+    for j in self.moves_to[order.dst]:
+      needs.append(j)
+      needs.extend(self.move_needs(j))
+    return needs
+
+  def move_needs(self, i):
+    """ the supports and convoys of move i """
+
+    order = self.orders[i]
+    key = self.units[order.unit].prov, order.dst
+    return self.move_supports.get(key, []) + self.convoys.get(key, [])
+
+  def resolve_order(self):
+    """ the orders, each after the ones it needs where there's no loop
+
+    Resolving in this order each decision mostly finds what it needs
+    already decided, so a long chain of moves doesn't recurse all the
+    way down it.
+
+    """
+
+    order = []
+    seen = [False]*len(self.orders)
+    for first in range(len(self.orders)):
+      if seen[first]:
+        continue
+      seen[first] = True
+      stack = [(first, iter(self.needs(first)))]
+      while stack:
+        i, needs = stack[-1]
+        for j in needs:
+          if not seen[j]:
+            seen[j] = True
+            stack.append((j, iter(self.needs(j))))
+            break
+        else:
+          stack.pop()
+          order.append(i)
+    return order
+
+  def resolve_all(self):
+    """ resolve every order; returns (results, dislodged_by, standoffs)
+
+    results is a list of booleans parallel to orders.  dislodged_by is
+    {order index: province the attack came from} for dislodged units.
+    standoffs is the set of provinces where moves bounced and that
+    are left empty, which can't be retreated to.
+
+    """
+
+    sys.setrecursionlimit(max(sys.getrecursionlimit(),
+                              FRAMES_PER_DEPTH*MAX_DEPTH + 1000))
+
+    for i in self.resolve_order():
+      self.resolve(i)
+    results = [self.resolve(i) for i in range(len(self.orders))]
+
+    dislodged_by = {}
+    for prov, moves in self.moves_to.items():
+      j = self.at.get(prov)
+      winners = [m for m in moves if results[m]]
+      if winners and j is not None and not (
+          self.orders[j].kind == MOVE and results[j]):
+        dislodged_by[j] = self.units[self.orders[winners[0]].unit].prov
+
+    standoffs = set()
+    for prov, moves in self.moves_to.items():
+      if len(moves) < 2 or [m for m in moves if results[m]]:
+        continue
+      j = self.at.get(prov)
+      if j is None or (self.orders[j].kind == MOVE and results[j]):
+        standoffs.add(prov)
+
+    return results, dislodged_by, standoffs
+
+def title(name):
+  """ 'STP' -> 'Stp', how the status files spell provinces """
+  return name[0] + name[1:].lower()
+
+def adjudicate(bundle, options, powers, raw_orders):
+  """ resolve a season of moves
+
+  options and powers are from disp.parse_status and raw_orders from
+  parse_orders.  Returns the new (options, powers), in the same form,
+  for the retreats (if anything was dislodged) or the next moves.
+
+  """
+
+  season = list(options.get("Season", ["Spring", "Moves", "0"]))
+  if season[1] != "Moves":
+    raise Exception("Can only adjudicate moves, not %s" % season[1])
+
+  units = []
+  unit_at = {} # (country, province) -> unit index
+  for p, (country, race, power_units, scs) in enumerate(powers):
+    for name, attrs in power_units:
+      unit = Unit(p, bundle.province(name),
+                  [a for a in attrs if not a.startswith("Dislodged")])
+      unit_at[country, unit.prov] = len(units)
+      units.append(unit)
+
+  orders = [Order(u) for u in range(len(units))]
+  for country, src, kind, args in raw_orders:
+    u = unit_at.get((country, src))
+    if u is None:
+      print "Ignoring order for a unit %s doesn't have in %s" % (
+        country, bundle.name(src))
+      continue
+    if kind == MOVE:
+      orders[u] = Order(u, MOVE, dst=args[0], dst_coast=args[1])
+    elif kind in [SUPPORT, CONVOY]:
+      orders[u] = Order(u, kind, of_src=args[0], of_dst=args[1])
+
+  results, dislodged_by, standoffs = Resolver(bundle, units, orders).resolve_all()
+
+  # move the units
+  new_units = [[] for power in powers]
+  for i, order in enumerate(orders):
+    unit = units[order.unit]
+    prov, attrs = unit.prov, unit.attrs
+    if order.kind == MOVE and results[i]:
+      prov = order.dst
+      attrs = [a for a in attrs if a.lower() not in COAST_ATTRS]
+      if order.dst_coast and bundle.has_coasts(prov):
+        attrs.insert(0, order.dst_coast)
+    elif i in dislodged_by:
+      attrs = attrs + ["Dislodged(%s)" % title(bundle.name(dislodged_by[i]))]
+    new_units[unit.power].append((bundle.name(prov), attrs))
+
+  # supply centers change hands after the fall moves
+  new_scs = [list(scs) for country, race, power_units, scs in powers]
+  if season[0] == "Fall":
+    for i, order in enumerate(orders):
+      unit = units[order.unit]
+      if unit.trader or i in dislodged_by:
+        continue
+      prov = unit.prov
+      if order.kind == MOVE and results[i]:
+        prov = order.dst
+      name = bundle.name(prov)
+      if not bundle.is_sc(prov) or name in new_scs[unit.power]:
+        continue
+      for scs in new_scs:
+        if name in scs:
+          scs.remove(name)
+      new_scs[unit.power].append(name)
+
+  new_powers = []
+  for p, (country, race, power_units, scs) in enumerate(powers):
+    new_powers.append([country, race, new_units[p], new_scs[p]])
+
+  new_options = dict(options)
+  if "PlacesCannotRetreatTo" in new_options:
+    del new_options["PlacesCannotRetreatTo"]
+  if dislodged_by:
+    new_options["Season"] = [season[0], "Retreats", season[2]]
+    if standoffs:
+      places = [title(bundle.name(p)) for p in standoffs]
+      places.sort()
+      new_options["PlacesCannotRetreatTo"] = places
+  elif season[0] == "Spring":
+    new_options["Season"] = ["Fall", "Moves", season[2]]
+  else:
+    new_options["Season"] = ["Winter", "Adjustments", season[2]]
+
+  return new_options, new_powers
+
+def write_status(fname, options, powers):
+  """ write options and powers out in the status file format """
+
+  outf = open(fname, "w")
+  if "Season" in options:
+    outf.write("  Season %s\n\n" % " ".join(options["Season"]))
+  names = [name for name in options if name != "Season"]
+  names.sort()
+  for name in names:
+    outf.write("  %s\n\n" % " ".join([name] + list(options[name])))
+
+  for country, race, units, scs in powers:
+    outf.write("  %s (%s):\n" % (country, race))
+    outf.write("     %s\n\n" % " ".join(title(sc) for sc in scs))
+    for name, attrs in units:
+      outf.write("     %s\n" % " ".join([title(name)] + list(attrs)))
+    outf.write("\n")
+  outf.close()
+
+def start(datafilesdir, status_fname, orders_fname, out_fname):
+  bundle = mapdata.load(datafilesdir)
+  options, powers = disp.parse_status(status_fname, bundle.ids)
+  raw_orders = parse_orders(orders_fname, bundle)
+  options, powers = adjudicate(bundle, options, powers, raw_orders)
+  write_status(out_fname, options, powers)
+  print "Wrote %s" % out_fname
+
+if __name__ == "__main__":
+  start(*sys.argv[1:])
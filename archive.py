@@ -0,0 +1,385 @@
+"""
+Usage:
+  python archive.py [--db history.db] add datafilesdir file.txt [file.txt ...]
+  python archive.py [--db history.db] turns
+  python archive.py [--db history.db] scs [view]
+  python archive.py [--db history.db] province Prov [view]
+  python archive.py [--db history.db] track season Prov [view]
+  python archive.py [--db history.db] status season [view] out.txt
+
+Keeps a game's status and orders files in a SQLite database, with
+units, supply centers, options and orders indexed by turn, province
+and race, so questions about the whole game don't mean reading every
+file again.
+
+add reads status and orders files into the archive.  Files named the
+way splitdisp names them (2371_Spring_Retreats_status_Klingon.txt) are
+that race's view of the season; other files are taken as the full
+view, with the season from their Season line.  Files already in the
+archive are skipped unless they've changed, so add can be run over
+every file after each turn.
+
+The queries all take a view, "full" unless given:
+
+  turns     the turns in the archive, in order
+  scs       supply center counts per race for each turn
+  province  who owned and who was in a province each turn
+  track     where the unit in a province at a season went after, by
+            following its move orders
+  status    write a turn back out as a status file
+
+To draw an archived turn:
+
+  python disp.py --archive history.db --season 2371_Spring_Retreats \\
+                 [--view full] datafilesdir tmp.png
+
+"""
+
+import sys
+import os
+import os.path
+import re
+import getopt
+import sqlite3
+
+import gamestate
+import manifest
+
+DEFAULT_DB = "history.db"
+
+SCHEMA = """
+create table if not exists files (
+  id integer primary key, path text unique, hash text, size integer,
+  mtime real);
+create table if not exists turns (
+  id integer primary key, file integer, kind text, season text, view text,
+  sort integer, unique (kind, season, view));
+create table if not exists options (turn integer, name text, value text);
+create table if not exists powers (
+  turn integer, power integer, country text, race text);
+create table if not exists scs (
+  turn integer, province text, power integer, race text);
+create table if not exists units (
+  turn integer, unit integer, province text, power integer, race text,
+  mode text, flags integer, attrs text);
+create table if not exists orders (
+  turn integer, country text, race text, province text, kind text,
+  dst text, line text);
+create index if not exists turns_sort on turns (kind, view, sort);
+create index if not exists units_turn on units (turn);
+create index if not exists units_province on units (province, turn);
+create index if not exists units_race on units (race, turn);
+create index if not exists scs_turn on scs (turn);
+create index if not exists scs_province on scs (province, turn);
+create index if not exists orders_turn on orders (turn, province);
+"""
+
+# the order of seasons and phases within a year, for sorting turns
+MONTHS = ["Spring", "Summer", "Fall", "Autumn", "Winter"]
+PHASES = ["Moves", "Retreats", "Adjustments", "Builds"]
+
+SPLIT_NAME = re.compile(r"^(\d+_[A-Za-z]+_[A-Za-z]+)_(status|orders)_(\w+)\.txt$")
+
+def connect(db_fname=DEFAULT_DB):
+  db = sqlite3.connect(db_fname)
+  db.text_factory = str
+  db.executescript(SCHEMA)
+  return db
+
+def season_sort(season):
+  """ "2371_Spring_Retreats" -> a number that sorts turns in order """
+
+  year, month, phase = season.split("_")
+  def index(names, name):
+    if name in names:
+      return names.index(name)
+    return 9
+  return int(year)*100 + index(MONTHS, month)*10 + index(PHASES, phase)
+
+def file_season(fname):
+  """ (season, kind, view) from a file's name, or its Season line """
+
+  m = SPLIT_NAME.match(os.path.basename(fname))
+  if m:
+    return m.groups()
+
+  kind = "status"
+  if "orders" in os.path.basename(fname):
+    kind = "orders"
+  for line in open(fname):
+    words = line.split()
+    if words and words[0] == "Season":
+      ignore, month, phase, year = words
+      return "%s_%s_%s" % (year, month, phase), kind, "full"
+  raise Exception("%s has no Season line" % fname)
+
+def parse_orders(lines):
+  """ [(country, race, province, kind, dst, line)] from an orders file
+
+  kind is "-", "S", "C" or "H" as in adjudicate; dst is where a move
+  goes, without any coast.
+
+  """
+
+  orders = []
+  country = race = None
+  for line in lines:
+    line = line.strip()
+    if not line or not line[0].isalpha() or line.startswith("Season "):
+      continue
+    if line.endswith(":"):
+      country, race = line[:-1].split(None)
+      race = race.strip("()")
+      continue
+    words = line.split()
+    kind, dst = "H", None
+    if len(words) > 2 and words[1] == "-":
+      kind, dst = "-", words[2].split("(")[0].upper()
+    elif len(words) > 1 and words[1].upper() in ("S", "C"):
+      kind = words[1].upper()
+    orders.append((country, race, words[0].split("(")[0].upper(), kind, dst,
+                   line))
+  return orders
+
+def add_file(db, fname, known_provinces):
+  """ read one file into the archive, unless it's there already
+
+  Returns True if it was read.
+
+  """
+
+  path = os.path.abspath(fname)
+  st = os.stat(path)
+  row = db.execute("select id, hash, size, mtime from files where path = ?",
+                   (path,)).fetchone()
+  if row and row[2] == st.st_size and row[3] == st.st_mtime:
+    return False
+  file_hash = manifest.file_hash(path)
+  if row and row[1] == file_hash:
+    db.execute("update files set mtime = ? where id = ?", (st.st_mtime, row[0]))
+    return False
+
+  if row:
+    file_id = row[0]
+    db.execute("update files set hash = ?, size = ?, mtime = ? where id = ?",
+               (file_hash, st.st_size, st.st_mtime, file_id))
+    for old_turn, in db.execute("select id from turns where file = ?",
+                                (file_id,)).fetchall():
+      delete_turn(db, old_turn)
+  else:
+    file_id = db.execute("insert into files (path, hash, size, mtime)"
+                         " values (?, ?, ?, ?)",
+                         (path, file_hash, st.st_size, st.st_mtime)).lastrowid
+
+  season, kind, view = file_season(path)
+  old = db.execute("select id from turns where kind = ? and season = ?"
+                   " and view = ?", (kind, season, view)).fetchone()
+  if old:
+    delete_turn(db, old[0]) # the same turn from another file
+  turn = db.execute("insert into turns (file, kind, season, view, sort)"
+                    " values (?, ?, ?, ?, ?)",
+                    (file_id, kind, season, view,
+                     season_sort(season))).lastrowid
+
+  inf = open(path)
+  try:
+    if kind == "orders":
+      db.executemany("insert into orders values (?, ?, ?, ?, ?, ?, ?)",
+                     [(turn,) + order for order in parse_orders(inf)])
+    else:
+      add_state(db, turn, gamestate.parse(inf, known_provinces))
+  finally:
+    inf.close()
+  return True
+
+def add_state(db, turn, state):
+  db.executemany("insert into options values (?, ?, ?)",
+                 [(turn, name, " ".join(words))
+                  for name, words in state.options.items()])
+  db.executemany("insert into powers values (?, ?, ?, ?)",
+                 [(turn, p, country, state.race(p))
+                  for p, country in enumerate(state.countries)])
+  db.executemany("insert into scs values (?, ?, ?, ?)",
+                 [(turn, state.provinces[prov], power, state.race(power))
+                  for prov, power in zip(state.sc_prov, state.sc_power)])
+  db.executemany("insert into units values (?, ?, ?, ?, ?, ?, ?, ?)",
+                 [(turn, u, state.unit_name(u), state.unit_power[u],
+                   state.race(state.unit_power[u]),
+                   gamestate.unit_mode(state.unit_flags[u]),
+                   state.unit_flags[u], " ".join(state.unit_attrs(u)))
+                  for u in range(len(state))])
+
+def delete_turn(db, turn):
+  for table in ["options", "powers", "scs", "units", "orders"]:
+    db.execute("delete from %s where turn = ?" % table, (turn,))
+  db.execute("delete from turns where id = ?", (turn,))
+
+def add(db, known_provinces, fnames):
+  """ read fnames into the archive; returns how many were new or changed """
+
+  added = 0
+  try:
+    for fname in fnames:
+      if add_file(db, fname, known_provinces):
+        added += 1
+    db.commit()
+  except:
+    db.rollback()
+    raise
+  return added
+
+def find_turn(db, season, view="full", kind="status"):
+  row = db.execute("select id from turns where kind = ? and season = ?"
+                   " and view = ?", (kind, season, view)).fetchone()
+  if not row:
+    views = [v for v, in db.execute("select view from turns where kind = ?"
+                                    " and season = ?", (kind, season))]
+    if views:
+      raise Exception("No %s view of %s (there's %s)"
+                      % (view, season, ", ".join(sorted(views))))
+    raise Exception("No %s of %s in the archive" % (kind, season))
+  return row[0]
+
+def turns(db, kind=None):
+  """ [(season, kind, view)] in order """
+
+  query = "select season, kind, view from turns"
+  args = ()
+  if kind:
+    query += " where kind = ?"
+    args = (kind,)
+  return db.execute(query + " order by sort, kind desc, view", args).fetchall()
+
+def sc_counts(db, view="full"):
+  """ [(season, race, supply centers)] in order """
+
+  return db.execute("select t.season, s.race, count(*) from scs s"
+                    " join turns t on t.id = s.turn"
+                    " where t.kind = 'status' and t.view = ?"
+                    " group by t.id, s.race order by t.sort, s.race",
+                    (view,)).fetchall()
+
+def province_history(db, province, view="full"):
+  """ [(season, owner race, [(unit race, mode, attrs)])] in order
+
+  owner is None in turns where the province isn't a supply center
+  anyone owns.
+
+  """
+
+  province = province.upper()
+  history = []
+  for turn, season in db.execute("select id, season from turns"
+                                 " where kind = 'status' and view = ?"
+                                 " order by sort", (view,)).fetchall():
+    owner = db.execute("select race from scs where turn = ? and province = ?",
+                       (turn, province)).fetchone()
+    units = db.execute("select race, mode, attrs from units"
+                       " where turn = ? and province = ? order by unit",
+                       (turn, province)).fetchall()
+    history.append((season, owner and owner[0], units))
+  return history
+
+def track(db, season, province, view="full"):
+  """ where the unit in province at season was in each later turn
+
+  Returns [(season, province)], starting with the one given.  A unit
+  stays put unless the archive has a move order for it in the same
+  view and the next turn has one of its race and type where it was
+  going.  The track ends when the unit can't be found.  If a retreat
+  turn has a dislodged unit and its attacker in province, it's the
+  attacker's track.
+
+  """
+
+  province = province.upper()
+  rows = db.execute("select id, season from turns where kind = 'status'"
+                    " and view = ? and sort >= ? order by sort",
+                    (view, season_sort(season))).fetchall()
+  if not rows or rows[0][1] != season:
+    raise Exception("No %s view of %s in the archive" % (view, season))
+
+  unit = db.execute("select race, mode from units where turn = ?"
+                    " and province = ? order by flags & ?, unit",
+                    (rows[0][0], province, gamestate.DISLODGED)).fetchone()
+  if not unit:
+    raise Exception("No unit in %s in %s" % (province, season))
+  race, mode = unit
+
+  found = [(season, province)]
+  for turn, next_season in rows[1:]:
+    places = [province]
+    move = db.execute("select o.dst from orders o join turns t on t.id = o.turn"
+                      " where t.kind = 'orders' and t.season = ?"
+                      " and t.view = ? and o.province = ? and o.race = ?"
+                      " and o.kind = '-'",
+                      (found[-1][0], view, province, race)).fetchone()
+    if move:
+      places.insert(0, move[0])
+    for place in places:
+      if db.execute("select 1 from units where turn = ? and province = ?"
+                    " and race = ? and mode is ?",
+                    (turn, place, race, mode)).fetchone():
+        province = place
+        break
+    else:
+      break
+    found.append((next_season, province))
+  return found
+
+def load_state(db, season, view="full"):
+  """ the GameState of an archived status, as gamestate.load would give """
+
+  turn = find_turn(db, season, view)
+  state = gamestate.GameState()
+  for name, value in db.execute("select name, value from options"
+                                " where turn = ?", (turn,)):
+    state.options[name] = value.split()
+  for power, country, race in db.execute("select power, country, race"
+                                         " from powers where turn = ?"
+                                         " order by power", (turn,)):
+    state.add_power(country, race)
+  for province, power in db.execute("select province, power from scs"
+                                    " where turn = ? order by rowid", (turn,)):
+    state.add_sc(power, province)
+  for province, power, attrs in db.execute("select province, power, attrs"
+                                           " from units where turn = ?"
+                                           " order by unit", (turn,)):
+    state.add_unit(power, province, attrs.split())
+  return state
+
+if __name__ == "__main__":
+  opts, args = getopt.getopt(sys.argv[1:], "", ["db="])
+  opts = dict(opts)
+  if not args:
+    sys.exit(__doc__)
+  db = connect(opts.get("--db", DEFAULT_DB))
+  command, args = args[0], args[1:]
+
+  if command == "add":
+    import disp
+    datafilesdir, fnames = args[0], args[1:]
+    known = disp.parse_coords(os.path.join(datafilesdir, disp.COORDS))
+    print "Added %d of %d files" % (add(db, known, fnames), len(fnames))
+  elif command == "turns":
+    for season, kind, view in turns(db):
+      print "%-24s %-7s %s" % (season, kind, view)
+  elif command == "scs":
+    for season, race, count in sc_counts(db, *args):
+      print "%-24s %-12s %2d" % (season, race, count)
+  elif command == "province":
+    for season, owner, units in province_history(db, *args):
+      print "%-24s %-12s %s" % (season, owner or "-",
+                                ", ".join(["%s %s" % (race, attrs)
+                                           for race, mode, attrs in units]))
+  elif command == "track":
+    for season, province in track(db, *args):
+      print "%-24s %s" % (season, province)
+  elif command == "status":
+    import adjudicate
+    out_fname = args.pop()
+    state = load_state(db, *args)
+    adjudicate.write_status(out_fname, state.options, state.powers())
+    print "Wrote %s" % out_fname
+  else:
+    sys.exit(__doc__)
@@ -0,0 +1,453 @@
+"""
+Usage:
+  $ python bench.py [--repeat N] [--grid N] [--only stage,stage]
+                    [--out results.json] [--baseline old.json]
+                    [--threshold 0.2] [datafilesdir]
+
+Times each stage of parsing and drawing a map, to catch regressions.
+
+Every stage runs on the shipped board: the data files in datafilesdir
+(by default the directory this file is in) with its statusfile.txt and
+orders.txt.  With --grid N (default 20, 0 to skip) they also run on a
+synthetic N by N board of square provinces, most of them owned and
+occupied, built in a temporary directory.
+
+For each stage this reports the median and fastest of --repeat runs,
+the memory it allocated (bytes from tracemalloc where python has it,
+otherwise the number of new objects the garbage collector tracks) and
+how much the peak RSS grew.  Each stage runs in its own forked process
+so one stage's memory doesn't hide the next one's.
+
+--out saves the results as JSON.  --baseline compares against results
+saved earlier, and exits with status 1 if any stage got more than
+--threshold (a fraction, 0.2 by default) slower or used that much more
+memory.  It also exits with status 1 if any stage failed.
+
+"""
+
+import sys
+import os
+import os.path
+import time
+import getopt
+import gc
+import shutil
+import tempfile
+import traceback
+import platform
+import json
+try:
+  import resource
+except ImportError:
+  resource = None # not on windows
+try:
+  import tracemalloc
+except ImportError:
+  tracemalloc = None # only in newer versions of python
+
+import Image, ImageDraw
+
+import disp
+import gamestate
+import splitdisp
+import sendout
+
+STATUS = "statusfile.txt"
+ORDERS = "orders.txt"
+
+# synthetic board: each province is a CELL pixel square
+CELL = 40
+
+class Board(object):
+  """ a data dir and the status and orders to benchmark with
+
+  tmpdir is where stages can write their output.  The paths are kept
+  absolute, as some stages change directory.
+
+  """
+
+  def __init__(self, name, tmpdir, datafilesdir, status_fname,
+               orders_fname=None):
+    self.name = name
+    self.tmpdir = os.path.abspath(tmpdir)
+    self.datafilesdir = os.path.abspath(datafilesdir)
+    self.status_fname = os.path.abspath(status_fname)
+    self.orders_fname = orders_fname and os.path.abspath(orders_fname)
+    self.coords = disp.parse_coords(os.path.join(datafilesdir, disp.COORDS))
+    self.assets = disp.load_assets(datafilesdir)
+    self.state = gamestate.load(status_fname, self.coords)
+
+  def wormhole(self):
+    a, b = self.state.options["Wormhole"]
+    return self.coords[a.upper()][0], self.coords[b.upper()][0]
+
+def grid_name(i, j):
+  return "G%02d%02d" % (i, j)
+
+def make_grid_board(tmpdir, n, icons_dir):
+  """ write an n by n board to tmpdir and return its Board
+
+  Provinces are white squares with black borders.  The units cycle
+  through the races and the kinds of unit there are icons for.
+
+  """
+
+  datafilesdir = os.path.join(tmpdir, "grid")
+  os.mkdir(datafilesdir)
+  os.symlink(os.path.abspath(icons_dir),
+             os.path.join(datafilesdir, disp.ICONS))
+
+  im = Image.new("RGB", (n*CELL+1, n*CELL+1), (255,255,255))
+  draw = ImageDraw.Draw(im)
+  for k in range(n+1):
+    draw.line([(k*CELL, 0), (k*CELL, n*CELL)], fill=(0,0,0))
+    draw.line([(0, k*CELL), (n*CELL, k*CELL)], fill=(0,0,0))
+  im.save(os.path.join(datafilesdir, disp.IMAGE))
+
+  # parse_coords maps z to 2*z+5
+  coordf = open(os.path.join(datafilesdir, disp.COORDS), "w")
+  for i in range(n):
+    for j in range(n):
+      name_x, name_y = 20*j + 5, 20*i + 5
+      unit_x, unit_y = 20*j + 10, 20*i + 10
+      coordf.write("%s %d %d %d %d %d %d %d %d\n" % (
+          grid_name(i, j), name_x, name_y, unit_x, unit_y,
+          unit_x, unit_y, unit_x, unit_y))
+  coordf.close()
+
+  kinds = ["Army", "Fleet", "Army Cloaked", "Fleet Infiltrated",
+           "Army Dislodged", "Fleet Trader"]
+  status_fname = os.path.join(tmpdir, "grid_status.txt")
+  statusf = open(status_fname, "w")
+  statusf.write("Season Spring Moves 2371\n\n")
+  statusf.write("Wormhole %s %s\n\n" % (grid_name(0, 0),
+                                        grid_name(n-1, n-1)))
+  cells = [(i, j) for i in range(n) for j in range(n)]
+  for p, race in enumerate(splitdisp.RACES):
+    statusf.write("%s (%s):\n" % (splitdisp.COUNTRIES[p], race))
+    mine = cells[p::len(splitdisp.RACES)]
+    statusf.write("  %s\n\n" % " ".join(grid_name(i, j) for i, j in mine))
+    for k, (i, j) in enumerate(mine):
+      if k % 4 != 3:
+        statusf.write("  %s %s\n" % (grid_name(i, j), kinds[k % len(kinds)]))
+    statusf.write("\n")
+  statusf.close()
+
+  return Board("grid%d" % n, tmpdir, datafilesdir, status_fname)
+
+# Each stage takes a Board and does its setup, then returns what to
+# time: a function of no arguments.
+
+def stage_parse_coords(board):
+  fname = os.path.join(board.datafilesdir, disp.COORDS)
+  return lambda: disp.parse_coords(fname)
+
+def stage_parse_status(board):
+  return lambda: disp.parse_status(board.status_fname, board.coords)
+
+def stage_gamestate(board):
+  return lambda: gamestate.load(board.status_fname, board.coords)
+
+def stage_flood_fill(board):
+  coords, base, labels, source_hash = board.assets
+  ownership = disp.ownership_of(board.state)
+  def run():
+    img = base.copy()
+    for name, (n, a, f, fs) in coords.items():
+      if name in ownership:
+        disp.flood_fill(img, n, ownership[name])
+  return run
+
+def stage_fill_ownership(board):
+  coords, base, labels, source_hash = board.assets
+  ownership = disp.ownership_of(board.state)
+  def run():
+    disp.fill_ownership(base.copy(), coords, ownership, labels)
+  return run
+
+def stage_calculate_bezier(board):
+  start, stop = board.wormhole()
+  return lambda: disp.wormhole_curve(start, stop)
+
+def stage_draw_wormhole(board):
+  base = board.assets[1]
+  start, stop = board.wormhole()
+  return lambda: disp.draw_wormhole(start, stop, base.copy())
+
+def stage_real_size(board):
+  icons = []
+  icons_dir = os.path.join(board.datafilesdir, disp.ICONS)
+  for fname in sorted(os.listdir(icons_dir)):
+    if fname.endswith(".png"):
+      ico, mask, real = disp.load_icon(os.path.join(icons_dir, fname))
+      icons.append((ico, mask))
+  def run():
+    for ico, mask in icons:
+      disp.real_size(ico, mask)
+  return run
+
+def stage_add_icon(board):
+  base = board.assets[1]
+  ops = [op for op in disp.plan_powers(board.datafilesdir, board.state,
+                                       board.coords)
+         if op[1] == "icon"]
+  def run():
+    im = base.copy()
+    for box, kind, args, kwargs in ops:
+      disp.add_icon(im, *args, **kwargs)
+  return run
+
+def stage_render(board):
+  return lambda: disp.render(board.datafilesdir, board.assets, board.state)
+
+def stage_render_units(board):
+  backgrounds = {}
+  disp.render(board.datafilesdir, board.assets, board.state, backgrounds)
+  return lambda: disp.render(board.datafilesdir, board.assets, board.state,
+                             backgrounds)
+
+def stage_splitdisp(board):
+  return splitdisp_run(board, board.status_fname, "bench_status.txt")
+
+def stage_splitdisp_orders(board):
+  return splitdisp_run(board, board.orders_fname, "bench_orders.txt")
+
+def splitdisp_run(board, fname, copy_as):
+  workdir = tempfile.mkdtemp(dir=board.tmpdir)
+  shutil.copy(fname, os.path.join(workdir, copy_as))
+  def run():
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+      splitdisp.start(board.datafilesdir, copy_as)
+    finally:
+      os.chdir(cwd)
+  return run
+
+def stage_sendout_mime(board):
+  workdir = tempfile.mkdtemp(dir=board.tmpdir)
+  png = os.path.join(workdir, "status.png")
+  disp.render(board.datafilesdir, board.assets, board.state).save(png)
+  files = [board.status_fname, png]
+  def run():
+    msg = sendout.build_message("gm@example.com", ["player@example.com"],
+                                "Resolutions", "Resolutions attached\n",
+                                files)
+    return msg.as_string()
+  return run
+
+STAGES = [("parse_coords", stage_parse_coords),
+          ("parse_status", stage_parse_status),
+          ("gamestate", stage_gamestate),
+          ("flood_fill", stage_flood_fill),
+          ("fill_ownership", stage_fill_ownership),
+          ("calculate_bezier", stage_calculate_bezier),
+          ("draw_wormhole", stage_draw_wormhole),
+          ("real_size", stage_real_size),
+          ("add_icon", stage_add_icon),
+          ("render", stage_render),
+          ("render_units", stage_render_units),
+          ("splitdisp", stage_splitdisp),
+          ("splitdisp_orders", stage_splitdisp_orders),
+          ("sendout_mime", stage_sendout_mime)]
+
+def peak_rss_kb():
+  if resource is None:
+    return None
+  return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def measure(make_run, board, repeat):
+  """ run one stage repeat times and return its results """
+
+  run = make_run(board)
+  rss_before = peak_rss_kb()
+
+  # allocations, from one run
+  gc.collect()
+  if tracemalloc:
+    tracemalloc.start()
+    result = run()
+    allocated = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    alloc_unit = "bytes"
+  else:
+    before = len(gc.get_objects())
+    result = run()
+    allocated = len(gc.get_objects()) - before
+    alloc_unit = "objects"
+  del result
+
+  times = []
+  for i in range(repeat):
+    gc.collect()
+    started = time.time()
+    run()
+    times.append(time.time() - started)
+  times.sort()
+
+  rss_growth = None
+  if rss_before is not None:
+    rss_growth = peak_rss_kb() - rss_before
+  return {"median": times[len(times)//2],
+          "min": times[0],
+          "repeat": repeat,
+          "allocated": allocated,
+          "alloc_unit": alloc_unit,
+          "peak_rss_kb": peak_rss_kb(),
+          "rss_growth_kb": rss_growth}
+
+def run_stage(make_run, board, repeat):
+  """ measure a stage in a forked process, where there's fork
+
+  Returns the results, or {"error": traceback}.
+
+  """
+
+  def quietly():
+    # the stages print progress we don't want mixed into the report
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+      return measure(make_run, board, repeat)
+    except Exception:
+      return {"error": traceback.format_exc()}
+
+  if not hasattr(os, "fork"):
+    saved = os.dup(1), os.dup(2)
+    try:
+      return quietly()
+    finally:
+      os.dup2(saved[0], 1)
+      os.dup2(saved[1], 2)
+
+  read_fd, write_fd = os.pipe()
+  pid = os.fork()
+  if pid == 0:
+    os.close(read_fd)
+    result = quietly()
+    outf = os.fdopen(write_fd, "w")
+    outf.write(json.dumps(result))
+    outf.close()
+    os._exit(0)
+
+  os.close(write_fd)
+  inf = os.fdopen(read_fd)
+  data = inf.read()
+  inf.close()
+  os.waitpid(pid, 0)
+  if not data:
+    return {"error": "benchmark process died"}
+  return json.loads(data)
+
+def run_all(boards, repeat, only=None):
+  """ {"board/stage": results} for every stage on every board """
+
+  results = {}
+  for board in boards:
+    for name, make_run in STAGES:
+      if only and name not in only:
+        continue
+      if name == "splitdisp_orders" and not board.orders_fname:
+        continue
+      key = "%s/%s" % (board.name, name)
+      results[key] = run_stage(make_run, board, repeat)
+      report_line(key, results[key])
+  return results
+
+def report_line(key, result):
+  if "error" in result:
+    print "%-28s FAILED" % key
+    print result["error"]
+    return
+  print "%-28s %9.4fs %9.4fs %12s %-7s %8s KB" % (
+    key, result["median"], result["min"], result["allocated"],
+    result["alloc_unit"], result["rss_growth_kb"])
+
+def compare(results, baseline, threshold):
+  """ the stages that regressed: [(key, what, old, new)] """
+
+  regressions = []
+  for key in sorted(results):
+    new, old = results[key], baseline.get(key)
+    if not old or "error" in old or "error" in new:
+      continue
+    checks = [("median", "median")]
+    if new["alloc_unit"] == old["alloc_unit"]:
+      checks.append(("allocated", "allocated"))
+    checks.append(("rss_growth_kb", "rss growth"))
+    for field, what in checks:
+      if old.get(field) is None or new.get(field) is None:
+        continue
+      if new[field] > old[field] * (1 + threshold) and new[field] > 0:
+        # ignore tiny absolute changes in memory
+        if field == "rss_growth_kb" and new[field] - old[field] < 1024:
+          continue
+        regressions.append((key, what, old[field], new[field]))
+  return regressions
+
+def start(datafilesdir, repeat=3, grid=20, only=None, out=None,
+          baseline=None, threshold=0.2):
+  """ run the benchmarks; returns whether nothing regressed """
+
+  saved_cache = disp.use_background_cache
+  disp.use_background_cache = False # we want to time drawing them
+  tmpdir = tempfile.mkdtemp()
+  try:
+    boards = [Board("shipped", tmpdir, datafilesdir,
+                    os.path.join(datafilesdir, STATUS),
+                    os.path.join(datafilesdir, ORDERS))]
+    if grid:
+      boards.append(make_grid_board(
+          tmpdir, grid, os.path.join(datafilesdir, disp.ICONS)))
+
+    print "%-28s %10s %10s %20s %11s" % ("stage", "median", "min",
+                                         "allocated", "rss growth")
+    results = run_all(boards, repeat, only)
+  finally:
+    disp.use_background_cache = saved_cache
+    shutil.rmtree(tmpdir, ignore_errors=True)
+
+  if out:
+    outf = open(out, "w")
+    json.dump({"python": platform.python_version(),
+               "platform": platform.platform(),
+               "when": time.strftime("%Y-%m-%d %H:%M:%S"),
+               "repeat": repeat,
+               "grid": grid,
+               "stages": results}, outf, indent=1, sort_keys=True)
+    outf.close()
+    print "Wrote %s" % out
+
+  ok = True
+  for key in sorted(results):
+    if "error" in results[key]:
+      ok = False
+
+  if baseline:
+    old = json.load(open(baseline))["stages"]
+    regressions = compare(results, old, threshold)
+    for key, what, old_value, new_value in regressions:
+      print "REGRESSION %s %s: %s -> %s" % (key, what, old_value, new_value)
+    if not regressions:
+      print "No regressions against %s (threshold %d%%)" % (
+        baseline, threshold*100)
+    ok = ok and not regressions
+  return ok
+
+if __name__ == "__main__":
+  opts, args = getopt.getopt(sys.argv[1:], "",
+                             ["repeat=", "grid=", "only=", "out=",
+                              "baseline=", "threshold="])
+  opts = dict(opts)
+  datafilesdir = os.path.dirname(os.path.abspath(__file__))
+  if args:
+    datafilesdir, = args
+  only = None
+  if "--only" in opts:
+    only = opts["--only"].split(",")
+  ok = start(datafilesdir, int(opts.get("--repeat", 3)),
+             int(opts.get("--grid", 20)), only, opts.get("--out"),
+             opts.get("--baseline"), float(opts.get("--threshold", 0.2)))
+  if not ok:
+    sys.exit(1)
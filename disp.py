@@ -5,24 +5,101 @@ Usage:
   
   $ python disp.py datafilesdir statusfile tmp.png
 
+To redraw only what changed since the last season:
+
+  $ python disp.py --prev-status last.txt --prev-image last.png \
+                   [--verify] datafilesdir statusfile tmp.png
+
+Drawn backgrounds are cached in datafilesdir/BACKGROUNDS.  To see or
+empty that cache:
+
+  $ python disp.py --list-backgrounds datafilesdir
+  $ python disp.py --purge-backgrounds datafilesdir
+
+To see where the time went:
+
+  $ python disp.py [--stats stats.jsonl] [--prometheus disp.prom] \
+                   [--profile disp.prof] datafilesdir statusfile tmp.png
+
+--stats appends a line of JSON with the seconds spent in each stage
+(coords, base, labels, status, background_cache, flood_fill,
+wormhole, names, powers, standoffs, save, tiles, total) and counts of
+what was done (pixels filled, icons pasted, cache hits).  --prometheus writes the same as a
+Prometheus textfile.  --profile runs it under cProfile and writes the
+profile, and a summary in disp.prof.txt.
+
+To choose how the image is encoded:
+
+  $ python disp.py --encoding email datafilesdir statusfile tmp.png
+  $ python disp.py --encoding email,colors=64 datafilesdir statusfile tmp.png
+  $ python disp.py --encoding-report datafilesdir statusfile tmp.png
+
+The presets are default (PIL's PNG, as always), fast, email (a 256
+color palette), archive (smallest lossless PNG) and webp (lossless, if
+PIL has WebP).  Options after the preset override it: format, colors,
+compress_level, compress_type (default, filtered, huffman, rle or
+fixed), optimize, strip, lossless, quality and method.
+--encoding-report prints the size and encode time of each preset.
+
+To also cut the image into tiles for a web viewer:
+
+  $ python disp.py --tiles tiles datafilesdir statusfile tmp.png
+
+See tiles.py.  Drawing over the same tiles directory again only
+rewrites the tiles that changed.
+
+To draw a turn kept in archive.py's database instead of a status file:
+
+  $ python disp.py --archive history.db --season 2371_Spring_Retreats \
+                   [--view full] datafilesdir tmp.png
+
+If the image's name ends in .svg it's drawn by svgdisp.py instead, as
+an SVG that links to the base map and icons.  The options about
+encoding, tiles, archives and earlier images can't be used then.
+
 """
 
 import sys
 import os.path
+import time
+import getopt
+import struct
+import traceback
+import threading
+try:
+  from hashlib import md5
+except ImportError:
+  from md5 import md5 # old versions of python don't have hashlib
 from random import random
-import Image, ImageDraw
-from math import sqrt, acos, sin
+import Image, ImageDraw, ImageChops
+from math import sqrt, acos, sin, ceil
+
+import gamestate
   
 ILLEGAL_PLACEMENT = (5,5) # The special value 5,5 for coordinates indicates illegal placement
 
+# COORDINATES numbers z are at pixel COORD_SCALE*z+COORD_OFFSET of the
+# map unless it says otherwise with a "Scale scale offset" line
+COORD_SCALE = 2
+COORD_OFFSET = 5
+
 
 IMAGE = "IMAGE_L.png"
 COORDS = "COORDINATES"
 ICONS="icons"
+LABELS = "PROVINCE_LABELS"          # built from IMAGE and COORDS by build_labels
+LABELS_IMAGE = "PROVINCE_LABELS.png"
+BACKGROUNDS = "BACKGROUNDS"         # cache of drawn backgrounds
+
+# part of each cached background's key; change it whenever the way
+# backgrounds are drawn changes, so old ones aren't used
+DRAWING_VERSION = 1
 
 use_images = True
 use_names = True
 use_flood_fill = True
+use_background_cache = True
+background_cache_bytes = 64*1024*1024
 
 def all(s):
   """old versions of python don't have all"""
@@ -31,6 +108,98 @@ def all(s):
       return False
   return True
 
+class Stats(object):
+  """ how long each stage of drawing took and what it did
+
+  stages is {stage: seconds}, added to each time a stage runs, and
+  counters is {counter: count}.  Stages are timed like:
+
+    started = stats.begin()
+    ...
+    stats.end("flood_fill", started)
+
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    self.stages = {}
+    self.counters = {}
+
+  def begin(self):
+    return time.time()
+
+  def end(self, stage, started):
+    self.add({stage: time.time() - started}, {})
+
+  def count(self, counter, n=1):
+    self.add({}, {counter: n})
+
+  def add(self, stages, counters):
+    """ add in another set of stages and counters, as from snapshot """
+
+    self.lock.acquire()
+    try:
+      for stage, seconds in stages.items():
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+      for counter, n in counters.items():
+        self.counters[counter] = self.counters.get(counter, 0) + n
+    finally:
+      self.lock.release()
+
+  def snapshot(self):
+    self.lock.acquire()
+    try:
+      return dict(self.stages), dict(self.counters)
+    finally:
+      self.lock.release()
+
+  def json_line(self, **extra):
+    """ one line of JSON with everything, plus any extra fields """
+
+    stages, counters = self.snapshot()
+    for name, value in icon_cache.stats().items():
+      counters["icon_cache_" + name] = value
+    record = {"time": time.time(), "stages": stages, "counters": counters}
+    record.update(extra)
+    import json # not in old versions of python
+    return json.dumps(record, sort_keys=True)
+
+  def prometheus(self):
+    """ the same in the Prometheus text format """
+
+    stages, counters = self.snapshot()
+    for name, value in icon_cache.stats().items():
+      counters["icon_cache_" + name] = value
+    lines = ["# TYPE disp_stage_seconds gauge"]
+    for stage in sorted(stages):
+      lines.append('disp_stage_seconds{stage="%s"} %f' % (stage, stages[stage]))
+    lines.append("# TYPE disp_count gauge")
+    for counter in sorted(counters):
+      lines.append('disp_count{counter="%s"} %d' % (counter, counters[counter]))
+    lines.append("# TYPE disp_last_run_timestamp_seconds gauge")
+    lines.append("disp_last_run_timestamp_seconds %f" % time.time())
+    return "\n".join(lines) + "\n"
+
+stats = Stats()
+
+def write_stats(json_fname=None, prometheus_fname=None, **extra):
+  """ append stats as a JSON line and/or write a Prometheus textfile """
+
+  if json_fname:
+    outf = open(json_fname, "a")
+    outf.write(stats.json_line(**extra) + "\n")
+    outf.close()
+  if prometheus_fname:
+    # the textfile collector may read it at any time; replace it whole
+    tmp = "%s.%s.tmp" % (prometheus_fname, os.getpid())
+    outf = open(tmp, "w")
+    outf.write(stats.prometheus())
+    outf.close()
+    os.rename(tmp, prometheus_fname)
+
 def parse_coords(COORDS):
   """ read the coordinates files and return {prov-name: (info)}
 
@@ -41,16 +210,28 @@ def parse_coords(COORDS):
   place to draw a fleet, and the place to draw a fleet on the
   alternate coast.
 
+  A line "Scale 1 0" says the numbers on the lines after it are
+  pixels; by default z is pixel COORD_SCALE*z+COORD_OFFSET, half
+  pixels, which is too coarse for big maps.  An army place of 0 0 is
+  always ILLEGAL_PLACEMENT.
+
   """
   
   inf = open(COORDS)
   coords = {}
+  scale, offset = COORD_SCALE, COORD_OFFSET
   for line in inf:
     line = line.strip()
     if not line or not line[0].isalpha():
       continue
     n, c = line.split(None, 1)
-    nX, nY, aX, aY, fX, fY, fsX, fsY = [2*int(z)+5 for z in c.split()]
+    c = c.split()
+    if n == "Scale" and len(c) == 2:
+      scale, offset = int(c[0]), int(c[1])
+      continue
+    nX, nY, aX, aY, fX, fY, fsX, fsY = [scale*int(z)+offset for z in c]
+    if int(c[2]) == int(c[3]) == 0:
+      aX, aY = ILLEGAL_PLACEMENT
     coords[n.upper()] = [(nX, nY), (aX, aY), (fX, fY), (fsX, fsY)]
   return coords
 
@@ -123,193 +304,125 @@ def parse_status(status_fname, provinces):
   scs is a list of the supply centers belonging to that power.  This
   list consists of the text names of the supply centers.
 
-  """
-  
-
-  
-  inf = open(status_fname)
-  
-  options = {} # {option_name ->(optionarg1, optionarg2)}
-  powers = []  # [(country, race, units, scs)]
-  
-  # units : [(unitname, (attr1, attr2, attr3))]
-  # scs : [sc1, sc2, ...]
-
-  power = []
-  units = []
-  scs = []
-  for line in inf:
-    line = line.strip()
-    if not line or not line[0].isalpha():
-      continue
-
-    if line.endswith(":"):
-      if power:
-        power.append(units)
-        power.append(scs)
-        powers.append(power)
-        power, units, scs = [], [], []
+  disp itself works from gamestate.load, which keeps the same
+  information more compactly; this builds the lists above from that.
+  The attrs of a unit come out in a fixed order, not necessarily the
+  order they were in the file.
 
-      line = line[:-1] # lose final :
-
-      country, race = line.split(None)
-      assert race.startswith("(") and race.endswith(")")
-      race = race[1:-1] # lose parens
-      power = [country, race]
-
-    else:
-
-      try:
-        name, attrs = line.split(None, 1)
-      except ValueError:
-        name, attrs = line, ""
-
-      attrs = attrs.split()
-      if power:
-        if not attrs or all(attr.upper() in provinces for attr in attrs):
-          scs.append(name.upper())
-          scs.extend([attr.upper() for attr in attrs]) 
-        else:
-          units.append((name.upper(), attrs))
-      else:
-        options[name]=attrs
-
-  if power:
-    power.append(units)
-    power.append(scs)
-    powers.append(power)
+  """
 
-  return options, powers
+  state = gamestate.load(status_fname, provinces)
+  return state.options, state.powers()
 
-def choose_loc(mode, coast, a, f, fs):
-  if mode == "Fleet":
-    if coast == "Secondary":
+def choose_loc(flags, a, f, fs):
+  if flags & gamestate.FLEET:
+    if gamestate.is_secondary(flags):
       return fs
     return f
-  if mode == "Army":
+  if flags & gamestate.ARMY:
     return a
 
   if a == ILLEGAL_PLACEMENT:
     return f
   return a
 
-def get_image_fname(datafilesdir, race, mode, enterprise, trader,
-                    cloaked, infiltrated, assimilated):
-  """ given info on the unit, try and get a picture for it """
+def get_image_fname(datafilesdir, race, flags, assimilated=None):
+  """ given info on the unit, try and get a picture for it
 
-  
-  fn = "%s_%s" % (race, mode)
-  if enterprise:
+  flags are the unit's gamestate flags, assimilated the race it was
+  assimilated from if it was
+
+  """
+
+  fn = "%s_%s" % (race, gamestate.unit_mode(flags))
+  if flags & gamestate.ENTERPRISE:
     fn += "_Enterprise"
-  if trader:
+  if flags & gamestate.TRADER:
     fn += "_Trader"
-  if cloaked:
+  if flags & gamestate.CLOAKED:
     fn += "_Cloaked"
-  if infiltrated:
+  if flags & gamestate.INFILTRATED:
     fn += "_Infiltrated"
-  if assimilated:
-    fn += "_" + assimilated
+  if flags & gamestate.ASSIMILATED:
+    fn += "_Assimilated(%s)" % assimilated
   fn += ".png"
 
   fn = os.path.join(datafilesdir,ICONS, fn)
 
-  if os.path.exists(fn):
+  if icon_cache.get(fn):
     return fn
   print "Missing", fn
   return None
 
-def draw_powers(datafilesdir, powers, coords, draw, im):
-  """ modify im to represent powers """
-  
+def plan_powers(datafilesdir, state, coords):
+  """ work out what draw_powers will draw, without drawing it
+
+  Returns a list of drawing operations in the order they need to be
+  done.  See draw_op.
+
+  """
+
+  ops = []
+
   used = set()
 
   draw_fnames = {}
 
-  debug_interpret_locs = {}
-  
-  for country, race, units, scs in powers:
-    for unitname, attrs in units:
-      n, a, f, fs = coords[unitname]
-
-      coast, mode, enterprise, infiltrated, cloaked, trader, assimilated, disloged = None, None, False, False, False, False, None, None
-
-      other_attrs = []
-      for attr in attrs:
-        o_attr = attr
-        attr = attr.lower()
-        if attr in ["(sc)", "(wc)"]:
-          coast = "Secondary"
-        elif attr in ["(nc)", "(ec)"]:
-          pass
-        elif attr == "army":
-          mode = "Army"
-        elif attr == "fleet":
-          mode = "Fleet"
-        elif attr == "flarmy":
-          mode = "Flarmy"
-        elif attr == "infiltrated":
-          infiltrated = True
-        elif attr == "cloaked":
-          cloaked = True
-        elif attr == "trader":
-          trader = True
-        elif attr == "enterprise":
-          enterprise = True
-        elif o_attr.startswith("Assimilated("):
-          assimilated = o_attr
-        elif o_attr.startswith("Dislodged"):
-          disloged = o_attr
-        else:
-          assert "Disloged" not in o_attr
-          other_attrs.append(o_attr)
-
-      loc = choose_loc(mode, coast, a, f, fs)
-
-      color=colors[race]
-
-      image_fname = None
-      if use_images:
-        image_fname = get_image_fname(datafilesdir, race, mode, enterprise, trader, cloaked, infiltrated, assimilated)
-
-      if not image_fname:
-        """ if we don't have some icons, draw ovals instead """
-        
-        while loc in used:
-          loc = add(loc, (12, 12))
-        used.add(loc)
-        debug_interpret_locs[loc] = image_fname, unitname
-
-
-        if mode == "Fleet":
-          xy = [add(loc,(-5,-10)), add(loc,(5,10))]
-        elif mode == "Army":
-          xy = [add(loc,(-10,-5)), add(loc,(10,5))]
-        else:
-          xy = [add(loc,(-6,-6)), add(loc,(6,6))]
-
-        if cloaked:
-          draw.ellipse(xy, outline=color)
-        else:
-          draw.ellipse(xy, fill=color)
-
-        if infiltrated:
-          draw.ellipse([add(loc,(-1,-1)), add(loc,(1,1))], fill=(0,0,0))
-        if trader:
-          draw.line([loc[0], loc[1], loc[0], loc[1]-14], fill=(0,0,0))
+  for u in range(len(state)):
+    n, a, f, fs = coords[state.unit_name(u)]
+    race = state.race(state.unit_power[u])
+    flags = state.unit_flags[u]
+    mode = gamestate.unit_mode(flags)
+
+    loc = choose_loc(flags, a, f, fs)
+
+    color=colors[race]
+
+    image_fname = None
+    if use_images:
+      assimilated = None
+      if flags & gamestate.ASSIMILATED:
+        assimilated = state.races[state.unit_assimilated[u]]
+      image_fname = get_image_fname(datafilesdir, race, flags, assimilated)
+
+    if not image_fname:
+      """ if we don't have some icons, draw ovals instead """
+      
+      while loc in used:
+        loc = add(loc, (12, 12))
+      used.add(loc)
+
+      if mode == "Fleet":
+        xy = [add(loc,(-5,-10)), add(loc,(5,10))]
+      elif mode == "Army":
+        xy = [add(loc,(-10,-5)), add(loc,(10,5))]
       else:
-        if loc not in draw_fnames:
-          draw_fnames[loc] = ["","",""]
-          debug_interpret_locs[loc] = image_fname, unitname
-        sort = 0 #"normal"
-        if trader:
-          sort = 1 #"trader"
-        elif disloged:
-          sort = 2 #"disloged"
-        draw_fnames[loc][sort] = image_fname
-
-      if other_attrs:
-        txt = "(%s)" % " ".join(attr[0].upper() for attr in other_attrs)
-        draw.text(add(loc,(10,-5)),txt,fill=color)
+        xy = [add(loc,(-6,-6)), add(loc,(6,6))]
+
+      if flags & gamestate.CLOAKED:
+        ops.append(shape_op("ellipse", xy, outline=color))
+      else:
+        ops.append(shape_op("ellipse", xy, fill=color))
+
+      if flags & gamestate.INFILTRATED:
+        ops.append(shape_op("ellipse", [add(loc,(-1,-1)), add(loc,(1,1))],
+                            fill=(0,0,0)))
+      if flags & gamestate.TRADER:
+        ops.append(shape_op("line", [loc, add(loc,(0,-14))],
+                            fill=(0,0,0)))
+    else:
+      if loc not in draw_fnames:
+        draw_fnames[loc] = ["","",""]
+      sort = 0 #"normal"
+      if flags & gamestate.TRADER:
+        sort = 1 #"trader"
+      elif flags & gamestate.DISLODGED:
+        sort = 2 #"disloged"
+      draw_fnames[loc][sort] = image_fname
+
+    if u in state.unit_extra:
+      txt = "(%s)" % " ".join(attr[0].upper() for attr in state.unit_extra[u])
+      ops.append(text_op(add(loc,(10,-5)), txt, fill=color))
 
   for loc, (normal, trader, disloged) in draw_fnames.items():
     t_loc = loc
@@ -317,16 +430,95 @@ def draw_powers(datafilesdir, powers, coords, draw, im):
     if normal:
       t_loc = add(loc, (0, -28))
     if trader:
-      add_icon(im, trader, t_loc)
+      ops.append(icon_op(trader, t_loc))
     if disloged:
       #assert normal
-      add_icon(im, disloged, loc, offset=True)
+      ops.append(icon_op(disloged, loc, offset=True))
     if normal:
-      try:
-        add_icon(im, normal, loc)
-      except Exception:
-        print loc, debug_interpret_locs[loc]
-        raise
+      ops.append(icon_op(normal, loc))
+
+  return ops
+
+def shape_op(kind, xy, **kwargs):
+  """ an operation to call draw.<kind>(xy, **kwargs) """
+
+  (x0, y0), (x1, y1) = xy
+  box = (min(x0, x1), min(y0, y1), max(x0, x1)+1, max(y0, y1)+1)
+  return box, kind, (xy,), kwargs
+
+def text_op(loc, txt, **kwargs):
+  """ an operation to call draw.text(loc, txt, **kwargs) """
+
+  w, h = text_measure.textsize(txt)
+  return (loc[0], loc[1], loc[0]+w, loc[1]+h), "text", (loc, txt), kwargs
+
+# only used for measuring text
+text_measure = ImageDraw.Draw(Image.new("L", (1,1)))
+
+def icon_op(iconfname, loc, offset=False):
+  """ an operation to call add_icon(im, iconfname, loc, offset) """
+
+  return (icon_box(iconfname, loc, offset), "icon", (iconfname, loc),
+          {"offset": offset})
+
+def touches(box, clip):
+  """ whether box overlaps any of the boxes in clip """
+
+  for other in clip:
+    if (box[0] < other[2] and other[0] < box[2] and
+        box[1] < other[3] and other[1] < box[3]):
+      return True
+  return False
+
+def draw_op(op, draw, im):
+  """ carry out a drawing operation
+
+  An operation is (box, kind, args, kwargs).  box is the (left, top,
+  right, bottom) of everything it could change.  kind "icon" is
+  add_icon(im, *args, **kwargs); any other kind is a method of draw.
+
+  """
+
+  box, kind, args, kwargs = op
+  if kind == "icon":
+    add_icon(im, *args, **kwargs)
+  else:
+    getattr(draw, kind)(*args, **kwargs)
+
+def shift_op(op, origin):
+  """ op moved to draw on the part of the map with its top left at origin """
+
+  box, kind, args, kwargs = op
+  box = sub(box[:2], origin) + sub(box[2:], origin)
+  if kind == "icon":
+    args = (args[0], sub(args[1], origin))
+  elif kind == "text":
+    args = (sub(args[0], origin), args[1])
+  else:
+    args = ([sub(pt, origin) for pt in args[0]],)
+  return box, kind, args, kwargs
+
+def draw_ops(ops, draw, im, clip=None):
+  """ carry out ops in order, skipping any not touching clip """
+
+  for op in ops:
+    if clip is not None and not touches(op[0], clip):
+      continue
+    try:
+      draw_op(op, draw, im)
+    except Exception:
+      print op
+      raise
+
+def draw_powers(datafilesdir, state, coords, draw, im, clip=None):
+  """ modify im to represent state's units
+
+  if clip is a list of boxes, only draw things touching them
+
+  """
+
+  draw_ops(plan_powers(datafilesdir, state, coords), draw, im, clip)
+
 
 def dot(a,b):
   x0,y0=a
@@ -402,10 +594,29 @@ def mkint(pt):
   x,y = pt
   return int(x),int(y)
 
-def draw_wormhole(start,stop,img):
-  """ make a bezier curve, color points near the bezier curve """
-  
-  sys.stderr.write("\nWormholeing...")
+def wormhole_darkening(d):
+  """ how much to take off r and g at distance squared d from the curve """
+
+  alpha = d/20.0 # get darker proportional to the distance to the
+                 # line squared, reaching 100% at sqrt(20) pixels
+                 # away
+
+  if alpha > 1:
+    # if we're all the way dark, go back towards the light
+    alpha = 1-(alpha/2)
+  if alpha < 0:
+    # if we're all the way light, make no change
+    alpha = 0
+
+  alpha = (alpha)/6 # instead of darkening all the way, darken only 1/6
+
+  assert 0<=alpha<=1
+
+  # int(r-255*alpha) for r >= 255*alpha
+  return int(ceil(255*alpha))
+
+def wormhole_control_points(start, stop):
+  """ the wormhole's bezier curve: [start, c1, c2, stop] """
 
   st_a = mul(.4, sub(start,stop))
   st_b = mul(.2, sub(stop,start))
@@ -413,113 +624,177 @@ def draw_wormhole(start,stop,img):
   c1=add(start, add(st_b, perp(mul(.5,st_b)))) 
   c2=add(stop, add(st_a, perp(mul(.5,st_a)))) 
 
-  control_points = [start, c1, c2, stop]
+  return [start, c1, c2, stop]
 
+def wormhole_curve(start, stop):
+  """ the set of pixels the wormhole's bezier curve passes through """
 
-  # for each point in a 14x14 square centered on each point on the
-  # bezier curve, compute the minimum distance from that point to the
-  # curve and put that info in all_points.  All points not in
-  # all_pts.keys() should be left alone
-  #
-  all_pts = {} # pt -> dist to curve
+  control_points = wormhole_control_points(start, stop)
+
+  # Sampled as finely as it always was: fewer steps skip pixels where
+  # the curve cuts a corner, which changes the darkening around it.
+  curve_pts = set()
   for x in range((len(control_points)-1)/3):
-    b_points = calculate_bezier(control_points[3*x:3*x+4])
-    for pt in b_points:
-      for xx in range(-6,6):
-        for yy in range(-6,6):
-          d=xx*xx+yy*yy
-          npt=mkint(add(pt,(xx,yy)))
-          
-          if npt not in all_pts or all_pts[npt] > d:
-            all_pts[npt]=d
+    for pt in calculate_bezier(control_points[3*x:3*x+4]):
+      curve_pts.add(mkint(pt))
 
-    sys.stderr.write(".")
+  return curve_pts
 
-  sys.stderr.write("\n\n")
+def wormhole_box(curve_pts, size):
+  """ the part of an image of this size draw_wormhole can change
+
+  Returns (left, top, right, bottom) or None if it's all off the image.
+
+  """
+
+  img_x, img_y = size
+  left = max(min(x for x, y in curve_pts) - 6, 0)
+  top = max(min(y for x, y in curve_pts) - 6, 0)
+  right = min(max(x for x, y in curve_pts) + 6, img_x)
+  bottom = min(max(y for x, y in curve_pts) + 6, img_y)
+  if left >= right or top >= bottom:
+    return None
+  return left, top, right, bottom
+
+def draw_wormhole(start,stop,img):
+  """ make a bezier curve, color points near the bezier curve """
+  
+  sys.stderr.write("\nWormholeing...")
+
+  curve_pts = wormhole_curve(start, stop)
+  sys.stderr.write(".")
+  darken_wormhole(curve_pts, img)
+  sys.stderr.write("\n")
+
+def darken_wormhole(curve_pts, img, origin=(0,0), map_size=None):
+  """ color the points of img near the curve's pixels
+
+  img is the part of the map with its top left at origin, and
+  map_size the size of the whole map if img isn't all of it.  Only
+  the curve pixels on the map and near img are looked at.
+
+  """
+
+  if map_size is None:
+    map_size = img.size
+  map_x, map_y = map_size
+  img_x, img_y = img.size
+  ox, oy = origin
+  curve_pts = [sub(pt, origin) for pt in curve_pts
+               if 0 <= pt[0] < map_x and 0 <= pt[1] < map_y and
+                  ox-6 <= pt[0] < ox+img_x+6 and oy-6 <= pt[1] < oy+img_y+6]
+  box = curve_pts and wormhole_box(curve_pts, img.size)
+  if not box:
+    return
+
+  # everything within 6 of the curve, whether it's on img or not
+  left = min(x for x, y in curve_pts) - 6
+  top = min(y for x, y in curve_pts) - 6
+  right = max(x for x, y in curve_pts) + 6
+  bottom = max(y for x, y in curve_pts) + 6
+  size = (right-left, bottom-top)
+
+  # each pixel in a 12x12 square around each curve pixel (offsets -6
+  # to 5) is at distance squared xx*xx+yy*yy from the curve, or less if
+  # it's nearer some other curve pixel.  Work that out for the whole
+  # bounding box at once: an "L" image of distances, 255 where we
+  # shouldn't touch, built by shifting the curve by each offset and
+  # keeping the minimum.
+  curve = Image.new("L", size, 255)
+  ImageDraw.Draw(curve).point([sub(pt, (left, top)) for pt in curve_pts],
+                              fill=0)
+
+  dists = Image.new("L", size, 255)
+  at_dist = {} # d -> the curve with its pixels set to d
+  for xx in range(-6,6):
+    for yy in range(-6,6):
+      d=xx*xx+yy*yy
+      if d not in at_dist:
+        at_dist[d] = curve.point([d] + [255]*255)
+      shifted = Image.new("L", size, 255)
+      shifted.paste(at_dist[d], (xx, yy))
+      dists = ImageChops.darker(dists, shifted)
 
   # now we have points and their distances to the curve.  color them
   # apropriately: no change right on the curve, darken the r and g as
   # we move away, then when we get too far fade back to no change
-  for pt, d in all_pts.iteritems():
+  darkening = [wormhole_darkening(d) for d in range(255)] + [0]
+  darken = dists.point(darkening).crop((box[0]-left, box[1]-top,
+                                        box[2]-left, box[3]-top))
 
-    # d is the distance squared from pt to the curve
-    # r,g,b are the colors of the output pixel
-    # alpha is how much to darken r and g by (range 0-1)
-    r,g,b=img.getpixel(pt)
+  r,g,b = img.crop(box).split()
+  r = ImageChops.subtract(r, darken)
+  g = ImageChops.subtract(g, darken)
+  img.paste(Image.merge("RGB", (r,g,b)), box[:2])
 
-    alpha = d/20.0 # get darker proportional to the distance to the
-                   # line squared, reaching 100% at sqrt(20) pixels
-                   # away
-                   
-    if alpha > 1:
-      # if we're all the way dark, go back towards the light
-      alpha = 1-(alpha/2)
-    if alpha < 0:
-      # if we're all the way light, make no change
-      alpha = 0
 
-    alpha = (alpha)/6 # instead of darkening all the way, darken only 1/6
+def ownership_of(state):
+  """ {sc: color of its owner} """
 
-    assert 0<=alpha<=1 
-
-    r,g,b=int(r-255*(alpha)), int(g-255*(alpha)), b      
+  ownership = {}
+  for prov, power in zip(state.sc_prov, state.sc_power):
+    ownership[state.provinces[prov]] = colors[state.race(power)]
+  return ownership
 
-    img.putpixel(pt, (r,g,b))
-  sys.stderr.write("\n")
+def draw_background(coords, state, draw, img, labels=None):
+  """ modify img to show sc ownership, province names, and the wormhole
 
+  if labels (from load_labels) are given they are used instead of
+  flood filling each province
 
-def draw_background(coords, powers, draw, img, options):
-  """ modify img to show sc ownership, province names, and the wormhole """
+  """
 
-  ownership = {}
-  for country, race, units, scs in powers:
-    for sc in scs:
-      ownership[sc] = colors[race]
+  ownership = ownership_of(state)
 
-  if use_flood_fill:
+  started = stats.begin()
+  if use_flood_fill and labels:
+    stats.count("pixels_filled", fill_ownership(img, coords, ownership, labels))
+  elif use_flood_fill:
     sys.stderr.write("\nFlood Filling")
     for name, (n, a, f, fs) in coords.items():
       if name in ownership:
         color = ownership[name]
-        flood_fill(img, n, color)
+        stats.count("pixels_filled", flood_fill(img, n, color))
         sys.stderr.write(".")
     sys.stderr.write("\n")
+  stats.end("flood_fill", started)
 
-  if "Wormhole" in options:
-    a, b = options["Wormhole"]
+  if "Wormhole" in state.options:
+    started = stats.begin()
+    a, b = state.options["Wormhole"]
     start =  coords[a.upper()][0]
     stop = coords[b.upper()][0]
     draw_wormhole(start, stop, img)
+    stats.end("wormhole", started)
 
   if use_names:
+    started = stats.begin()
     for name, (n, a, f, fs) in coords.items():
       color = (0,0,0)
       if name in ownership and not flood_fill:
         color = ownership[name]
       draw.text(n, name, fill=color)
+    stats.end("names", started)
     
 
-def alpha_paste(img_base, img_add, xyoffset):
-  """ img.paste ignores the alpha channel, so we do it by hand """
-  
-  from_x_max, from_y_max = img_add.size
+# if it's almost all the way transparent, make it all the way
+ALPHA_CUTOFF = [0]*5 + range(5, 256)
 
-  def blend(a_color, b_color, alpha):
-    return (a_color*alpha + b_color*(255-alpha))/255
+def alpha_paste(img_base, img_add, xyoffset, mask=None):
+  """ img.paste ignores the alpha channel, so we pass it as the mask
 
-  for x in range(from_x_max):
-    for y in range(from_y_max):
-      
-      ar,ag,ab,aa = img_add.getpixel((x,y))
-      br,bg,bb = img_base.getpixel(add((x,y), xyoffset))
+  PIL blends the whole icon at once and clips it to the edges of
+  img_base.  Its rounding differs from blending by hand by at most 1
+  per channel.
 
-      if aa < 5: # if it's almost all the way transparent, make it all the
-                 # way
-        aa = 0
+  mask, if given, is img_add's alpha channel already put through
+  ALPHA_CUTOFF.
 
-      r,g,b,a = blend(ar,br,aa), blend(ag,bg,aa), blend(ab,bb,aa), 255
+  """
 
-      img_base.putpixel(add((x,y), xyoffset), (r,g,b,a))
+  if mask is None:
+    mask = img_add.split()[3].point(ALPHA_CUTOFF)
+  img_base.paste(img_add.convert(img_base.mode), mkint(xyoffset), mask)
 
 def within(img, x, y):
   img_x, img_y = img.size
@@ -530,18 +805,21 @@ def flood_fill(image, loc, value):
 
   modified from http://article.gmane.org/gmane.comp.python.image/1753
 
+  Returns how many pixels were filled.
+
   """
   x,y = loc
   
   if not within(image,x, y):
-    return
+    return 0
 
   orig_color = image.getpixel((x, y))
   if orig_color == value:
-    return
+    return 0
   
   edge = [(x, y)]
   image.putpixel((x, y), value)
+  filled = 1
   while edge:
     newedge = []
     for (x, y) in edge:
@@ -549,71 +827,1097 @@ def flood_fill(image, loc, value):
         if within(image, s, t) and image.getpixel((s, t)) == orig_color:
           image.putpixel((s, t), value)
           newedge.append((s, t))
+    filled += len(newedge)
     edge = newedge
+  return filled
+
+def labels_source_hash(datafilesdir):
+  """ hash of everything the province labels are built from """
+
+  h = md5()
+  for fname in [IMAGE, COORDS]:
+    h.update(open(os.path.join(datafilesdir, fname), "rb").read())
+  return h.hexdigest()
+
+def build_labels(datafilesdir):
+  """ work out ahead of time what flood_fill would do to each province
+
+  Returns (label_im, provinces, region_colors, adjacent) or None if
+  the base map can't be represented this way.
+
+  label_im is an "L" image the size of the base map.  Each connected
+  region of the base map that contains the name point of some
+  province gets its own label (1-255); everything else is 0.
+
+  provinces is {prov-name: label}, region_colors is {label: (r,g,b)},
+  the color of that region in the base map, and adjacent is {label:
+  set(labels)}, the regions that touch it.
+
+  Filling a province always recolors whole regions, so knowing which
+  regions touch is enough to replay a sequence of flood fills without
+  looking at pixels again.  This only holds if none of the flood fill
+  colors appear in the base map, so if one does we return None and the
+  caller should flood fill the slow way.
+
+  """
+
+  coords = parse_coords(os.path.join(datafilesdir, COORDS))
+  base = Image.open(os.path.join(datafilesdir, IMAGE)).convert()
+  width, height = base.size
+
+  base_colors = base.getcolors(width*height)
+  for count, color in base_colors:
+    if color in colors.values():
+      return None
+
+  label_im = Image.new("L", base.size, 0)
+  pix = base.load()
+  lpix = label_im.load()
+
+  provinces = {}
+  region_colors = {}
+  adjacent = {}
+
+  for name, (n, a, f, fs) in coords.items():
+    x,y = n
+    if not (0 <= x < width and 0 <= y < height):
+      continue
+
+    if lpix[x,y]:
+      provinces[name] = lpix[x,y]
+      continue
+
+    label = len(region_colors) + 1
+    if label > 255:
+      return None
+
+    orig_color = pix[x,y]
+    provinces[name] = label
+    region_colors[label] = orig_color
+    adjacent[label] = set()
+
+    edge = [(x, y)]
+    lpix[x,y] = label
+    while edge:
+      newedge = []
+      for (x, y) in edge:
+        for (s, t) in ((x+1, y), (x-1, y), (x, y+1), (x, y-1)):
+          if not (0 <= s < width and 0 <= t < height):
+            continue
+          other = lpix[s,t]
+          if other == label:
+            continue
+          if other:
+            # regions labeled earlier are never the same color as
+            # this one, or they would have been the same region
+            adjacent[label].add(other)
+            adjacent[other].add(label)
+          elif pix[s,t] == orig_color:
+            lpix[s,t] = label
+            newedge.append((s, t))
+      edge = newedge
+    sys.stderr.write(".")
+
+  return label_im, provinces, region_colors, adjacent
+
+def save_labels(datafilesdir, labels, source_hash):
+  label_im, provinces, region_colors, adjacent = labels
+
+  label_im.save(os.path.join(datafilesdir, LABELS_IMAGE))
+
+  outf = open(os.path.join(datafilesdir, LABELS), "w")
+  outf.write("# PROVINCE LABELS, generated by disp.py from %s and %s\n"
+             % (IMAGE, COORDS))
+  outf.write("# Do not edit; this is rebuilt whenever either changes\n\n")
+  outf.write("Source %s\n\n" % source_hash)
+  for label, (r,g,b) in sorted(region_colors.items()):
+    outf.write("Region %s %s %s %s %s\n" % (
+        label, r, g, b, " ".join(str(x) for x in sorted(adjacent[label]))))
+  outf.write("\n")
+  for name, label in sorted(provinces.items()):
+    outf.write("Province %s %s\n" % (name, label))
+  outf.close()
+
+def read_labels(datafilesdir, source_hash):
+  """ the saved labels, or None if they're missing or out of date """
+
+  try:
+    inf = open(os.path.join(datafilesdir, LABELS))
+  except IOError:
+    return None
+
+  provinces, region_colors, adjacent = {}, {}, {}
+  source = None
+  for line in inf:
+    line = line.split()
+    if not line or line[0].startswith("#"):
+      continue
+    if line[0] == "Source":
+      source = line[1]
+    elif line[0] == "Region":
+      label, r, g, b = [int(x) for x in line[1:5]]
+      region_colors[label] = (r,g,b)
+      adjacent[label] = set(int(x) for x in line[5:])
+    elif line[0] == "Province":
+      provinces[line[1]] = int(line[2])
+  inf.close()
+
+  if source != source_hash:
+    return None
+
+  try:
+    label_im = Image.open(os.path.join(datafilesdir, LABELS_IMAGE))
+    label_im.load()
+  except IOError:
+    return None
+
+  return label_im, provinces, region_colors, adjacent
+
+def load_labels(datafilesdir, source_hash=None):
+  """ get the province labels, building and saving them if needed """
+
+  if source_hash is None:
+    source_hash = labels_source_hash(datafilesdir)
+  labels = read_labels(datafilesdir, source_hash)
+  if labels:
+    return labels
+
+  sys.stderr.write("\nBuilding province labels")
+  labels = build_labels(datafilesdir)
+  sys.stderr.write("\n")
+  if labels:
+    try:
+      save_labels(datafilesdir, labels, source_hash)
+    except IOError:
+      pass # read only data dir; just build them again next time
+  return labels
+
+def replay_fills(coords, ownership, labels):
+  """ what flood filling each owned province would do to each region
+
+  Returns {label: (r,g,b)}, the color of every labeled region after
+  the fills.
+
+  """
+
+  label_im, provinces, region_colors, adjacent = labels
+
+  current = dict(region_colors)
+  for name, (n, a, f, fs) in coords.items():
+    if name not in ownership or name not in provinces:
+      continue
+
+    color = ownership[name]
+    seed = provinces[name]
+    orig_color = current[seed]
+    if orig_color == color:
+      continue
+
+    edge = [seed]
+    current[seed] = color
+    while edge:
+      newedge = []
+      for label in edge:
+        for other in adjacent[label]:
+          if current[other] == orig_color:
+            current[other] = color
+            newedge.append(other)
+      edge = newedge
+
+  return current
+
+def region_box(labels, label):
+  """ the bounding box of one labeled region """
+
+  label_im = labels[0]
+  return label_im.point([0]*label + [255] + [0]*(255-label)).getbbox()
+
+def fill_ownership(img, coords, ownership, labels, origin=(0,0), current=None):
+  """ same result as flood_fill on each owned province, done in one pass
+
+  Replays the fills on the region graph from build_labels, then
+  recolors every region that changed by pasting the label image
+  through a palette.  Returns how many pixels were recolored.
+
+  img can be part of the map, with its top left at origin.  current
+  is replay_fills' result, if it's already known.
+
+  """
+
+  label_im, provinces, region_colors, adjacent = labels
+
+  if current is None:
+    current = replay_fills(coords, ownership, labels)
+
+  palette = [0]*(256*3)
+  mask_lut = [0]*256
+  for label, color in current.items():
+    if color != region_colors[label]:
+      palette[3*label:3*label+3] = color
+      mask_lut[label] = 255
+
+  if origin != (0,0) or img.size != label_im.size:
+    label_im = label_im.crop(origin + add(origin, img.size))
+  fill = label_im.copy()
+  fill.putpalette(palette)
+  mask = label_im.point(mask_lut)
+  img.paste(fill.convert("RGB"), (0,0), mask)
+  return mask.histogram()[255]
+
+def real_size(ico, mask=None):
+  """ compute the size of the part of the image having alpha > 5
+
+  measured from the center of the image, so an icon that is opaque
+  only on one side still counts the other half
+
+  """
+
+  if mask is None:
+    mask = ico.split()[3].point(ALPHA_CUTOFF)
 
-def real_size(ico):
-  """ compute the size of the part of the image having alpha > 5 """
-  
   x_max, y_max = ico.size
 
   rx_min, rx_max = x_max/2, x_max/2
   ry_min, ry_max = y_max/2, y_max/2
 
-  for x in range(x_max):
-    for y in range(y_max):
-      r,g,b,a=ico.getpixel((x,y))
-      if a >= 5:
-        if x < rx_min:
-          rx_min = x
-        if x > rx_max:
-          rx_max = x
-        if y < ry_min:
-          ry_min = y
-        if y > ry_max:
-          ry_max = y
+  bbox = mask.getbbox()
+  if bbox:
+    x0, y0, x1, y1 = bbox
+    rx_min, rx_max = min(rx_min, x0), max(rx_max, x1-1)
+    ry_min, ry_max = min(ry_min, y0), max(ry_max, y1-1)
   return rx_max-rx_min, ry_max-ry_min
 
+def load_icon(iconfname):
+  """ decode an icon for IconCache: (ico, mask, real size) or None """
+
+  if not os.path.exists(iconfname):
+    return None
+  ico = Image.open(iconfname).convert("RGBA")
+  mask = ico.split()[3].point(ALPHA_CUTOFF)
+  return ico, mask, real_size(ico, mask)
+
+class IconCache(object):
+  """ decoded icons, shared by every render in this process
+
+  Keyed by icon filename.  Entries are what load_icon returns,
+  including None for icons that don't exist, so a missing icon is
+  only looked for on disk once.  At most max_icons are kept, dropping
+  the one used longest ago.
 
-def draw_standoffs(datafilesdir, coords, places, draw, im):
+  """
+
+  def __init__(self, max_icons=256):
+    self.max_icons = max_icons
+    self.entries = {}   # fname -> (ico, mask, (real_w, real_h)) or None
+    self.last_used = {} # fname -> tick
+    self.tick = 0
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.lock = threading.Lock() # for dispserver's worker threads
+
+  def get(self, iconfname):
+    self.lock.acquire()
+    try:
+      return self.get_locked(iconfname)
+    finally:
+      self.lock.release()
+
+  def get_locked(self, iconfname):
+    self.tick += 1
+    if iconfname in self.entries:
+      self.hits += 1
+    else:
+      self.misses += 1
+      self.entries[iconfname] = load_icon(iconfname)
+    self.last_used[iconfname] = self.tick
+
+    while len(self.entries) > self.max_icons:
+      oldest = min([(t, f) for f, t in self.last_used.items()])[1]
+      del self.entries[oldest]
+      del self.last_used[oldest]
+      self.evictions += 1
+
+    return self.entries[iconfname]
+
+  def clear(self):
+    self.lock.acquire()
+    try:
+      self.entries.clear()
+      self.last_used.clear()
+    finally:
+      self.lock.release()
+
+  def stats(self):
+    return {"icons": len(self.entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions}
+
+icon_cache = IconCache()
+
+def plan_standoffs(datafilesdir, coords, places):
+  ops = []
   for place in places:
     n, a, f, fs = coords[place.upper()]
-    loc = choose_loc(None, None, a, f, fs)
-    add_icon(im, os.path.join(datafilesdir,ICONS,"Standoff.png"), loc)
+    loc = choose_loc(0, a, f, fs)
+    ops.append(icon_op(os.path.join(datafilesdir,ICONS,"Standoff.png"), loc))
+  return ops
+
+def draw_standoffs(datafilesdir, coords, places, draw, im, clip=None):
+  draw_ops(plan_standoffs(datafilesdir, coords, places), draw, im, clip)
     
-  
-def add_icon(im, iconfname, loc, offset=False):
-  """ add the icon in iconfname to im at loc
+def get_icon(iconfname):
+  icon = icon_cache.get(iconfname)
+  if icon is None:
+    raise IOError("Missing icon %s" % iconfname)
+  return icon
+
+def icon_box(iconfname, loc, offset=False):
+  """ where add_icon would put the icon: (left, top, right, bottom)
 
   if offset, adjust position by 1/3 of the real width and height
 
   """
-  
-  ico = Image.open(iconfname).convert()
+
+  ico, mask, (real_w, real_h) = get_icon(iconfname)
+
   x,y = loc
   x_max, y_max = ico.size
 
   loc = x-x_max/2, y-y_max/2
 
   if offset:
-    real_w, real_h = real_size(ico)
     loc = loc[0]+real_w/3, loc[1]+real_h/3
 
-  alpha_paste(im, ico, loc)
+  return loc[0], loc[1], loc[0]+x_max, loc[1]+y_max
+
+def add_icon(im, iconfname, loc, offset=False):
+  """ add the icon in iconfname to im at loc
+
+  if offset, adjust position by 1/3 of the real width and height
+
+  """
+
+  ico, mask, real = get_icon(iconfname)
+  alpha_paste(im, ico, icon_box(iconfname, loc, offset)[:2], mask)
+  stats.count("icons_pasted")
   
-def start(datafilesdir, status_fname, img_out):
+def load_assets(datafilesdir):
+  """ everything from datafilesdir that doesn't depend on the status
+
+  Returns (coords, base, labels, source_hash): the parsed COORDINATES,
+  the decoded base map, the province labels (None if not flood
+  filling) and labels_source_hash.  Icons are shared through
+  icon_cache instead.
+
+  """
+
+  started = stats.begin()
   coords = parse_coords(os.path.join(datafilesdir,COORDS))
-  options, powers = parse_status(status_fname, coords)
+  stats.end("coords", started)
+
+  started = stats.begin()
+  base = Image.open(os.path.join(datafilesdir,IMAGE)).convert()
+  stats.end("base", started)
+
+  started = stats.begin()
+  source_hash = labels_source_hash(datafilesdir)
+  labels = None
+  if use_flood_fill:
+    labels = load_labels(datafilesdir, source_hash)
+  stats.end("labels", started)
+
+  return coords, base, labels, source_hash
+
+def background_key(state):
+  """ everything draw_background looks at, besides the data files """
+
+  return (tuple(state.power_races), tuple(state.sc_prov),
+          tuple(state.sc_power), tuple(state.options.get("Wormhole", ())))
+
+def background_cache_key(source_hash, state):
+  """ name of the file in BACKGROUNDS for this background """
+
+  ownership = ownership_of(state).items()
+  ownership.sort()
+  wormhole = tuple(w.upper() for w in state.options.get("Wormhole", ()))
+
+  h = md5()
+  h.update(repr((DRAWING_VERSION, source_hash, ownership, wormhole,
+                 use_flood_fill, use_names)))
+  return h.hexdigest() + ".ppm"
+
+def read_background(datafilesdir, key):
+  """ the cached background, or None """
+
+  fname = os.path.join(datafilesdir, BACKGROUNDS, key)
+  try:
+    im = Image.open(fname)
+    im.load()
+    os.utime(fname, None) # mark as recently used
+  except (IOError, OSError):
+    return None
+  return im
+
+def save_background(datafilesdir, key, im):
+  cachedir = os.path.join(datafilesdir, BACKGROUNDS)
+  try:
+    if not os.path.isdir(cachedir):
+      os.mkdir(cachedir)
+    # write then rename, so other processes and threads never read
+    # half a file
+    tmp = os.path.join(cachedir, "%s.%s.%s.tmp"
+                       % (key, os.getpid(), threading.currentThread().ident))
+    im.save(tmp, "PPM")
+    os.rename(tmp, os.path.join(cachedir, key))
+  except (IOError, OSError):
+    return # read only data dir; just draw it again next time
+  purge_backgrounds(datafilesdir, background_cache_bytes)
+
+def list_backgrounds(datafilesdir):
+  """ [(last used, bytes, key)] for the cached backgrounds, newest first """
+
+  cachedir = os.path.join(datafilesdir, BACKGROUNDS)
+  if not os.path.isdir(cachedir):
+    return []
+
+  entries = []
+  for key in os.listdir(cachedir):
+    if not key.endswith(".ppm"):
+      continue
+    try:
+      st = os.stat(os.path.join(cachedir, key))
+    except OSError:
+      continue # purged by someone else
+    entries.append((st.st_mtime, st.st_size, key))
+  entries.sort()
+  entries.reverse()
+  return entries
+
+def purge_backgrounds(datafilesdir, max_bytes=0):
+  """ remove the least recently used backgrounds until under max_bytes
+
+  Returns how many were removed.
+
+  """
+
+  total = 0
+  removed = 0
+  for mtime, size, key in list_backgrounds(datafilesdir):
+    total += size
+    if total > max_bytes:
+      try:
+        os.remove(os.path.join(datafilesdir, BACKGROUNDS, key))
+        removed += 1
+      except OSError:
+        pass
+  return removed
+
+def get_background(datafilesdir, assets, state):
+  """ the drawn background for this status, from BACKGROUNDS if there """
+
+  coords, base, labels, source_hash = assets
+
+  if use_background_cache:
+    started = stats.begin()
+    key = background_cache_key(source_hash, state)
+    background = read_background(datafilesdir, key)
+    stats.end("background_cache", started)
+    if background:
+      stats.count("background_cache_hits")
+      return background
+    stats.count("background_cache_misses")
+
+  background = base.copy()
+  draw_background(coords, state, ImageDraw.Draw(background),
+                  background, labels)
 
-  im = Image.open(os.path.join(datafilesdir,IMAGE)).convert()
-        
+  if use_background_cache:
+    save_background(datafilesdir, key, background)
+  return background
+
+def render(datafilesdir, assets, state, backgrounds=None, clip=None):
+  """ draw the map for one gamestate.GameState and return the image
+
+  backgrounds, if given, is a dict of already drawn backgrounds keyed
+  by background_key; new ones are added to it.
+
+  if clip is a list of boxes, only units and standoffs touching them
+  are drawn; the image is only right inside those boxes.
+
+  """
+
+  coords = assets[0]
+
+  if backgrounds is None:
+    backgrounds = {}
+
+  # keep the one fetched; another thread may empty backgrounds meanwhile
+  key = background_key(state)
+  background = backgrounds.get(key)
+  if background is None:
+    background = get_background(datafilesdir, assets, state)
+    backgrounds[key] = background
+  else:
+    stats.count("backgrounds_shared")
+
+  im = background.copy()
+
+  # plan_units, timed in two parts
   draw = ImageDraw.Draw(im)
-  draw_background(coords, powers, draw, im, options)
-  draw_powers(datafilesdir, powers, coords, draw, im)
+  started = stats.begin()
+  draw_ops(plan_powers(datafilesdir, state, coords), draw, im, clip)
+  stats.count("units", len(state))
+  stats.end("powers", started)
 
-  if "PlacesCannotRetreatTo" in options:
-    draw_standoffs(datafilesdir, coords, options["PlacesCannotRetreatTo"], draw, im)
-  
-  im.save(img_out)
+  if "PlacesCannotRetreatTo" in state.options:
+    started = stats.begin()
+    draw_ops(plan_standoffs(datafilesdir, coords,
+                            state.options["PlacesCannotRetreatTo"]),
+             draw, im, clip)
+    stats.end("standoffs", started)
+
+  return im
+
+def plan_units(datafilesdir, coords, state):
+  """ the operations for everything drawn on top of the background """
+
+  ops = plan_powers(datafilesdir, state, coords)
+  if "PlacesCannotRetreatTo" in state.options:
+    ops.extend(plan_standoffs(datafilesdir, coords,
+                              state.options["PlacesCannotRetreatTo"]))
+  return ops
+
+def dirty_boxes(datafilesdir, assets, old_state, state):
+  """ the parts of the map that differ between two statuses' renders
+
+  Returns a list of boxes (left, top, right, bottom) covering every
+  pixel that can differ between the two renders, or None if we can't
+  tell and the whole map should be redrawn.
+
+  """
+
+  coords, base, labels, source_hash = assets
+  boxes = []
+
+  # supply center ownership
+  old_ownership, ownership = ownership_of(old_state), ownership_of(state)
+  if use_flood_fill and old_ownership != ownership:
+    if not labels:
+      return None
+    old_fill = replay_fills(coords, old_ownership, labels)
+    new_fill = replay_fills(coords, ownership, labels)
+    for label, color in new_fill.items():
+      if old_fill[label] != color:
+        boxes.append(region_box(labels, label))
+
+  # the wormhole
+  wormholes = [tuple(w.upper() for w in s.options.get("Wormhole", ()))
+               for s in [old_state, state]]
+  if wormholes[0] != wormholes[1]:
+    for wormhole in wormholes:
+      if wormhole:
+        a, b = wormhole
+        box = wormhole_box(wormhole_curve(coords[a][0], coords[b][0]),
+                           base.size)
+        if box:
+          boxes.append(box)
+
+  # units and standoffs that were added, removed or changed
+  old_ops = plan_units(datafilesdir, coords, old_state)
+  new_ops = plan_units(datafilesdir, coords, state)
+  for op in old_ops:
+    if op not in new_ops:
+      boxes.append(op[0])
+  for op in new_ops:
+    if op not in old_ops:
+      boxes.append(op[0])
+
+  # and ones drawn in both, but now in a different order relative to
+  # something they overlap
+  common = [op for op in new_ops if op in old_ops]
+  old_order = [old_ops.index(op) for op in common]
+  for i in range(len(common)):
+    for j in range(i+1, len(common)):
+      if old_order[i] > old_order[j] and touches(common[i][0], [common[j][0]]):
+        boxes.append(common[i][0])
+        boxes.append(common[j][0])
+
+  return boxes
+
+def render_incremental(datafilesdir, assets, prev_im, old_state, state,
+                       backgrounds=None):
+  """ update prev_im, the render of the old status, to the new one
+
+  Only the boxes from dirty_boxes are redrawn; the result is the same
+  as render(datafilesdir, assets, state).
+
+  """
+
+  coords, base, labels, source_hash = assets
+
+  boxes = dirty_boxes(datafilesdir, assets, old_state, state)
+  if boxes is None or prev_im.size != base.size:
+    return render(datafilesdir, assets, state, backgrounds)
+
+  img_x, img_y = base.size
+  clipped = []
+  for left, top, right, bottom in boxes:
+    box = max(left, 0), max(top, 0), min(right, img_x), min(bottom, img_y)
+    if box[0] < box[2] and box[1] < box[3] and box not in clipped:
+      clipped.append(box)
+
+  im = prev_im.convert(base.mode)
+  if not clipped:
+    return im
+
+  patch = render(datafilesdir, assets, state, backgrounds, clipped)
+  for box in clipped:
+    im.paste(patch.crop(box), box[:2])
+  return im
+
+def webp_lossless(fname):
+  """ whether the WebP file fname was saved lossless """
+
+  inf = open(fname, "rb")
+  try:
+    inf.seek(12) # past "RIFF", the size and "WEBP"
+    while True:
+      header = inf.read(8)
+      if len(header) < 8:
+        return False
+      kind, size = header[:4], struct.unpack("<I", header[4:])[0]
+      if kind in ("VP8L", "VP8 "):
+        return kind == "VP8L"
+      inf.seek(size + (size & 1), 1)
+  finally:
+    inf.close()
+
+def exact_image(im, fname):
+  """ whether im, opened from fname, has every pixel as it was drawn
+
+  Images quantized to a palette (--encoding email) or saved lossy
+  don't, so patching them wouldn't match a full render.
+
+  """
+
+  if im.mode not in ("RGB", "RGBA"):
+    return False
+  if im.format == "JPEG":
+    return False
+  if im.format == "WEBP":
+    return webp_lossless(fname)
+  return True
+
+def start_incremental(datafilesdir, prev_status_fname, prev_img,
+                      status_fname, img_out, verify=False):
+  """ like start, but only redraw what changed since prev_status_fname
+
+  prev_img must be the render of prev_status_fname with the same data
+  files.  If it was saved with a palette or lossy encoding the whole
+  map is drawn instead.  If verify, also do a full render and raise if
+  they differ.
+
+  """
+
+  assets = load_assets(datafilesdir)
+  coords = assets[0]
+
+  started = stats.begin()
+  old_state = gamestate.load(prev_status_fname, coords)
+  state = gamestate.load(status_fname, coords)
+  stats.end("status", started)
+
+  prev_im = Image.open(prev_img)
+  if exact_image(prev_im, prev_img):
+    im = render_incremental(datafilesdir, assets, prev_im, old_state, state)
+  else:
+    sys.stderr.write("%s isn't exact (%s %s), drawing the whole map\n"
+                     % (prev_img, prev_im.format, prev_im.mode))
+    im = render(datafilesdir, assets, state)
+
+  if verify:
+    full = render(datafilesdir, assets, state)
+    diff = ImageChops.difference(im, full).getbbox()
+    if diff:
+      raise Exception("Incremental render of %s differs from a full render in %s"
+                      % (status_fname, diff))
+    print "Verified %s against a full render" % img_out
+
+  started = stats.begin()
+  save_image(im, img_out)
+  stats.end("save", started)
+  if tiles_dir:
+    write_tiles(im, img_out)
+
+# How images are written.  format None means by img_out's extension,
+# as disp always did.  colors quantizes to an adaptive palette of that
+# many colors, which suits the map's few flat colors; strip leaves out
+# any ICC profile or EXIF.  The rest are PIL encoder options.
+ENCODINGS = {
+  "default": {},
+  "fast":    {"format": "PNG", "compress_level": 1},
+  "email":   {"format": "PNG", "colors": 256, "optimize": True, "strip": True},
+  "archive": {"format": "PNG", "optimize": True, "strip": True},
+  "webp":    {"format": "WEBP", "lossless": True, "quality": 100, "method": 6,
+              "strip": True},
+}
+
+# the png compress_type, zlib's strategy; python 2's zlib only names
+# the first three
+ZLIB_STRATEGIES = {"default": 0, "filtered": 1, "huffman": 2, "rle": 3,
+                   "fixed": 4}
+
+def parse_bool(value):
+  return value.lower() in ("1", "yes", "true", "on")
+
+def parse_strategy(value):
+  if value in ZLIB_STRATEGIES:
+    return ZLIB_STRATEGIES[value]
+  return int(value)
+
+ENCODING_OPTIONS = {"format": str.upper,
+                    "colors": int,
+                    "compress_level": int,
+                    "compress_type": parse_strategy,
+                    "optimize": parse_bool,
+                    "strip": parse_bool,
+                    "lossless": parse_bool,
+                    "quality": int,
+                    "method": int}
+
+encoding = "default" # what save_image uses unless told otherwise
+
+# if set, images are also cut into a tile pyramid (see tiles.py) here.
+# A %s is replaced by the image's name without its extension, so a
+# batch of images each get their own.
+tiles_dir = None
+tile_threads = 2
+
+def parse_encoding(spec):
+  """ "email" or "email,colors=64,compress_type=rle" -> options dict
+
+  A spec starts with a preset from ENCODINGS, or is just overrides of
+  the default one.
+
+  """
+
+  words = spec.split(",")
+  options = {}
+  if "=" not in words[0]:
+    preset = words.pop(0)
+    if preset not in ENCODINGS:
+      raise Exception("Unknown encoding %s (try %s)"
+                      % (preset, ", ".join(sorted(ENCODINGS))))
+    options.update(ENCODINGS[preset])
+  for word in words:
+    name, value = word.split("=", 1)
+    if name not in ENCODING_OPTIONS:
+      raise Exception("Unknown encoding option %s (try %s)"
+                      % (name, ", ".join(sorted(ENCODING_OPTIONS))))
+    options[name] = ENCODING_OPTIONS[name](value)
+  return options
+
+def encoding_extension(spec=None):
+  """ ".webp" and the like, or None if the encoding doesn't choose """
+
+  fmt = parse_encoding(spec or encoding).get("format")
+  if fmt:
+    return "." + fmt.lower()
+  return None
+
+def save_image(im, out, spec=None):
+  """ im.save(out) with the encoding spec, or the global encoding
+
+  out is a file name or a file object; for a file object, or a file
+  name without an extension PIL knows, the format defaults to PNG.
+  Returns the image as saved, which is a palette image after colors.
+
+  """
+
+  options = parse_encoding(spec or encoding)
+  fmt = options.pop("format", None)
+  palette_colors = options.pop("colors", None)
+  if options.pop("strip", False):
+    options["icc_profile"] = ""
+    options["exif"] = ""
+
+  Image.init()
+  if fmt is None:
+    if not isinstance(out, basestring) or \
+       os.path.splitext(out)[1].lower() not in Image.EXTENSION:
+      fmt = "PNG"
+  elif fmt not in Image.SAVE:
+    raise Exception("This PIL can't write %s images" % fmt)
+
+  if palette_colors:
+    im = im.convert("P", palette=Image.ADAPTIVE, colors=palette_colors)
+  im.save(out, fmt, **options)
+  return im
+
+def write_tiles(im, img_out):
+  """ cut im, just saved as img_out, into tiles_dir's pyramid """
+
+  import tiles
+  outdir = tiles_dir
+  if "%s" in outdir:
+    outdir = outdir % os.path.splitext(os.path.basename(img_out))[0]
+  ext = encoding_extension() or ".png"
+  started = stats.begin()
+  written, total = tiles.write_pyramid(im, outdir, threads=tile_threads,
+                                       save=save_image, ext=ext,
+                                       encoding=encoding)
+  stats.end("tiles", started)
+  stats.count("tiles_written", written)
+  stats.count("tiles", total)
+
+def encoding_report(im, presets=None, outf=sys.stdout):
+  """ print how long each preset takes to encode im and how big it is """
+
+  from cStringIO import StringIO
+  im = im.convert("RGB") # in case it was saved with a palette
+  for preset in presets or sorted(ENCODINGS):
+    buf = StringIO()
+    started = time.time()
+    try:
+      save_image(im, buf, preset)
+    except Exception, e:
+      outf.write("%-8s %s\n" % (preset, e))
+      continue
+    outf.write("%-8s %9d bytes %7.3fs\n" % (preset, len(buf.getvalue()),
+                                            time.time() - started))
+
+# what pool workers render from.  Set before the pool is started so
+# forked workers share the parent's copy instead of loading their own.
+batch_state = None # (datafilesdir, assets, backgrounds)
+
+def render_job(job):
+  """ render one (status_fname, img_out) from batch_state
+
+  Returns (img_out, error) where error is None or a formatted
+  traceback, so one failing view doesn't stop the others.
+
+  """
+
+  status_fname, img_out = job
+  datafilesdir, assets, backgrounds = batch_state
+  try:
+    started = stats.begin()
+    state = gamestate.load(status_fname, assets[0])
+    stats.end("status", started)
+
+    im = render(datafilesdir, assets, state, backgrounds)
+
+    started = stats.begin()
+    save_image(im, img_out)
+    stats.end("save", started)
+    stats.count("images")
+    if tiles_dir:
+      write_tiles(im, img_out)
+  except Exception:
+    return img_out, traceback.format_exc()
+  return img_out, None
+
+def pool_render_job(job):
+  """ render_job in a pool worker, also returning the worker's stats """
+
+  stats.reset()
+  img_out, error = render_job(job)
+  return img_out, error, stats.snapshot()
+
+def start_batch(datafilesdir, jobs, processes=1):
+  """ render several status files of the same board
+
+  jobs is a list of (status_fname, img_out) pairs.  The data files are
+  read once for all of them, and views that agree on supply center
+  ownership and the wormhole (all of splitdisp's views of one turn)
+  share one background, so only the units are drawn per view.
+
+  With processes > 1 the views are drawn in a pool of that many
+  processes.  Everything shared is loaded and every background drawn
+  before the pool forks, so workers only draw units.  The images are
+  the same as drawing them one at a time.
+
+  Returns [(img_out, error)] in the order of jobs, where error is None
+  or the traceback of what went wrong with that image.  Timings and
+  counts, the workers' included, are added to stats.
+
+  """
+
+  results = dict(iter_batch(datafilesdir, jobs, processes))
+  return [(img_out, results[img_out]) for status_fname, img_out in jobs]
+
+def iter_batch(datafilesdir, jobs, processes=1):
+  """ start_batch, yielding each (img_out, error) as soon as it's drawn
+
+  With processes > 1 they come in the order they finish, not the
+  order of jobs.  Closing the generator early stops the pool, so the
+  images not yet drawn never are.
+
+  """
+
+  global batch_state
+
+  assets = load_assets(datafilesdir)
+  coords = assets[0]
+
+  backgrounds = {}
+  if processes > 1:
+    for status_fname, img_out in jobs:
+      try:
+        state = gamestate.load(status_fname, coords)
+      except Exception:
+        continue # render_job will report it
+      key = background_key(state)
+      if key not in backgrounds:
+        backgrounds[key] = get_background(datafilesdir, assets, state)
+
+  batch_state = datafilesdir, assets, backgrounds
+  pool = None
+  finished = False
+  try:
+    if processes > 1:
+      import multiprocessing # not in old versions of python
+      pool = multiprocessing.Pool(processes)
+      for img_out, error, (stages, counters) in pool.imap_unordered(
+          pool_render_job, jobs):
+        stats.add(stages, counters)
+        yield img_out, error
+    else:
+      for job in jobs:
+        yield render_job(job)
+    finished = True
+  finally:
+    if pool is not None:
+      if finished:
+        pool.close()
+      else:
+        pool.terminate()
+      pool.join()
+    batch_state = None
+
+def start(datafilesdir, status_fname, img_out):
+  for img_out, error in start_batch(datafilesdir, [(status_fname, img_out)]):
+    if error:
+      raise Exception(error)
+
+def start_archived(datafilesdir, db_fname, season, view, img_out):
+  """ like start, but drawing a turn from archive.py's database """
+
+  import archive # needs sqlite3, which old versions of python don't have
+  assets = load_assets(datafilesdir)
+
+  started = stats.begin()
+  db = archive.connect(db_fname)
+  try:
+    state = archive.load_state(db, season, view)
+  finally:
+    db.close()
+  stats.end("status", started)
+
+  im = render(datafilesdir, assets, state)
+
+  started = stats.begin()
+  save_image(im, img_out)
+  stats.end("save", started)
+  if tiles_dir:
+    write_tiles(im, img_out)
+
+def profile_call(profile_fname, func, *args):
+  """ call func under cProfile, and tracemalloc where python has it
+
+  Writes the profile to profile_fname (for pstats), a summary of it to
+  profile_fname.txt and the biggest allocations to
+  profile_fname.tracemalloc.txt.
+
+  """
+
+  try:
+    import cProfile as profile
+  except ImportError:
+    import profile # old versions of python
+  import pstats
+  try:
+    import tracemalloc
+  except ImportError:
+    tracemalloc = None
+
+  if tracemalloc:
+    tracemalloc.start()
+  prof = profile.Profile()
+  try:
+    return prof.runcall(func, *args)
+  finally:
+    prof.dump_stats(profile_fname)
+    outf = open(profile_fname + ".txt", "w")
+    pstats.Stats(profile_fname, stream=outf).sort_stats("cumulative").print_stats(40)
+    outf.close()
+
+    if tracemalloc:
+      snapshot = tracemalloc.take_snapshot()
+      tracemalloc.stop()
+      outf = open(profile_fname + ".tracemalloc.txt", "w")
+      for stat in snapshot.statistics("lineno")[:40]:
+        outf.write("%s\n" % stat)
+      outf.close()
+
+# the options svgdisp can't do anything with
+NOT_FOR_SVG = ["--encoding", "--encoding-report", "--tiles", "--archive",
+               "--prev-status", "--prev-image", "--verify"]
 
 if __name__ == "__main__":
-  start(*sys.argv[1:])
+  opts, args = getopt.getopt(sys.argv[1:], "",
+                             ["prev-status=", "prev-image=", "verify",
+                              "list-backgrounds", "purge-backgrounds",
+                              "stats=", "prometheus=", "profile=",
+                              "encoding=", "encoding-report", "tiles=",
+                              "archive=", "season=", "view="])
+  opts = dict(opts)
+  if "--list-backgrounds" in opts:
+    datafilesdir, = args
+    for mtime, size, key in list_backgrounds(datafilesdir):
+      print "%s %9d %s" % (time.strftime("%Y-%m-%d %H:%M:%S",
+                                         time.localtime(mtime)), size, key)
+  elif "--purge-backgrounds" in opts:
+    datafilesdir, = args
+    print "Removed %s backgrounds" % purge_backgrounds(datafilesdir)
+  else:
+    if "--archive" in opts:
+      datafilesdir, img_out = args
+      status_fname = "%s:%s" % (opts["--archive"], opts["--season"])
+    else:
+      datafilesdir, status_fname, img_out = args
+    if img_out.lower().endswith(".svg"):
+      unusable = [opt for opt in NOT_FOR_SVG if opt in opts]
+      if unusable:
+        sys.exit("%s can't be used for SVG images" % ", ".join(unusable))
+    encoding = opts.get("--encoding", encoding)
+    parse_encoding(encoding) # complain now rather than after drawing
+    tiles_dir = opts.get("--tiles")
+    if "--archive" in opts:
+      func = start_archived
+      args = (datafilesdir, opts["--archive"], opts["--season"],
+              opts.get("--view", "full"), img_out)
+    elif img_out.lower().endswith(".svg"):
+      # svgdisp imports this file again as disp, a copy with its own
+      # globals; it draws with that copy, so report that copy's stats
+      import svgdisp
+      func = svgdisp.start
+      stats = svgdisp.disp.stats
+    elif "--prev-status" in opts:
+      func = start_incremental
+      args = (datafilesdir, opts["--prev-status"], opts["--prev-image"],
+              status_fname, img_out, "--verify" in opts)
+    else:
+      func = start
+    started = time.time()
+    if "--profile" in opts:
+      profile_call(opts["--profile"], func, *args)
+    else:
+      func(*args)
+    stats.end("total", started)
+    if "--encoding-report" in opts:
+      encoding_report(Image.open(img_out))
+    write_stats(opts.get("--stats"), opts.get("--prometheus"),
+                status=status_fname, image=img_out)
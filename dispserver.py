@@ -0,0 +1,313 @@
+"""
+Usage:
+  $ python dispserver.py [--socket PATH | --port N] [--threads N] \
+                         datafilesdir [datafilesdir ...]
+
+Keeps disp's data files loaded and decoded between renders, so each
+render only costs drawing.  It speaks HTTP, either on a Unix socket
+(--socket) or on 127.0.0.1 (--port, 8371 by default):
+
+  POST /render?data=DIR&encoding=SPEC
+
+    The body is the status file.  Returns the image; it's never
+    written to disk on the server.  data picks one of the
+    datafilesdirs given on the command line and defaults to the
+    first.  encoding is as for disp.py --encoding, such as email or
+    webp.
+
+  GET /stats
+
+    JSON with request counts, latencies (in seconds) and queue depth.
+
+For example:
+
+  $ curl --unix-socket /tmp/disp.sock --data-binary @status.txt \
+         -o map.png http://localhost/render
+
+Renders are done by --threads worker threads (2 by default) taking
+requests off one queue.
+
+"""
+
+import sys
+import os.path
+import time
+import getopt
+import traceback
+import threading
+import Queue
+import SocketServer
+import BaseHTTPServer
+import urlparse
+import json
+from cStringIO import StringIO
+
+import disp
+import gamestate
+
+DEFAULT_PORT = 8371
+
+# how many recent requests the latency figures are over
+LATENCY_WINDOW = 1000
+
+# drawn backgrounds kept per data dir; a game only has a few per turn
+MAX_BACKGROUNDS = 32
+
+def percentile(sorted_values, fraction):
+  if not sorted_values:
+    return None
+  return sorted_values[min(len(sorted_values)-1,
+                           int(fraction*len(sorted_values)))]
+
+class DataDir(object):
+  """ the loaded assets and drawn backgrounds for one datafilesdir
+
+  The assets are loaded again if COORDINATES or the map image change.
+
+  """
+
+  def __init__(self, datafilesdir):
+    self.datafilesdir = datafilesdir
+    self.lock = threading.Lock()
+    self.signature = None
+    self.assets = None
+    self.backgrounds = {}
+
+  def files_signature(self):
+    signature = []
+    for fname in [disp.COORDS, disp.IMAGE]:
+      st = os.stat(os.path.join(self.datafilesdir, fname))
+      signature.append((st.st_mtime, st.st_size))
+    return signature
+
+  def get(self):
+    """ (assets, backgrounds), as disp.render takes them """
+
+    self.lock.acquire()
+    try:
+      signature = self.files_signature()
+      if signature != self.signature:
+        self.assets = disp.load_assets(self.datafilesdir)
+        self.backgrounds = {}
+        self.signature = signature
+      if len(self.backgrounds) > MAX_BACKGROUNDS:
+        # a new dict, as renders still drawing may be using the old one
+        self.backgrounds = {}
+      return self.assets, self.backgrounds
+    finally:
+      self.lock.release()
+
+class Job(object):
+  """ one render request, waiting in the queue or being drawn """
+
+  def __init__(self, datadir, status_text, encoding=None):
+    self.datadir = datadir
+    self.status_text = status_text
+    self.encoding = encoding
+    self.queued = time.time()
+    self.done = threading.Event()
+    self.png = None   # the encoded image
+    self.error = None # formatted traceback if it failed
+
+  def run(self):
+    try:
+      assets, backgrounds = self.datadir.get()
+      state = gamestate.parse(self.status_text.splitlines(), assets[0])
+      im = disp.render(self.datadir.datafilesdir, assets, state, backgrounds)
+      buf = StringIO()
+      disp.save_image(im, buf, self.encoding)
+      self.png = buf.getvalue()
+    except Exception:
+      self.error = traceback.format_exc()
+    self.done.set()
+
+class Renderer(object):
+  """ a queue of jobs and the threads that draw them """
+
+  def __init__(self, datafilesdirs, threads=2):
+    self.datadirs = {}
+    self.default = None
+    for datafilesdir in datafilesdirs:
+      datafilesdir = os.path.abspath(datafilesdir)
+      self.datadirs[datafilesdir] = DataDir(datafilesdir)
+      if self.default is None:
+        self.default = datafilesdir
+
+    self.queue = Queue.Queue()
+    self.lock = threading.Lock()
+    self.started = time.time()
+    self.requests = 0
+    self.errors = 0
+    self.in_flight = 0
+    self.max_queue_depth = 0
+    self.latencies = [] # (total, waiting in the queue) of recent requests
+
+    self.threads = []
+    for i in range(threads):
+      t = threading.Thread(target=self.work)
+      t.setDaemon(True)
+      t.start()
+      self.threads.append(t)
+
+  def warm(self):
+    """ load every data dir now instead of on its first request """
+    for datadir in self.datadirs.values():
+      datadir.get()
+
+  def datadir(self, datafilesdir):
+    if datafilesdir is None:
+      datafilesdir = self.default
+    return self.datadirs.get(os.path.abspath(datafilesdir))
+
+  def work(self):
+    while True:
+      job = self.queue.get()
+      started = time.time()
+      self.lock.acquire()
+      self.in_flight += 1
+      self.lock.release()
+
+      job.run()
+
+      finished = time.time()
+      self.lock.acquire()
+      self.in_flight -= 1
+      self.requests += 1
+      if job.error:
+        self.errors += 1
+      self.latencies.append((finished - job.queued, started - job.queued))
+      del self.latencies[:-LATENCY_WINDOW]
+      self.lock.release()
+
+  def render(self, datadir, status_text, encoding=None):
+    """ queue a render and wait for it; returns the finished Job """
+
+    job = Job(datadir, status_text, encoding)
+    self.queue.put(job)
+    depth = self.queue.qsize()
+    self.lock.acquire()
+    self.max_queue_depth = max(self.max_queue_depth, depth)
+    self.lock.release()
+    job.done.wait()
+    return job
+
+  def stats(self):
+    self.lock.acquire()
+    try:
+      totals = [total for total, waited in self.latencies]
+      waits = [waited for total, waited in self.latencies]
+      totals.sort()
+      waits.sort()
+      latency = {}
+      for name, values in [("total", totals), ("queued", waits)]:
+        latency[name] = {"p50": percentile(values, 0.5),
+                         "p90": percentile(values, 0.9),
+                         "p99": percentile(values, 0.99),
+                         "max": percentile(values, 1.0)}
+      return {"uptime": time.time() - self.started,
+              "requests": self.requests,
+              "errors": self.errors,
+              "threads": len(self.threads),
+              "queue_depth": self.queue.qsize(),
+              "max_queue_depth": self.max_queue_depth,
+              "in_flight": self.in_flight,
+              "latency": latency,
+              "latency_window": len(totals),
+              "icons": disp.icon_cache.stats(),
+              "datafilesdirs": sorted(self.datadirs.keys())}
+    finally:
+      self.lock.release()
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+  def log_message(self, format, *args):
+    # client_address is a string for Unix sockets, not (host, port)
+    client = "unix"
+    if isinstance(self.client_address, tuple):
+      client = self.client_address[0]
+    sys.stderr.write("%s - - [%s] %s\n" % (client, self.log_date_time_string(),
+                                            format % args))
+
+  def reply(self, code, body, content_type="application/json"):
+    self.send_response(code)
+    self.send_header("Content-Type", content_type)
+    self.send_header("Content-Length", str(len(body)))
+    self.end_headers()
+    self.wfile.write(body)
+
+  def reply_json(self, code, obj):
+    self.reply(code, json.dumps(obj, indent=1, sort_keys=True) + "\n")
+
+  def do_GET(self):
+    path = urlparse.urlparse(self.path)[2]
+    if path == "/stats":
+      self.reply_json(200, self.server.renderer.stats())
+    else:
+      self.reply_json(404, {"error": "no such path"})
+
+  def do_POST(self):
+    url = urlparse.urlparse(self.path)
+    if url[2] != "/render":
+      return self.reply_json(404, {"error": "no such path"})
+
+    query = urlparse.parse_qs(url[4])
+    datafilesdir = query.get("data", [None])[0]
+    encoding = query.get("encoding", [None])[0]
+
+    datadir = self.server.renderer.datadir(datafilesdir)
+    if not datadir:
+      return self.reply_json(400, {"error": "not serving %s" % datafilesdir})
+
+    try:
+      fmt = disp.parse_encoding(encoding or disp.encoding).get("format", "PNG")
+    except Exception, e:
+      return self.reply_json(400, {"error": str(e)})
+
+    length = int(self.headers.get("Content-Length", 0))
+    status_text = self.rfile.read(length)
+
+    job = self.server.renderer.render(datadir, status_text, encoding)
+    if job.error:
+      self.reply_json(500, {"error": job.error})
+    else:
+      self.reply(200, job.png, "image/" + fmt.lower())
+
+class TCPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+  daemon_threads = True
+
+class UnixServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+  daemon_threads = True
+
+  def server_bind(self):
+    if os.path.exists(self.server_address):
+      os.remove(self.server_address) # left over from a previous run
+    SocketServer.UnixStreamServer.server_bind(self)
+
+def serve(datafilesdirs, socket_path=None, port=DEFAULT_PORT, threads=2):
+  renderer = Renderer(datafilesdirs, threads)
+  renderer.warm()
+
+  if socket_path:
+    server = UnixServer(socket_path, Handler)
+    where = socket_path
+  else:
+    server = TCPServer(("127.0.0.1", port), Handler)
+    where = "http://127.0.0.1:%s/" % port
+  server.renderer = renderer
+
+  sys.stderr.write("Serving %s on %s\n" % (", ".join(datafilesdirs), where))
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    if socket_path and os.path.exists(socket_path):
+      os.remove(socket_path)
+
+if __name__ == "__main__":
+  opts, args = getopt.getopt(sys.argv[1:], "",
+                             ["socket=", "port=", "threads="])
+  opts = dict(opts)
+  if not args:
+    sys.exit(__doc__)
+  serve(args, opts.get("--socket"), int(opts.get("--port", DEFAULT_PORT)),
+        int(opts.get("--threads", 2)))
@@ -0,0 +1,330 @@
+"""
+
+Compact model of a status file, shared by disp and splitdisp
+
+A GameState keeps each unit as a handful of small integers in parallel
+arrays instead of a list of attribute strings: the province as an
+interned id, the unit's type and markings as bit flags, and the
+provinces and races its attributes refer to as ids too.  Status files
+are read in one pass, and the attribute words are only looked at then.
+
+Province names are interned in a Names table.  By default every state
+shares one table, so a long archive of seasons stores each name once.
+
+"""
+
+import threading
+from array import array
+
+RACES = ["Federation", "Klingon", "Ferengi", "Romulan",
+         "Cardassian", "Dominion", "Borg"]
+
+# unit flags
+ARMY        = 0x0001
+FLEET       = 0x0002
+FLARMY      = 0x0004
+CLOAKED     = 0x0008
+INFILTRATED = 0x0010
+TRADER      = 0x0020
+ENTERPRISE  = 0x0040
+DISLODGED   = 0x0080 # unit_from says from where, if it's known
+ASSIMILATED = 0x0100 # unit_assimilated says from whom
+COAST_SHIFT = 9      # bits 9-11: 1 + index into COASTS, 0 for none
+COAST_MASK  = 0x0e00
+MODE_MASK   = ARMY|FLEET|FLARMY
+
+MODES = [(ARMY, "Army"), (FLEET, "Fleet"), (FLARMY, "Flarmy")]
+COASTS = ["(nc)", "(ec)", "(sc)", "(wc)"]
+SECONDARY_COASTS = ["(sc)", "(wc)"]
+
+# attribute words that are just flags, by lower case word
+WORD_FLAGS = {"army": ARMY,
+              "fleet": FLEET,
+              "flarmy": FLARMY,
+              "cloaked": CLOAKED,
+              "infiltrated": INFILTRATED,
+              "trader": TRADER,
+              "enterprise": ENTERPRISE}
+
+class Names(object):
+  """ interns names as small integers
+
+  Looking up a name already in the table doesn't lock; adding one does,
+  so threads parsing at once never give two names the same id.
+
+  """
+
+  __slots__ = ["names", "ids", "lock"]
+
+  def __init__(self, names=()):
+    self.names = []
+    self.ids = {}
+    self.lock = threading.Lock()
+    for name in names:
+      self.intern(name)
+
+  def intern(self, name):
+    try:
+      return self.ids[name]
+    except KeyError:
+      pass
+
+    self.lock.acquire()
+    try:
+      if name not in self.ids:
+        # the name goes in before its id, so any id seen can be looked up
+        self.names.append(name)
+        self.ids[name] = len(self.names) - 1
+      return self.ids[name]
+    finally:
+      self.lock.release()
+
+  def __getitem__(self, i):
+    return self.names[i]
+
+  def __len__(self):
+    return len(self.names)
+
+# shared by every state unless told otherwise
+provinces = Names()
+races = Names(RACES)
+
+def race_mask(race_names, races=races):
+  """ ['Klingon', 'Borg'] -> bitmask of those races """
+
+  mask = 0
+  for race in race_names:
+    mask |= 1 << races.intern(race)
+  return mask
+
+def mask_races(mask, races=races):
+  """ bitmask -> ['Klingon', 'Borg'], in race id order """
+
+  found = []
+  i = 0
+  while mask:
+    if mask & 1:
+      found.append(races[i])
+    mask >>= 1
+    i += 1
+  return found
+
+def parse_attrs(attrs, provinces=provinces, races=races):
+  """ a unit's attribute words -> (flags, from, assimilated, knows, extra)
+
+  from is the province id a dislodged unit was dislodged from (-1 if
+  not given), assimilated the race id it was assimilated from (-1 if
+  none) and knows the bitmask of races that know about it.  extra is a
+  tuple of the words that aren't flags, in order; disp labels the unit
+  with their initials.  Knows(...) stays in extra as well as in knows,
+  as it's always been labelled "(K)".
+
+  Matching follows what disp always did: the flag words in any case,
+  Assimilated(...) and Dislodged exactly.  A later mode word replaces
+  an earlier one.
+
+  """
+
+  flags = 0
+  dislodged_from = -1
+  assimilated = -1
+  knows = 0
+  extra = []
+  for attr in attrs:
+    lattr = attr.lower()
+    if lattr in WORD_FLAGS:
+      if WORD_FLAGS[lattr] & MODE_MASK:
+        flags &= ~MODE_MASK
+      flags |= WORD_FLAGS[lattr]
+    elif lattr in COASTS:
+      flags = (flags & ~COAST_MASK) | ((COASTS.index(lattr)+1) << COAST_SHIFT)
+    elif attr.startswith("Assimilated("):
+      flags |= ASSIMILATED
+      assimilated = races.intern(attr[len("Assimilated("):].rstrip(")"))
+    elif attr.startswith("Dislodged"):
+      flags |= DISLODGED
+      if attr.startswith("Dislodged(") and attr.endswith(")"):
+        dislodged_from = provinces.intern(attr[len("Dislodged("):-1].upper())
+    else:
+      assert "Disloged" not in attr
+      if attr.startswith("Knows(") and attr.endswith(")"):
+        knows |= race_mask(attr[len("Knows("):-1].split(","), races)
+      extra.append(attr)
+  return flags, dislodged_from, assimilated, knows, tuple(extra)
+
+def unit_mode(flags):
+  """ "Army", "Fleet", "Flarmy" or None """
+
+  for flag, mode in MODES:
+    if flags & flag:
+      return mode
+  return None
+
+def is_secondary(flags):
+  """ whether the unit is on a province's second coast """
+  return unit_coast(flags) in SECONDARY_COASTS
+
+def unit_coast(flags):
+  """ the coast word, like "(sc)", or None """
+
+  coast = (flags & COAST_MASK) >> COAST_SHIFT
+  if coast:
+    return COASTS[coast-1]
+  return None
+
+class GameState(object):
+  """ one status file
+
+  options is {name: [words]}, as disp.parse_status always returned.
+
+  Powers are numbered in file order: countries[p] and power_races[p]
+  are race ids.  Supply centers are sc_prov[i] owned by sc_power[i],
+  in file order.  Unit u is in unit_prov[u], belongs to unit_power[u]
+  and has the rest of its attributes in unit_flags[u], unit_from[u],
+  unit_assimilated[u] and unit_knows[u], as from parse_attrs.  The
+  rare units with other words have them in unit_extra {u: (words)}.
+
+  """
+
+  __slots__ = ["options", "provinces", "races", "countries", "power_races",
+               "sc_prov", "sc_power", "unit_prov", "unit_power",
+               "unit_flags", "unit_from", "unit_assimilated", "unit_knows",
+               "unit_extra"]
+
+  def __init__(self, provinces=provinces, races=races):
+    self.options = {}
+    self.provinces = provinces
+    self.races = races
+    self.countries = []
+    self.power_races = array("B")
+    self.sc_prov = array("H")
+    self.sc_power = array("B")
+    self.unit_prov = array("H")
+    self.unit_power = array("B")
+    self.unit_flags = array("H")
+    self.unit_from = array("h")
+    self.unit_assimilated = array("b")
+    self.unit_knows = array("L")
+    self.unit_extra = {}
+
+  def add_power(self, country, race):
+    self.countries.append(country)
+    self.power_races.append(self.races.intern(race))
+    return len(self.countries) - 1
+
+  def add_sc(self, power, name):
+    self.sc_prov.append(self.provinces.intern(name))
+    self.sc_power.append(power)
+
+  def add_unit(self, power, name, attrs):
+    flags, dislodged_from, assimilated, knows, extra = parse_attrs(
+      attrs, self.provinces, self.races)
+    if extra:
+      self.unit_extra[len(self.unit_prov)] = extra
+    self.unit_prov.append(self.provinces.intern(name))
+    self.unit_power.append(power)
+    self.unit_flags.append(flags)
+    self.unit_from.append(dislodged_from)
+    self.unit_assimilated.append(assimilated)
+    self.unit_knows.append(knows)
+
+  def __len__(self):
+    """ the number of units """
+    return len(self.unit_prov)
+
+  def race(self, power):
+    return self.races[self.power_races[power]]
+
+  def unit_name(self, u):
+    return self.provinces[self.unit_prov[u]]
+
+  def scs(self, power):
+    """ names of the supply centers power owns """
+    return [self.provinces[prov]
+            for prov, owner in zip(self.sc_prov, self.sc_power)
+            if owner == power]
+
+  def unit_attrs(self, u):
+    """ the attribute words for unit u, as they'd be in a status file
+
+    Flags come out in a fixed order, so this may not be the same order
+    they were read in.
+
+    """
+
+    flags = self.unit_flags[u]
+    attrs = []
+    if unit_coast(flags):
+      attrs.append(unit_coast(flags))
+    for flag, mode in MODES:
+      if flags & flag:
+        attrs.append(mode)
+    for flag, word in [(ENTERPRISE, "Enterprise"), (TRADER, "Trader"),
+                       (CLOAKED, "Cloaked"), (INFILTRATED, "Infiltrated")]:
+      if flags & flag:
+        attrs.append(word)
+    if flags & ASSIMILATED:
+      attrs.append("Assimilated(%s)" % self.races[self.unit_assimilated[u]])
+    if flags & DISLODGED:
+      if self.unit_from[u] >= 0:
+        prov = self.provinces[self.unit_from[u]]
+        attrs.append("Dislodged(%s)" % (prov[0] + prov[1:].lower()))
+      else:
+        attrs.append("Dislodged")
+    attrs.extend(self.unit_extra.get(u, ()))
+    return attrs
+
+  def powers(self):
+    """ the [country, race, units, scs] lists disp.parse_status returns """
+
+    powers = []
+    for p, country in enumerate(self.countries):
+      powers.append([country, self.race(p), [], self.scs(p)])
+    for u in range(len(self)):
+      powers[self.unit_power[u]][2].append((self.unit_name(u),
+                                            self.unit_attrs(u)))
+    return powers
+
+def parse(lines, known_provinces, provinces=provinces, races=races):
+  """ read a status file (or any iterable of its lines) in one pass
+
+  known_provinces is anything supporting "in" with upper case
+  province names, such as disp.parse_coords' result.  It tells supply
+  center lines ("Mos StP War") apart from unit lines ("Mos Army").
+
+  """
+
+  state = GameState(provinces, races)
+  power = None
+  for line in lines:
+    line = line.strip()
+    if not line or not line[0].isalpha():
+      continue
+
+    if line.endswith(":"):
+      country, race = line[:-1].split(None)
+      assert race.startswith("(") and race.endswith(")")
+      power = state.add_power(country, race[1:-1])
+      continue
+
+    words = line.split()
+    name, attrs = words[0], words[1:]
+    if power is None:
+      state.options[name] = attrs
+    elif not attrs or [a for a in attrs if a.upper() not in known_provinces] == []:
+      state.add_sc(power, name.upper())
+      for attr in attrs:
+        state.add_sc(power, attr.upper())
+    else:
+      state.add_unit(power, name.upper(), attrs)
+
+  return state
+
+def load(status_fname, known_provinces):
+  """ parse a status file by name """
+
+  inf = open(status_fname)
+  try:
+    return parse(inf, known_provinces)
+  finally:
+    inf.close()
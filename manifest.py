@@ -0,0 +1,95 @@
+"""
+
+The list of files splitdisp made for a season
+
+splitdisp records each file it writes in SEASON_manifest.json, for
+example 2371_Spring_Retreats_manifest.json, and sendout reads it back
+to know what to send whom.  Each entry is a dict:
+
+  {"season": "2371_Spring_Retreats", "kind": "status", "race": "Klingon",
+   "path": "2371_Spring_Retreats_status_Klingon.png",
+   "hash": "<md5 of the contents>", "size": 123456}
+
+kind is "status" or "orders"; race is a race, "public" or "full".
+
+"""
+
+import os
+import os.path
+import json
+try:
+  from hashlib import md5
+except ImportError:
+  from md5 import md5 # old versions of python don't have hashlib
+
+MANIFEST = "%s_manifest.json"
+
+def file_hash(fname):
+  h = md5()
+  inf = open(fname, "rb")
+  try:
+    while True:
+      block = inf.read(1 << 16)
+      if not block:
+        break
+      h.update(block)
+  finally:
+    inf.close()
+  return h.hexdigest()
+
+def artifact(season, kind, race, path, directory="."):
+  """ the manifest entry for a file that's just been written
+
+  path is relative to directory, where the manifest is.
+
+  """
+
+  fname = os.path.join(directory, path)
+  return {"season": season,
+          "kind": kind,
+          "race": race,
+          "path": path,
+          "hash": file_hash(fname),
+          "size": os.path.getsize(fname)}
+
+def manifest_fname(season, directory="."):
+  return os.path.normpath(os.path.join(directory, MANIFEST % season))
+
+def read(season, directory="."):
+  """ the season's entries, or None if there's no manifest """
+
+  try:
+    inf = open(manifest_fname(season, directory))
+  except IOError:
+    return None
+  try:
+    entries = json.load(inf)
+  finally:
+    inf.close()
+  for entry in entries:
+    for field in ["season", "kind", "race", "path", "hash"]:
+      entry[field] = str(entry[field]) # not unicode
+  return entries
+
+def update(season, artifacts, directory="."):
+  """ add artifacts to the season's manifest
+
+  Entries for the same path replace the old ones, so running splitdisp
+  again on a season doesn't list anything twice.
+
+  """
+
+  paths = set([a["path"] for a in artifacts])
+  entries = [a for a in read(season, directory) or []
+             if a["path"] not in paths]
+  entries.extend(artifacts)
+  entries.sort(key=lambda a: a["path"])
+
+  fname = manifest_fname(season, directory)
+  tmp = "%s.%s.tmp" % (fname, os.getpid())
+  outf = open(tmp, "w")
+  json.dump(entries, outf, indent=1, sort_keys=True)
+  outf.write("\n")
+  outf.close()
+  os.rename(tmp, fname)
+  return fname
@@ -0,0 +1,381 @@
+"""
+
+Compile MAP and COORDINATES into one indexed binary bundle
+
+Usage:
+  python mapdata.py datafilesdir
+
+Example:
+  python mapdata.py ~/dipper_data_files
+
+This writes MAP.bundle in datafilesdir.  Anything that needs the map
+should call load(datafilesdir), which uses the bundle if it's up to
+date and otherwise reads the text files (and tries to rewrite the
+bundle).
+
+Provinces get integer ids in the order they're listed in MAP, with any
+only found in COORDINATES after those.  Adjacency is stored CSR style:
+the edges of province p are edges offsets[p] to offsets[p+1], each a
+target province and flags saying whether an army or fleet can make
+that move and whether it leaves from p's secondary coast.
+
+"""
+
+import sys
+import os.path
+import struct
+import mmap
+try:
+  from hashlib import md5
+except ImportError:
+  from md5 import md5 # old versions of python don't have hashlib
+
+import disp
+
+MAP = "MAP"
+BUNDLE = "MAP.bundle"
+
+MAGIC = "DIPMAP1\0"
+
+# province flags
+SC = 1
+COASTS = 2     # has a secondary coast
+WATER = 4
+HAS_COORDS = 8 # listed in COORDINATES
+
+# edge flags
+ARMY = 1
+FLEET = 2
+SECONDARY = 4  # the move is from the secondary coast
+
+HEADER = "<8s32sIII" # magic, source hash, provinces, edges, names length
+PROVINCE = "<B8h"    # flags, then the 8 numbers from parse_coords
+
+def source_hash(datafilesdir):
+  """ hash of everything the bundle is built from """
+
+  h = md5()
+  for fname in [MAP, disp.COORDS]:
+    h.update(open(os.path.join(datafilesdir, fname), "rb").read())
+  return h.hexdigest()
+
+def parse_map(map_fname):
+  """ read the MAP file
+
+  Returns (provinces, edges).  provinces is a list of (name, flags) in
+  file order.  edges is {name: {(target, secondary): army_fleet_flags}}
+  where secondary is whether the move is from the second coast.
+
+  The file lists every province with its ISSC HASCOASTS ISWATER flags,
+  then for each province one block of neighbours per coast:
+
+    PROVINCE: BUL
+      5 4 3       <- number of neighbours, armies can, fleets can
+        SER T F   <- neighbour, army can, fleet can
+        ...
+      3 2 3       <- second coast
+        GRE T T
+
+  """
+
+  lines = []
+  for line in open(map_fname):
+    line = line.strip()
+    if line and not line.startswith("#"):
+      lines.append(line.split())
+
+  count = int(lines[0][0])
+  provinces = []
+  for name, is_sc, has_coasts, is_water in lines[1:count+1]:
+    flags = 0
+    if is_sc == "T":
+      flags |= SC
+    if has_coasts == "T":
+      flags |= COASTS
+    if is_water == "T":
+      flags |= WATER
+    provinces.append((name.upper(), flags))
+
+  edges = {}
+  name = None
+  coast = 0
+  i = count+1
+  while i < len(lines):
+    line = lines[i]
+    i += 1
+
+    if line[0] == "PROVINCE:":
+      name = line[1].upper()
+      edges.setdefault(name, {})
+      coast = 0
+      continue
+
+    assert name, "neighbours before any PROVINCE: line"
+
+    n_neighbours = int(line[0])
+    for target, army, fleet in lines[i:i+n_neighbours]:
+      key = target.upper(), coast == 1
+      flags = edges[name].get(key, 0)
+      if army == "T":
+        flags |= ARMY
+      if fleet == "T":
+        flags |= FLEET
+      edges[name][key] = flags
+    i += n_neighbours
+    coast += 1
+
+  return provinces, edges
+
+def compile_bundle(datafilesdir, hash=None):
+  """ build the bundle from the text files and return it as a string """
+
+  if hash is None:
+    hash = source_hash(datafilesdir)
+
+  provinces, edges = parse_map(os.path.join(datafilesdir, MAP))
+  coords = disp.parse_coords(os.path.join(datafilesdir, disp.COORDS))
+
+  names = [name for name, flags in provinces]
+  flags = dict(provinces)
+  extra = [name for name in coords if name not in flags]
+  extra.sort()
+  names.extend(extra)
+
+  ids = {}
+  for pid, name in enumerate(names):
+    ids[name] = pid
+
+  province_data = []
+  for name in names:
+    pflags = flags.get(name, 0)
+    xys = [0]*8
+    if name in coords:
+      pflags |= HAS_COORDS
+      xys = []
+      for xy in coords[name]:
+        xys.extend(xy)
+    province_data.append(struct.pack(PROVINCE, pflags, *xys))
+
+  offsets = [0]
+  targets = []
+  edge_flags = []
+  for name in names:
+    out = edges.get(name, {}).items()
+    out.sort()
+    for (target, secondary), flags_ in out:
+      if target not in ids:
+        continue # a neighbour MAP doesn't list; nothing can move there
+      if secondary:
+        flags_ |= SECONDARY
+      targets.append(ids[target])
+      edge_flags.append(flags_)
+    offsets.append(len(targets))
+
+  names_blob = "\n".join(names)
+  return "".join([
+      struct.pack(HEADER, MAGIC, hash, len(names), len(targets),
+                  len(names_blob)),
+      "".join(province_data),
+      names_blob,
+      struct.pack("<%dI" % len(offsets), *offsets),
+      struct.pack("<%dH" % len(targets), *targets),
+      struct.pack("<%dB" % len(edge_flags), *edge_flags)])
+
+def write_bundle(datafilesdir):
+  """ compile the bundle and save it next to the text files """
+
+  data = compile_bundle(datafilesdir)
+  fname = os.path.join(datafilesdir, BUNDLE)
+  tmp = "%s.%s.tmp" % (fname, os.getpid())
+  outf = open(tmp, "wb")
+  outf.write(data)
+  outf.close()
+  os.rename(tmp, fname)
+  return fname
+
+class MapBundle(object):
+  """ the map, read straight out of a compiled bundle
+
+  data is the bundle, either an mmap of the file or a string.  Only
+  the names are decoded up front; everything else is read from data
+  when asked for.
+
+  """
+
+  def __init__(self, data):
+    self.data = data
+
+    (magic, self.source_hash, self.n, self.n_edges,
+     names_len) = struct.unpack_from(HEADER, data, 0)
+    if magic != MAGIC:
+      raise ValueError("not a map bundle")
+
+    self.provinces_at = struct.calcsize(HEADER)
+    names_at = self.provinces_at + self.n*struct.calcsize(PROVINCE)
+    self.offsets_at = names_at + names_len
+    self.targets_at = self.offsets_at + 4*(self.n+1)
+    self.flags_at = self.targets_at + 2*self.n_edges
+
+    self.names = data[names_at:self.offsets_at].split("\n")
+    self.ids = {}
+    for pid, name in enumerate(self.names):
+      self.ids[name] = pid
+
+  def province(self, name):
+    """ the id of a province, by (any case) name """
+    return self.ids[name.upper()]
+
+  def name(self, pid):
+    return self.names[pid]
+
+  def province_flags(self, pid):
+    return struct.unpack_from(
+      "<B", self.data, self.provinces_at + pid*struct.calcsize(PROVINCE))[0]
+
+  def is_sc(self, pid):
+    return bool(self.province_flags(pid) & SC)
+
+  def is_water(self, pid):
+    return bool(self.province_flags(pid) & WATER)
+
+  def has_coasts(self, pid):
+    return bool(self.province_flags(pid) & COASTS)
+
+  def coords(self):
+    """ the same {prov-name: (info)} as disp.parse_coords """
+
+    coords = {}
+    size = struct.calcsize(PROVINCE)
+    for pid, name in enumerate(self.names):
+      fields = struct.unpack_from(PROVINCE, self.data,
+                                  self.provinces_at + pid*size)
+      if fields[0] & HAS_COORDS:
+        xys = fields[1:]
+        coords[name] = [xys[0:2], xys[2:4], xys[4:6], xys[6:8]]
+    return coords
+
+  def edges(self, pid):
+    """ [(target, flags)] for the moves out of pid """
+
+    start, stop = struct.unpack_from("<2I", self.data,
+                                     self.offsets_at + 4*pid)
+    n = stop - start
+    targets = struct.unpack_from("<%dH" % n, self.data,
+                                 self.targets_at + 2*start)
+    flags = struct.unpack_from("<%dB" % n, self.data, self.flags_at + start)
+    return zip(targets, flags)
+
+  def neighbours(self, pid, mode=None, coast=None):
+    """ provinces a unit in pid can move to
+
+    mode is "Army", "Fleet" or None for either.  coast is "Secondary"
+    for a fleet on the second coast (as in disp.draw_powers), anything
+    else for the first; it only matters to fleets.
+
+    """
+
+    want = ARMY|FLEET
+    if mode == "Army":
+      want = ARMY
+    elif mode == "Fleet":
+      want = FLEET
+
+    found = []
+    for target, flags in self.edges(pid):
+      if not flags & want:
+        continue
+      if mode == "Fleet" and bool(flags & SECONDARY) != (coast == "Secondary"):
+        continue
+      if target not in found:
+        found.append(target)
+    return found
+
+  def adjacent(self, a, b, mode=None, coast=None):
+    return b in self.neighbours(a, mode, coast)
+
+  def reachable(self, pid, mode=None, moves=1):
+    """ {province: fewest moves to get there} within moves moves
+
+    Fleets are allowed onto either coast at each step.
+
+    """
+
+    dist = {pid: 0}
+    edge = [pid]
+    for step in range(1, moves+1):
+      newedge = []
+      for p in edge:
+        for coast in [None, "Secondary"]:
+          for target in self.neighbours(p, mode, coast):
+            if target not in dist:
+              dist[target] = step
+              newedge.append(target)
+      edge = newedge
+    return dist
+
+  def convoy_path(self, src, dst, fleets=None):
+    """ shortest chain of water provinces to convoy an army src -> dst
+
+    fleets, if given, is the set of water provinces that have a fleet
+    in them to convoy with; otherwise any water province will do.
+
+    Returns [src, water, ..., dst] or None if there's no such path.
+
+    """
+
+    def usable(p):
+      return self.is_water(p) and (fleets is None or p in fleets)
+
+    back = {}
+    edge = []
+    for target in self.neighbours(src):
+      if usable(target) and target not in back:
+        back[target] = src
+        edge.append(target)
+
+    while edge:
+      newedge = []
+      for p in edge:
+        if dst in self.neighbours(p, "Fleet"):
+          path = [dst, p]
+          while path[-1] != src:
+            path.append(back[path[-1]])
+          path.reverse()
+          return path
+        for target in self.neighbours(p, "Fleet"):
+          if usable(target) and target not in back:
+            back[target] = p
+            newedge.append(target)
+      edge = newedge
+    return None
+
+def load(datafilesdir):
+  """ the map for datafilesdir, from the bundle if it's up to date
+
+  Falls back to compiling from MAP and COORDINATES when the bundle is
+  missing or stale, saving the new bundle if the directory is writable.
+
+  """
+
+  hash = source_hash(datafilesdir)
+  fname = os.path.join(datafilesdir, BUNDLE)
+  try:
+    inf = open(fname, "rb")
+    try:
+      data = mmap.mmap(inf.fileno(), 0, access=mmap.ACCESS_READ)
+    finally:
+      inf.close()
+    bundle = MapBundle(data)
+    if bundle.source_hash == hash:
+      return bundle
+  except (IOError, OSError, ValueError, struct.error):
+    pass
+
+  try:
+    write_bundle(datafilesdir)
+  except (IOError, OSError):
+    pass # read only data dir
+  return MapBundle(compile_bundle(datafilesdir, hash))
+
+if __name__ == "__main__":
+  print "Wrote %s" % write_bundle(*sys.argv[1:])
@@ -0,0 +1,282 @@
+"""
+Usage:
+  python replay.py [--format gif|apng] [--delay ms] [--colors N]
+                   datafilesdir out.gif status.txt [status.txt ...]
+  python replay.py [--format gif|apng] [--delay ms] [--colors N]
+                   --archive history.db [--view full] datafilesdir out.gif
+
+Draws the game so far as an animation, one frame per status file in
+the order given, or per turn in archive.py's database.
+
+Each turn after the first is drawn from the one before it, redrawing
+only what changed (as disp.py --prev-status does).  A frame only holds
+the rectangle that differs from the frame before, with the pixels in
+it that didn't change left transparent.  Every frame uses one palette
+of --colors (255 at most, the default; the last entry is the
+transparent one), chosen from all the frames together, so the file
+stays small however many turns there are.
+
+The format is from --format, or out's extension: GIF, or APNG (an
+animated PNG, which browsers show but most mail readers only show the
+first frame of).  --delay is how long each frame shows, 1000ms by
+default.
+
+At the end it prints the time spent drawing and encoding each frame,
+the rectangle it covers and its size in bytes.
+
+"""
+
+import sys
+import os.path
+import time
+import getopt
+import struct
+import zlib
+from cStringIO import StringIO
+import Image, ImageChops, GifImagePlugin
+
+import disp
+import gamestate
+
+# the palette index of pixels the frame before shows through
+TRANSPARENT = 255
+
+class Frame(object):
+  """ one turn of the replay: what changed and what it cost """
+
+  def __init__(self, name, box, patch, changed, draw_seconds):
+    self.name = name
+    self.box = box         # (left, top, right, bottom) of patch in the map
+    self.patch = patch     # the RGB pixels there
+    self.changed = changed # "L" mask of the pixels in patch that changed,
+                           # or None for all of them
+    self.draw_seconds = draw_seconds
+    self.encode_seconds = 0
+    self.bytes = 0
+
+def state_name(state, default):
+  season = state.options.get("Season")
+  if season:
+    return " ".join(season)
+  return default
+
+def draw_frames(datafilesdir, states):
+  """ [Frame] for each (name, GameState), each only what changed """
+
+  assets = disp.load_assets(datafilesdir)
+  backgrounds = {}
+  frames = []
+  prev_state = prev_im = None
+  for name, state in states:
+    started = time.time()
+    if prev_im is None:
+      im = disp.render(datafilesdir, assets, state, backgrounds)
+      box = (0, 0) + im.size
+      changed = None
+    else:
+      im = disp.render_incremental(datafilesdir, assets, prev_im, prev_state,
+                                   state, backgrounds)
+      diff = ImageChops.difference(im, prev_im)
+      box = diff.getbbox()
+      if box is None:
+        box = (0, 0, 1, 1) # nothing changed, but the frame still shows
+      changed = diff.crop(box).convert("L").point(lambda v: v and 255)
+    frames.append(Frame(name, box, im.crop(box), changed,
+                        time.time() - started))
+    prev_state, prev_im = state, im
+  return frames
+
+def shared_palette(frames, colors=TRANSPARENT):
+  """ a palette image with colors chosen from every frame's patch
+
+  Entries from TRANSPARENT on are copies of the first, so no pixel is
+  matched to them.
+
+  """
+
+  width = max([frame.patch.size[0] for frame in frames])
+  height = sum([frame.patch.size[1] for frame in frames])
+  montage = Image.new("RGB", (width, height))
+  y = 0
+  for frame in frames:
+    montage.paste(frame.patch, (0, y))
+    y += frame.patch.size[1]
+  palette_im = montage.convert("P", palette=Image.ADAPTIVE,
+                               colors=min(colors, TRANSPARENT))
+  palette = palette_im.getpalette()[:TRANSPARENT*3]
+  palette += palette[:3] * (256 - len(palette)//3)
+  palette_im.putpalette(palette)
+  return palette_im
+
+def frame_pixels(frame, palette_im):
+  """ the frame's patch on the shared palette, unchanged pixels clear """
+
+  pixels = frame.patch.quantize(palette=palette_im)
+  if frame.changed is not None:
+    pixels.paste(TRANSPARENT, None, ImageChops.invert(frame.changed))
+  return pixels
+
+def palette_bytes(palette_im):
+  palette = palette_im.getpalette()[:256*3]
+  palette += [0] * (256*3 - len(palette))
+  return "".join([chr(c) for c in palette])
+
+def write_gif(outf, frames, palette_im, delay):
+  """ a GIF89a that loops, each frame a patch drawn over the last """
+
+  width, height = frames[0].patch.size
+  outf.write("GIF89a")
+  # a global color table of 256 colors
+  outf.write(struct.pack("<HHBBB", width, height, 0xf7, 0, 0))
+  outf.write(palette_bytes(palette_im))
+  outf.write("\x21\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", 0) + "\x00")
+
+  for frame in frames:
+    started = time.time()
+    patch = frame_pixels(frame, palette_im)
+    # graphic control: keep the last frame under this one, then wait;
+    # and TRANSPARENT shows it through
+    flags = 0x04
+    if frame.changed is not None:
+      flags |= 0x01
+    data = "\x21\xf9\x04" + chr(flags) + struct.pack("<H", delay // 10) + \
+           chr(TRANSPARENT) + "\x00"
+    chunks = GifImagePlugin.getdata(patch, offset=frame.box[:2])
+    data += "".join(chunks)
+    del chunks[:] # PIL collects every call's data in one list
+    outf.write(data)
+    frame.bytes = len(data)
+    frame.encode_seconds = time.time() - started
+  outf.write(";")
+
+def png_chunk(kind, data):
+  return (struct.pack(">I", len(data)) + kind + data +
+          struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff))
+
+def png_chunks(im, **params):
+  """ [(kind, data)] of im saved as a PNG with params """
+
+  buf = StringIO()
+  im.save(buf, "PNG", **params)
+  png = buf.getvalue()
+  chunks = []
+  i = 8 # after the signature
+  while i < len(png):
+    length, = struct.unpack(">I", png[i:i+4])
+    chunks.append((png[i+4:i+8], png[i+8:i+8+length]))
+    i += 12 + length
+  return chunks
+
+def write_apng(outf, frames, palette_im, delay):
+  """ an animated PNG that loops, each frame a patch over the last """
+
+  outf.write("\x89PNG\r\n\x1a\n")
+  sequence = 0
+  for n, frame in enumerate(frames):
+    started = time.time()
+    chunks = png_chunks(frame_pixels(frame, palette_im), bits=8)
+    data = ""
+    if n == 0:
+      for kind, body in chunks:
+        if kind == "IHDR":
+          data += png_chunk(kind, body)
+          data += png_chunk("acTL", struct.pack(">II", len(frames), 0))
+        elif kind == "PLTE":
+          data += png_chunk(kind, body)
+          data += png_chunk("tRNS", "\xff" * TRANSPARENT + "\x00")
+    width, height = frame.patch.size
+    left, top = frame.box[:2]
+    # no disposal; the first frame replaces what was there and the rest
+    # are drawn over it, so TRANSPARENT shows it through
+    blend = 1
+    if frame.changed is None:
+      blend = 0
+    data += png_chunk("fcTL", struct.pack(">IIIIIHHBB", sequence, width,
+                                          height, left, top, delay, 1000,
+                                          0, blend))
+    sequence += 1
+    for kind, body in chunks:
+      if kind == "IDAT":
+        if n == 0:
+          data += png_chunk("IDAT", body)
+        else:
+          data += png_chunk("fdAT", struct.pack(">I", sequence) + body)
+          sequence += 1
+    outf.write(data)
+    frame.bytes = len(data)
+    frame.encode_seconds = time.time() - started
+  outf.write(png_chunk("IEND", ""))
+
+WRITERS = {"gif": write_gif, "apng": write_apng}
+
+def replay(datafilesdir, states, out_fname, format=None, delay=1000,
+           colors=TRANSPARENT):
+  """ draw states, [(name, GameState)], as an animation in out_fname
+
+  Returns the frames, with their timings and sizes.
+
+  """
+
+  if format is None:
+    format = "gif"
+    if out_fname.lower().endswith(".png"):
+      format = "apng"
+  if format not in WRITERS:
+    raise Exception("Unknown format %s (try %s)"
+                    % (format, ", ".join(sorted(WRITERS))))
+  if not states:
+    raise Exception("No turns to replay")
+
+  frames = draw_frames(datafilesdir, states)
+  palette_im = shared_palette(frames, colors)
+  outf = open(out_fname, "wb")
+  try:
+    WRITERS[format](outf, frames, palette_im, delay)
+  finally:
+    outf.close()
+  return frames
+
+def print_report(frames, out_fname):
+  print "%-24s %7s %7s %-22s %8s" % ("frame", "draw", "encode", "rectangle",
+                                     "bytes")
+  for frame in frames:
+    left, top, right, bottom = frame.box
+    print "%-24s %6.3fs %6.3fs %-22s %8d" % (
+      frame.name, frame.draw_seconds, frame.encode_seconds,
+      "%dx%d at %d,%d" % (right - left, bottom - top, left, top), frame.bytes)
+  print "Wrote %s, %d frames, %d bytes" % (out_fname, len(frames),
+                                           os.path.getsize(out_fname))
+
+def file_states(datafilesdir, fnames):
+  coords = disp.parse_coords(os.path.join(datafilesdir, disp.COORDS))
+  states = []
+  for fname in fnames:
+    state = gamestate.load(fname, coords)
+    states.append((state_name(state, fname), state))
+  return states
+
+def archive_states(db_fname, view="full"):
+  import archive # needs sqlite3, which old versions of python don't have
+  db = archive.connect(db_fname)
+  try:
+    return [(season, archive.load_state(db, season, view))
+            for season, kind, v in archive.turns(db, "status") if v == view]
+  finally:
+    db.close()
+
+if __name__ == "__main__":
+  opts, args = getopt.getopt(sys.argv[1:], "",
+                             ["format=", "delay=", "colors=", "archive=",
+                              "view="])
+  opts = dict(opts)
+  if len(args) < 2:
+    sys.exit(__doc__)
+  datafilesdir, out_fname, fnames = args[0], args[1], args[2:]
+  if "--archive" in opts:
+    states = archive_states(opts["--archive"], opts.get("--view", "full"))
+  else:
+    states = file_states(datafilesdir, fnames)
+  frames = replay(datafilesdir, states, out_fname, opts.get("--format"),
+                  int(opts.get("--delay", 1000)),
+                  int(opts.get("--colors", TRANSPARENT)))
+  print_report(frames, out_fname)
@@ -0,0 +1,410 @@
+"""
+Usage:
+  python scheduler.py [--threads N] [--poll SECONDS] [--report SECONDS]
+                      [--once] jobdir
+
+Draws and splits turns for many games in one process, so games on the
+same map share one loaded copy of its data files (the map image,
+COORDINATES, labels and icons) and its drawn backgrounds, instead of
+each disp.py or splitdisp.py run loading its own.
+
+Each job is a file in jobdir ending in .job, one "Key value" per line:
+
+  Game     stdip_12                  which game; the status file's
+                                     directory if not given
+  Kind     split                     split (as splitdisp.py) or
+                                     render (as disp.py, the default)
+  Data     ../stdip                  the datafilesdir
+  Status   2371_Spring_Moves_status.txt
+  Out      game12/                   render: the image; split: the
+                                     directory for the files (the
+                                     status file's if not given)
+  Encoding email                     as for disp.py --encoding
+  Deadline 2026-10-20 18:00          local time, or seconds since 1970
+  Priority 1                         higher goes first, 0 by default
+
+Paths are relative to jobdir.  Jobs with a deadline go first, soonest
+first, then by priority.  Among the rest the game with the fewest
+turns drawing or drawn so far goes next, so one game sending many
+turns doesn't hold up the others.  --threads (2 by default) jobs are
+drawn at once.
+
+Write each job under another name and rename it to end in .job, so
+it's never read half written; one that can't be read fails at once.
+When a job finishes its .job file is replaced by a .done file saying
+what was written and how long it took, or a .failed one with the
+error, and the name can be used again for the game's next job.  jobdir is looked at every --poll seconds (5 by default) for
+new jobs, and every --report seconds (60) a report of turns per
+minute and per game goes to stderr.  With --once the jobs already
+there are done, the report printed and it exits.
+
+"""
+
+import sys
+import os
+import os.path
+import time
+import getopt
+import traceback
+import threading
+
+import disp
+import gamestate
+import splitdisp
+import manifest
+from dispserver import DataDir
+
+JOB_EXT = ".job"
+
+KINDS = ["render", "split"]
+
+# the window the recent rate is over
+RATE_WINDOW = 60
+
+def parse_deadline(value):
+  """ seconds since 1970, from that or "YYYY-MM-DD HH:MM" local time """
+
+  try:
+    return float(value)
+  except ValueError:
+    return time.mktime(time.strptime(value, "%Y-%m-%d %H:%M"))
+
+class Job(object):
+  """ one turn of one game to draw, queued, drawing or done """
+
+  def __init__(self, game, kind, datafilesdir, status, out=None,
+               encoding=None, deadline=None, priority=0, fname=None):
+    self.game = game
+    self.kind = kind
+    self.datafilesdir = os.path.abspath(datafilesdir)
+    self.status = status
+    self.out = out
+    self.encoding = encoding
+    self.deadline = deadline
+    self.priority = priority
+    self.fname = fname # the .job file, if it came from one
+
+    self.seq = None # order submitted
+    self.queued = time.time()
+    self.started = self.finished = None
+    self.wrote = []
+    self.error = None # formatted traceback if it failed
+
+  def late(self):
+    return self.deadline is not None and self.finished > self.deadline
+
+  def write_result(self):
+    """ replace the .job file with a .done or .failed one """
+
+    base = self.fname[:-len(JOB_EXT)]
+    result = ".done"
+    if self.error:
+      result = ".failed"
+    outf = open(base + result, "w")
+    outf.write("Game %s\n" % self.game)
+    outf.write("Kind %s\n" % self.kind)
+    outf.write("Waited %.3f\n" % (self.started - self.queued))
+    outf.write("Seconds %.3f\n" % (self.finished - self.started))
+    if self.deadline is not None:
+      outf.write("Late %s\n" % ["no", "yes"][self.late()])
+    for fname in self.wrote:
+      outf.write("Wrote %s\n" % fname)
+    if self.error:
+      outf.write("\n" + self.error)
+    outf.close()
+    os.remove(self.fname)
+
+def read_job(fname):
+  """ the Job a .job file describes """
+
+  fields = {}
+  for line in open(fname):
+    line = line.strip()
+    if not line or line.startswith("#"):
+      continue
+    words = line.split(None, 1)
+    fields[words[0]] = (words[1:] or [""])[0]
+
+  for key in ["Data", "Status"]:
+    if key not in fields:
+      raise Exception("%s has no %s line" % (fname, key))
+  kind = fields.get("Kind", "render")
+  if kind not in KINDS:
+    raise Exception("%s: unknown Kind %s (try %s)"
+                    % (fname, kind, ", ".join(KINDS)))
+  if kind == "render" and "Out" not in fields:
+    raise Exception("%s has no Out line" % fname)
+  if "Encoding" in fields:
+    disp.parse_encoding(fields["Encoding"])
+
+  here = os.path.dirname(os.path.abspath(fname))
+  def path(key, default=None):
+    if key not in fields:
+      return default
+    return os.path.normpath(os.path.join(here, fields[key]))
+
+  status = path("Status")
+  deadline = None
+  if "Deadline" in fields:
+    deadline = parse_deadline(fields["Deadline"])
+  return Job(fields.get("Game", os.path.basename(os.path.dirname(status))),
+             kind, path("Data"), status,
+             path("Out", os.path.dirname(status)), fields.get("Encoding"),
+             deadline, int(fields.get("Priority", 0)), fname)
+
+class Scheduler(object):
+  """ jobs waiting, the threads that draw them and what they've done
+
+  Each datafilesdir's assets and backgrounds are loaded once, by the
+  first job that needs them, and shared by every game using it.
+
+  """
+
+  def __init__(self, threads=2):
+    self.cond = threading.Condition()
+    self.pending = []
+    self.in_flight = {} # game -> jobs drawing
+    self.served = {}    # game -> jobs started
+    self.finished = []  # the finished jobs, in the order they finished
+    self.datadirs = {}  # datafilesdir -> DataDir
+    self.job_files = set() # .job files submitted and not yet finished
+    self.submitted = 0
+    self.started = time.time()
+    self.stopping = False
+
+    self.threads = []
+    for i in range(threads):
+      t = threading.Thread(target=self.work)
+      t.setDaemon(True)
+      t.start()
+      self.threads.append(t)
+
+  def datadir(self, datafilesdir):
+    self.cond.acquire()
+    try:
+      if datafilesdir not in self.datadirs:
+        self.datadirs[datafilesdir] = DataDir(datafilesdir)
+      return self.datadirs[datafilesdir]
+    finally:
+      self.cond.release()
+
+  def submit(self, job):
+    self.cond.acquire()
+    try:
+      job.seq = self.submitted
+      self.submitted += 1
+      if job.fname:
+        self.job_files.add(job.fname)
+      self.pending.append(job)
+      self.cond.notify()
+    finally:
+      self.cond.release()
+
+  def order(self, job):
+    """ the sort key of a pending job, least first; needs the lock """
+
+    return (job.deadline is None, job.deadline, -job.priority,
+            self.in_flight.get(job.game, 0), self.served.get(job.game, 0),
+            job.seq)
+
+  def next_job(self):
+    """ take the job to do next, waiting for one; None when stopping """
+
+    self.cond.acquire()
+    try:
+      while not self.pending and not self.stopping:
+        self.cond.wait()
+      if not self.pending:
+        return None
+      job = min(self.pending, key=self.order)
+      self.pending.remove(job)
+      self.in_flight[job.game] = self.in_flight.get(job.game, 0) + 1
+      self.served[job.game] = self.served.get(job.game, 0) + 1
+      return job
+    finally:
+      self.cond.release()
+
+  def work(self):
+    while True:
+      job = self.next_job()
+      if job is None:
+        return
+      job.started = time.time()
+      try:
+        if job.kind == "split":
+          self.split(job)
+        else:
+          self.render(job)
+      except Exception:
+        job.error = traceback.format_exc()
+      job.finished = time.time()
+
+      written = False
+      if job.fname:
+        try:
+          job.write_result()
+          written = True
+        except (IOError, OSError):
+          traceback.print_exc() # the .job file stays, so don't read it again
+
+      self.cond.acquire()
+      try:
+        if written:
+          self.job_files.discard(job.fname)
+        self.in_flight[job.game] -= 1
+        self.finished.append(job)
+        self.cond.notifyAll()
+      finally:
+        self.cond.release()
+
+  def draw(self, job, status_fname, img_out):
+    assets, backgrounds = self.datadir(job.datafilesdir).get()
+    state = gamestate.load(status_fname, assets[0])
+    im = disp.render(job.datafilesdir, assets, state, backgrounds)
+    disp.save_image(im, img_out, job.encoding)
+    job.wrote.append(img_out)
+
+  def render(self, job):
+    self.draw(job, job.status, job.out)
+
+  def split(self, job):
+    """ splitdisp.start, into job.out """
+
+    if not os.path.isdir(job.out):
+      os.makedirs(job.out)
+    season, kind, views = splitdisp.split(job.status, job.out)
+    artifacts = []
+    for race, fname_text in views:
+      job.wrote.append(fname_text)
+      artifacts.append(manifest.artifact(
+        season, kind, race, os.path.relpath(fname_text, job.out), job.out))
+      if kind == "status":
+        fname_png = splitdisp.image_fname(fname_text, job.encoding)
+        self.draw(job, fname_text, fname_png)
+        artifacts.append(manifest.artifact(
+          season, kind, race, os.path.relpath(fname_png, job.out), job.out))
+    job.wrote.append(manifest.update(season, artifacts, job.out))
+
+  def submitted_file(self, fname):
+    """ is the .job file fname queued or drawing """
+
+    self.cond.acquire()
+    try:
+      return fname in self.job_files
+    finally:
+      self.cond.release()
+
+  def drain(self):
+    """ wait until every job submitted so far is done """
+
+    self.cond.acquire()
+    try:
+      while self.pending or [n for n in self.in_flight.values() if n]:
+        self.cond.wait(1)
+    finally:
+      self.cond.release()
+
+  def stop(self):
+    """ let the threads finish what they're drawing, then end them """
+
+    self.cond.acquire()
+    self.stopping = True
+    del self.pending[:]
+    self.cond.notifyAll()
+    self.cond.release()
+    for t in self.threads:
+      t.join()
+
+  def report(self):
+    """ {"games": {game: {...}}, ...}, what's been done so far """
+
+    now = time.time()
+    self.cond.acquire()
+    try:
+      finished = self.finished[:]
+      pending = len(self.pending)
+      in_flight = sum(self.in_flight.values())
+    finally:
+      self.cond.release()
+
+    games = {}
+    for job in finished:
+      game = games.setdefault(job.game, {"turns": 0, "failed": 0, "late": 0,
+                                         "seconds": 0.0, "waited": 0.0})
+      game["turns"] += 1
+      game["failed"] += bool(job.error)
+      game["late"] += job.late()
+      game["seconds"] += job.finished - job.started
+      game["waited"] += job.started - job.queued
+
+    minutes = (now - self.started) / 60
+    if finished:
+      minutes = (finished[-1].finished - self.started) / 60
+    recent = [job for job in finished if job.finished > now - RATE_WINDOW]
+    return {"games": games,
+            "turns": len(finished),
+            "minutes": minutes,
+            "turns_per_minute": len(finished) / max(minutes, 1e-9),
+            "recent_turns_per_minute": len(recent) * 60.0 / RATE_WINDOW,
+            "pending": pending,
+            "in_flight": in_flight,
+            "threads": len(self.threads),
+            "datafilesdirs": len(self.datadirs)}
+
+def print_report(report, outf=sys.stderr):
+  outf.write("%-20s %6s %6s %5s %9s %9s\n" % ("game", "turns", "failed",
+                                               "late", "mean", "waited"))
+  for name, game in sorted(report["games"].items()):
+    outf.write("%-20s %6d %6d %5d %8.2fs %8.2fs\n" % (
+      name, game["turns"], game["failed"], game["late"],
+      game["seconds"] / game["turns"], game["waited"] / game["turns"]))
+  outf.write("%d turns in %.2f minutes: %.1f turns per minute, %.1f in the"
+             " last %ds\n" % (report["turns"], report["minutes"],
+                              report["turns_per_minute"],
+                              report["recent_turns_per_minute"], RATE_WINDOW))
+  outf.write("%d waiting, %d drawing, %d threads, %d data dirs loaded\n" % (
+    report["pending"], report["in_flight"], report["threads"],
+    report["datafilesdirs"]))
+
+def scan(scheduler, jobdir):
+  """ submit the .job files in jobdir not already submitted """
+
+  for name in sorted(os.listdir(jobdir)):
+    fname = os.path.join(jobdir, name)
+    if not name.endswith(JOB_EXT) or scheduler.submitted_file(fname):
+      continue
+    try:
+      job = read_job(fname)
+    except Exception:
+      outf = open(fname[:-len(JOB_EXT)] + ".failed", "w")
+      outf.write(traceback.format_exc())
+      outf.close()
+      os.remove(fname)
+      continue
+    scheduler.submit(job)
+
+def start(jobdir, threads=2, poll=5, report_every=60, once=False):
+  scheduler = Scheduler(threads)
+  last_report = time.time()
+  try:
+    scan(scheduler, jobdir)
+    while not once:
+      time.sleep(poll)
+      scan(scheduler, jobdir)
+      if time.time() - last_report >= report_every:
+        print_report(scheduler.report())
+        last_report = time.time()
+    scheduler.drain()
+  finally:
+    scheduler.stop()
+    print_report(scheduler.report())
+  return scheduler
+
+if __name__ == "__main__":
+  opts, args = getopt.getopt(sys.argv[1:], "",
+                             ["threads=", "poll=", "report=", "once"])
+  opts = dict(opts)
+  if len(args) != 1:
+    sys.exit(__doc__)
+  start(args[0], int(opts.get("--threads", 2)), float(opts.get("--poll", 5)),
+        float(opts.get("--report", 60)), "--once" in opts)
@@ -3,7 +3,8 @@
 Send out status, orders, pictures etc
 
 Usage:
-  python sendout.py emailfile when
+  python sendout.py [--smtp host[:port]] [--user name] [--starttls]
+                    [--connections N] [--retries N] emailfile when
 
 Example:
   python sendout.py stdip/player_emails.txt 2371_Spring_Retreats
@@ -12,10 +13,31 @@ player_emails should look like:
   Cardassian foo@example.com
   public bar@example.com
 
+Without --smtp mail goes through /usr/sbin/sendmail.  With it, each of
+--connections (2 by default) threads opens one connection to the
+server, logs in if --user is given (the password comes from the
+SENDOUT_SMTP_PASSWORD environment variable) and sends its share of
+the messages over it.  Each message is tried up to --retries more
+times (3 by default) with growing waits in between, unless the server
+refuses it outright.  A server that doesn't answer in 60 seconds
+counts as a failed try, and one that refuses the login fails every
+message without logging in again.  At the end a report says what happened to each
+message; the exit status is 1 if any failed.
+
+To try it without sending real mail, run a fake server that prints
+what it gets and point sendout at it:
+
+  python -m smtpd -n -c DebuggingServer localhost:1025
+  python sendout.py --smtp localhost:1025 emailfile when
+
 """
 
 import os
 import sys
+import time
+import getopt
+import socket
+import threading
 import smtplib
 from email.MIMEMultipart import MIMEMultipart
 from email.MIMEBase import MIMEBase
@@ -23,8 +45,22 @@ from email.MIMEText import MIMEText
 from email.Utils import COMMASPACE, formatdate
 from email import Encoders
 
+import manifest
+
 use_smtp = False
 
+# used when use_smtp is set
+smtp_server = "localhost"
+smtp_port = 25
+smtp_user = None
+smtp_password = None
+smtp_starttls = False
+smtp_connections = 2 # connections, and so messages sent at once
+smtp_timeout = 60    # seconds to wait on the server before giving up
+
+retries = 3         # further tries of a message after the first fails
+retry_backoff = 1.0 # seconds before the first retry, doubling each time
+
 def parse_emails(fname):
   emails = {}
   for line in open(fname):
@@ -32,6 +68,31 @@ def parse_emails(fname):
     emails[race] = addr
   return emails
 
+def find_artifacts(when):
+  """ the files for a season, as manifest entries
+
+  From splitdisp's manifest if there is one, otherwise by looking for
+  files named like 2371_Spring_Retreats_status_Klingon.png.  Files
+  found that way have no hash.
+
+  """
+
+  artifacts = manifest.read(when)
+  if artifacts is not None:
+    return artifacts
+
+  artifacts = []
+  for a_file in os.listdir("."):
+    if a_file.startswith(when + "_"):
+      base, ext = os.path.splitext(a_file)
+      parts = base[len(when)+1:].split("_")
+      if len(parts) != 2:
+        continue # not one of splitdisp's
+      kind, race = parts
+      artifacts.append({"season": when, "kind": kind, "race": race,
+                        "path": a_file, "hash": None})
+  return artifacts
+
 def start(emailfile, when):
 
   year, season, type = when.split("_")
@@ -39,32 +100,89 @@ def start(emailfile, when):
   emails = parse_emails(emailfile)
 
   files_for_players = {} # race -> [files]
+  hashes = {} # file -> hash, where the manifest gave one
 
-  for a_file in os.listdir("."):
-    if a_file.startswith(when):
-      base, ext = a_file.split(".")
-      ignore, ignore, ignore, ignore, race = base.split("_")
+  for artifact in find_artifacts(when):
+    race = artifact["race"]
+    if race not in files_for_players:
+      files_for_players[race] = []
+    files_for_players[race].append(artifact["path"])
+    if artifact.get("hash"):
+      hashes[artifact["path"]] = (artifact["hash"], artifact.get("size"))
 
-      if race not in files_for_players:
-        files_for_players[race] = []
-      files_for_players[race].append(a_file)
+  # files with the same contents (the same image sent to several
+  # races, say) are only read and encoded once
+  parts = PartCache(hashes)
 
+  messages = []
   for race, files in files_for_players.items():
     if race not in emails:
       print "Skipping", race, "(no email addr)"
       continue
-    
-    send_mail(send_from=emails["gm"],
-              send_to=[emails[race]],
-              subject="Resolutions %s %s %s %s Edition" % (season, type, year, race),
-              text="Resolutions attached as text and images\n",
-              files=files)
-
-def send_mail(send_from, send_to, subject, text, files=[], server="localhost"):
-  """ modified from http://snippets.dzone.com/posts/show/2038 """
 
-  print "Sending %s to %s" % (files, send_to)
-  
+    files.sort()
+    print "Sending %s to %s" % (files, emails[race])
+    msg = build_message(send_from=emails["gm"],
+                        send_to=[emails[race]],
+                        subject="Resolutions %s %s %s %s Edition" % (season, type, year, race),
+                        text="Resolutions attached as text and images\n",
+                        files=files, parts=parts)
+    messages.append((race, emails["gm"], [emails[race]], msg.as_string()))
+
+  print "Encoded %d attachments for %d files" % (parts.encoded, parts.files)
+
+  report = deliver(messages)
+  print_report(report)
+  return report
+
+class PartCache(object):
+  """ base64 encoded file contents, shared between messages by hash
+
+  hashes is {fname: (hash, size)} for files whose hash is already
+  known, as from splitdisp's manifest; it's trusted as long as the
+  size still matches.  Other files are hashed when first used.
+
+  """
+
+  def __init__(self, hashes=None):
+    self.hashes = hashes or {}
+    self.by_path = {} # fname -> hash
+    self.by_hash = {} # hash -> encoded contents
+    self.files = 0    # distinct files asked for
+    self.encoded = 0  # distinct contents encoded
+
+  def content_hash(self, fname):
+    if fname not in self.by_path:
+      self.files += 1
+      known = self.hashes.get(fname)
+      if known and known[1] == os.path.getsize(fname):
+        self.by_path[fname] = known[0]
+      else:
+        self.by_path[fname] = manifest.file_hash(fname)
+    return self.by_path[fname]
+
+  def part(self, fname):
+    """ a new attachment part for fname, encoded at most once per content """
+
+    h = self.content_hash(fname)
+    part = MIMEBase('application', "octet-stream")
+    if h not in self.by_hash:
+      part.set_payload( open(fname,"rb").read() )
+      Encoders.encode_base64(part)
+      self.by_hash[h] = part.get_payload()
+      self.encoded += 1
+    else:
+      part.set_payload(self.by_hash[h])
+      part['Content-Transfer-Encoding'] = 'base64'
+    return part
+
+def build_message(send_from, send_to, subject, text, files=[], parts=None):
+  """ the MIME message send_mail sends
+
+  parts, a PartCache, lets several messages share encoded attachments
+
+  """
+
   assert type(send_to)==list
   assert type(files)==list
 
@@ -76,26 +194,227 @@ def send_mail(send_from, send_to, subject, text, files=[], server="localhost"):
 
   msg.attach( MIMEText(text) )
 
+  if parts is None:
+    parts = PartCache()
+
   for f in files:
-    part = MIMEBase('application', "octet-stream")
-    part.set_payload( open(f,"rb").read() )
-    Encoders.encode_base64(part)
+    part = parts.part(f)
     part.add_header('Content-Disposition', 'attachment; filename="%s"' % os.path.basename(f))
     msg.attach(part)
 
-  if use_smtp:
-    smtp = smtplib.SMTP(server)
-    smtp.sendmail(send_from, send_to, msg.as_string())
-    smtp.close()
-  else:
-    sendmail_location = "/usr/sbin/sendmail" # sendmail location
-    p = os.popen("%s -t" % sendmail_location, "w")
-    p.write(msg.as_string())
-    
+  return msg
+
+def send_mail(send_from, send_to, subject, text, files=[], server=None):
+  """ modified from http://snippets.dzone.com/posts/show/2038 """
+
+  print "Sending %s to %s" % (files, send_to)
+
+  msg = build_message(send_from, send_to, subject, text, files)
+
+  transport = new_transport(server)
+  try:
+    transport.send(send_from, send_to, msg.as_string())
+  finally:
+    transport.close()
+
+class Permanent(Exception):
+  """ a failure that trying again won't fix """
+
+class SendmailTransport(object):
+  """ hands each message to the local sendmail """
+
+  sendmail_location = "/usr/sbin/sendmail" # sendmail location
+
+  def send(self, send_from, send_to, msg_string):
+    p = os.popen("%s -t" % self.sendmail_location, "w")
+    p.write(msg_string)
+
     status = p.close()
     if status:
        raise Exception("Sendmail failed with status %s" % status)
 
+  def close(self):
+    pass
+
+class SMTPTransport(object):
+  """ one SMTP connection, opened on first use and then kept
+
+  If the server drops it between messages it's opened again.  If the
+  server refuses the connection or the login outright it isn't tried
+  again: every message sent afterwards fails the same way, so a bad
+  password doesn't log in over and over and get the account locked.
+
+  """
+
+  def __init__(self, server=None, port=None):
+    self.server = server or smtp_server
+    self.port = port or smtp_port
+    self.smtp = None
+    self.refused = None # why the server refused us, if it did
+
+  def connect(self):
+    if self.refused:
+      raise Permanent(self.refused)
+    smtp = smtplib.SMTP(timeout=smtp_timeout)
+    try:
+      code, msg = smtp.connect(self.server, self.port)
+      if code != 220:
+        raise smtplib.SMTPConnectError(code, msg)
+      if smtp_starttls:
+        smtp.ehlo()
+        smtp.starttls()
+        smtp.ehlo()
+      if smtp_user:
+        smtp.login(smtp_user, smtp_password)
+    except smtplib.SMTPResponseException, e:
+      smtp.close()
+      if e.smtp_code >= 500:
+        self.refused = "%s %s" % (e.smtp_code, e.smtp_error)
+        raise Permanent(self.refused)
+      raise
+    except (smtplib.SMTPException, socket.error):
+      smtp.close()
+      raise
+    self.smtp = smtp
+
+  def send(self, send_from, send_to, msg_string):
+    if self.smtp is None:
+      self.connect()
+    try:
+      refused = self.smtp.sendmail(send_from, send_to, msg_string)
+    except smtplib.SMTPRecipientsRefused, e:
+      raise Permanent("Recipients refused: %s" % e.recipients)
+    except smtplib.SMTPResponseException, e:
+      if e.smtp_code >= 500:
+        raise Permanent("%s %s" % (e.smtp_code, e.smtp_error))
+      raise # smtplib has reset the connection, so we can keep it
+    except (smtplib.SMTPException, socket.error):
+      self.close() # start again with a new connection
+      raise
+    if refused:
+      raise Permanent("Recipients refused: %s" % refused)
+
+  def close(self):
+    if self.smtp is not None:
+      try:
+        self.smtp.quit()
+      except (smtplib.SMTPException, socket.error):
+        pass
+      self.smtp = None
+
+def new_transport(server=None):
+  if use_smtp:
+    return SMTPTransport(server)
+  return SendmailTransport()
+
+def deliver(messages, connections=None, transport_factory=new_transport):
+  """ send messages, several at a time, retrying the ones that fail
+
+  messages is a list of (name, send_from, send_to, msg_string), name
+  being anything to know the message by in the report.  Each of
+  connections threads (smtp_connections if not given; sendmail is
+  always one at a time) makes one transport and sends messages over
+  it until there are none left.
+
+  Returns the report, one (name, send_to, error, tries, seconds) per
+  message in the order given, error being None if it was sent.
+
+  """
+
+  if connections is None:
+    connections = smtp_connections
+  if transport_factory is new_transport and not use_smtp:
+    connections = 1 # sendmail queues them itself
+  connections = max(1, min(connections, len(messages)))
+
+  todo = list(enumerate(messages))
+  todo.reverse()
+  report = [None] * len(messages)
+  lock = threading.Lock()
+
+  def work():
+    transport = transport_factory()
+    try:
+      while True:
+        lock.acquire()
+        try:
+          if not todo:
+            return
+          i, (name, send_from, send_to, msg_string) = todo.pop()
+        finally:
+          lock.release()
+        report[i] = send_with_retries(transport, name, send_from, send_to,
+                                      msg_string)
+    finally:
+      transport.close()
+
+  threads = []
+  for n in range(connections):
+    t = threading.Thread(target=work)
+    t.start()
+    threads.append(t)
+  for t in threads:
+    t.join()
+  return report
+
+def send_with_retries(transport, name, send_from, send_to, msg_string):
+  """ one line of deliver's report """
+
+  started = time.time()
+  error = None
+  tries = 0
+  while tries <= retries:
+    if tries:
+      time.sleep(retry_backoff * 2**(tries-1))
+    tries += 1
+    try:
+      transport.send(send_from, send_to, msg_string)
+      return name, send_to, None, tries, time.time() - started
+    except Permanent, e:
+      return name, send_to, str(e), tries, time.time() - started
+    except Exception, e:
+      error = "%s: %s" % (e.__class__.__name__, e)
+  return name, send_to, error, tries, time.time() - started
+
+def print_report(report):
+  print
+  print "Delivery report:"
+  for name, send_to, error, tries, seconds in report:
+    status = "sent"
+    if error:
+      status = "FAILED (%s)" % error
+    print "  %-12s %-30s %s, tries: %d, %.1fs" % (
+      name, ", ".join(send_to), status, tries, seconds)
+  failed = len([line for line in report if line[2]])
+  print "%d sent, %d failed" % (len(report) - failed, failed)
+
+
+# the command line options configure takes
+OPTIONS = ["smtp=", "user=", "starttls", "connections=", "retries="]
+
+def configure(opts):
+  """ set the module's settings from a dict of OPTIONS, as from getopt """
+
+  global use_smtp, smtp_server, smtp_port, smtp_user, smtp_password
+  global smtp_starttls, smtp_connections, retries
+
+  if "--smtp" in opts:
+    use_smtp = True
+    smtp_server = opts["--smtp"]
+    if ":" in smtp_server:
+      smtp_server, smtp_port = smtp_server.split(":")
+      smtp_port = int(smtp_port)
+  if "--user" in opts:
+    smtp_user = opts["--user"]
+    smtp_password = os.environ.get("SENDOUT_SMTP_PASSWORD")
+  smtp_starttls = "--starttls" in opts
+  smtp_connections = int(opts.get("--connections", smtp_connections))
+  retries = int(opts.get("--retries", retries))
 
 if __name__ == "__main__":
-  start(*sys.argv[1:])
+  opts, args = getopt.getopt(sys.argv[1:], "", OPTIONS)
+  configure(dict(opts))
+
+  report = start(*args)
+  if [line for line in report if line[2]]:
+    sys.exit(1)
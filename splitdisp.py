@@ -1,20 +1,30 @@
 """
-usage: python splitdisp.py datafiledir statusfile.txt
+usage: python splitdisp.py [--jobs N] [--encoding SPEC] [--tiles DIR]
+                           datafiledir statusfile.txt
        python splitdisp.py datafiledir ordersfile.txt
 
+  --jobs N         render the images in N processes
+  --encoding SPEC  how to encode the images, as for disp.py; email
+                   makes them much smaller to send
+  --tiles DIR      also cut each image into tiles for a web viewer, in
+                   DIR/<image name>/ (see tiles.py)
+
 
 """
 
 import sys
+import os.path
 import re
+import getopt
 import disp
+import gamestate
+import manifest
 from fileinput import input
 
 
 COUNTRIES = ["England", "France", "Germany", "Turkey",
              "Italy", "Russia", "Austria"]
-RACES = ["Federation", "Klingon", "Ferengi", "Romulan",
-         "Cardassian", "Dominion", "Borg"]
+RACES = gamestate.RACES
 
 def remove_empty_categories(s):
   """if a line ends with colon, and the next line does to, skip the first """
@@ -34,25 +44,41 @@ def remove_empty_categories(s):
   # lose anything left in held
    
 
-def start(datafiledir, fname_in):
-  outfname="status"
-  if "orders" in fname_in:
-    outfname="orders"
-  else:
-    assert "status" in fname_in
+# the views that aren't races, as bits after the races'
+FULL = 1 << len(RACES)   # sees everything
+PUBLIC = FULL << 1       # sees only what everyone does
+EVERYONE = -1            # the mask of a line everyone sees
 
-  inf = open(fname_in)
+# the views that see which units are infiltrated
+SEE_INFILTRATED = ["Dominion", "full"]
+
+def view_bit(view):
+  if view == "full":
+    return FULL
+  if view == "public":
+    return PUBLIC
+  return gamestate.race_mask([view])
+
+def visibility(inf, outfname="status"):
+  """ read a status or orders file once, noting who sees each line
+
+  Returns (season, lines, views).  lines is [(mask, text, plain)]:
+  mask has the view_bit of each view that sees the line, text is the
+  line as the views in SEE_INFILTRATED see it and plain as the others
+  do, without "Infiltrated".  views is {view: index of the first line
+  it's needed for}.  A view only gets the lines before that everyone
+  sees, as the public view does.
+
+  A cloaked unit is seen by the Romulans, the Dominion too if it's
+  infiltrated, and the races it Knows(...), who don't see that they
+  do.  Everything else is public.
+
+  """
 
-  country,race = None,None
-  
   season = ""
-  
-  outs = {"public": [], "full":[]}
-  
-  def new_race(r):
-    if r not in outs:
-      outs[r] = outs["public"][:]
-  
+  lines = []
+  views = {"public": 0, "full": 0}
+
   for line in inf:
     if line.strip().startswith("Season "):
       ignore, month, type, year = line.strip().split()
@@ -60,69 +86,140 @@ def start(datafiledir, fname_in):
 
       if type == "Retreats" and outfname == "orders":
         print "Remember to infiltrate someone for the dominion"
-  
+
     if ":" in line and "(" in line and ")" in line:
       country, race = line.strip().split()
       race = race.replace("(","").replace(")","").replace(":","")
-  
+
       assert country in COUNTRIES, country
       assert race in RACES, race
-    
-    sendto=set() # all if left blank
-    infiltrated = "Infiltrated" in line
-    cloaked = "Cloaked" in line
-    
-    if cloaked:
-      new_race("Romulan")
-      sendto.add("Romulan") # by explicitly writing romulan we remove
-                            # other powers from the recieve
-    if infiltrated:
-      new_race("Dominion")
-      if cloaked:
-        sendto.add("Dominion")
-  
-    if sendto: # restricted
-
-      # interpret the Knows(...) attributes
-      for attr in line.split():
-        if attr.startswith("Knows("):
-          attr = attr.replace("Knows(","").replace(")","")
-          for r in attr.split(","):
-            assert r in RACES, r
-            new_race(r)
-            sendto.add(r)
-
-          # info about who knows what is also restricted
-          line = re.sub(r" Knows\(.*\)","",line)
-          
-      sendto.add("full") # everything goes to full
-    else: # public
-      sendto = outs # all
-  
-    for r in sendto:
-      l = line
-      if r not in ["Dominion", "full"]: # only the dominion and the
-                                        # full set include infiltrations
-        l = l.replace(" Infiltrated", "")
-      outs[r].append(l)
-    
-  for race, out in outs.items():
-    if race != "full":
-       continue
-
-    fname_base="%s_%s_%s" % (season,outfname,race)
-    fname_text=fname_base+".txt"
-    fname_png=fname_base+".png"
 
+    flags, dislodged_from, assimilated, knows, extra = \
+        gamestate.parse_attrs(line.split())
+
+    mask = EVERYONE
+    seen_by = []
+    if flags & gamestate.CLOAKED:
+      seen_by.append("Romulan")
+    if flags & gamestate.INFILTRATED:
+      views.setdefault("Dominion", len(lines))
+      if seen_by:
+        seen_by.append("Dominion")
+    if seen_by: # restricted
+      for r in gamestate.mask_races(knows):
+        assert r in RACES, r
+        seen_by.append(r)
+      for r in seen_by:
+        views.setdefault(r, len(lines))
+      mask = FULL | gamestate.race_mask(seen_by)
+
+      # info about who knows what is also restricted
+      if " Knows(" in line:
+        line = re.sub(r" Knows\(.*\)","",line)
+
+    lines.append((mask, line, line.replace(" Infiltrated", "")))
+
+  return season, lines, views
+
+def view_lines(lines, views, view):
+  """ the lines of one view, from visibility """
+
+  bit = view_bit(view)
+  since = views[view]
+  sees_infiltrated = view in SEE_INFILTRATED
+  for i, (mask, text, plain) in enumerate(lines):
+    if i < since:
+      if mask == EVERYONE:
+        yield plain
+    elif mask & bit:
+      if sees_infiltrated:
+        yield text
+      else:
+        yield plain
+
+def split(fname_in, directory="."):
+  """ write each race's view of fname_in to its own file in directory
+
+  Returns (season, kind, [(race, fname_text)]), kind being "status" or
+  "orders" after fname_in's name.  The file is read once; each view is
+  written straight from that.
+
+  """
+
+  outfname="status"
+  if "orders" in fname_in:
+    outfname="orders"
+  else:
+    assert "status" in fname_in
+
+  inf = open(fname_in)
+  try:
+    season, lines, views = visibility(inf, outfname)
+  finally:
+    inf.close()
+
+  texts = []
+  for race in views:
+    fname_text=os.path.normpath(os.path.join(
+      directory, "%s_%s_%s.txt" % (season,outfname,race)))
     textf=open(fname_text, "w")
-    textf.writelines(remove_empty_categories(out))
+    textf.writelines(remove_empty_categories(view_lines(lines, views, race)))
     print "Wrote %s" % fname_text
     textf.close()
+    texts.append((race, fname_text))
+  return season, outfname, texts
+
+def image_fname(fname_text, encoding=None):
+  """ the image splitdisp draws of a status view """
+  return (fname_text[:-len(".txt")] +
+          (disp.encoding_extension(encoding) or ".png"))
+
+def start(datafiledir, fname_in, processes=1):
+  season, outfname, texts = split(fname_in)
+
+  images = [] # [(fname_text, fname_png)]
+  races = {} # fname_png -> race
+  artifacts = [] # for the manifest
+  for race, fname_text in texts:
+    artifacts.append(manifest.artifact(season, outfname, race, fname_text))
 
     if outfname == "status":
-      disp.start(datafiledir, fname_text, fname_png)
+      fname_png = image_fname(fname_text)
+      images.append((fname_text, fname_png))
+      races[fname_png] = race
+
+  # all the views are of the same board, so render them together;
+  # orders files have nothing to draw, so don't load the map for them
+  failed = []
+  results = []
+  if images:
+    results = disp.start_batch(datafiledir, images, processes)
+  for fname_png, error in results:
+    if error:
+      print "Failed %s (%s):" % (fname_png, races[fname_png])
+      print error
+      failed.append(races[fname_png])
+    else:
       print "Wrote %s" % fname_png
+      artifacts.append(manifest.artifact(season, outfname, races[fname_png],
+                                         fname_png))
+
+  print "Wrote %s" % manifest.update(season, artifacts)
+
+  if failed:
+    raise Exception("Could not render %s" % ", ".join(failed))
   
 if __name__ == "__main__":
-  start(*sys.argv[1:])
+  opts, args = getopt.getopt(sys.argv[1:], "j:", ["jobs=", "encoding=",
+                                                     "tiles="])
+  processes = 1
+  for opt, val in opts:
+    if opt in ("-j", "--jobs"):
+      processes = int(val)
+    elif opt == "--encoding":
+      disp.parse_encoding(val) # complain before splitting anything
+      disp.encoding = val
+    elif opt == "--tiles":
+      disp.tiles_dir = os.path.join(val, "%s")
+  start(*args, **{"processes": processes})
   
@@ -0,0 +1,328 @@
+"""
+Usage:
+  $ python svgdisp.py [--href URL] datafilesdir statusfile map.svg
+
+Draws the same map as disp.py, as SVG instead of pixels.  The base
+map and each icon are linked once, not copied in, and units are placed
+just where disp puts them.  Supply center ownership is filled with the
+outlines of the same regions disp's flood fill colors, and the
+wormhole is a curve, so a turn is a small text file that a browser
+draws at any size.  disp.py draws SVG too when the image it's asked
+for ends in .svg.
+
+The links are relative to map.svg, so it shows as long as the data
+files stay where they are.  --href puts URL in front of their names
+in the data dir instead ("IMAGE_L.png", "icons/...") for putting the
+map on a web site.
+
+The outlines are traced from disp's province labels the first time
+and kept in datafilesdir/PROVINCE_OUTLINES.
+
+E-mail readers mostly can't show SVG with linked images, so use
+disp.py's PNGs for mail.
+
+"""
+
+import sys
+import os
+import os.path
+import getopt
+from xml.sax.saxutils import escape, quoteattr
+import Image
+
+import disp
+import gamestate
+
+OUTLINES = "PROVINCE_OUTLINES"
+
+def trace_outlines(label_im):
+  """ {label: SVG path data} of the edges of each labeled region
+
+  The paths follow pixel edges, so filled with the even-odd rule they
+  cover exactly the region's pixels, holes and all.
+
+  """
+
+  width, height = label_im.size
+  data = list(label_im.getdata())
+
+  # directed edges between pixel corners, clockwise around each region
+  edges = {} # label -> {corner: [next corners]}
+  for y in range(height):
+    row = y*width
+    for x in range(width):
+      label = data[row+x]
+      if not label:
+        continue
+      starts = edges.setdefault(label, {})
+      if y == 0 or data[row-width+x] != label:
+        starts.setdefault((x, y), []).append((x+1, y))
+      if x == width-1 or data[row+x+1] != label:
+        starts.setdefault((x+1, y), []).append((x+1, y+1))
+      if y == height-1 or data[row+width+x] != label:
+        starts.setdefault((x+1, y+1), []).append((x, y+1))
+      if x == 0 or data[row+x-1] != label:
+        starts.setdefault((x, y+1), []).append((x, y))
+
+  outlines = {}
+  for label, starts in edges.items():
+    loops = []
+    while starts:
+      start = starts.iterkeys().next()
+      corners = [start]
+      corner = start
+      while True:
+        following = starts[corner]
+        next_corner = following.pop()
+        if not following:
+          del starts[corner]
+        if next_corner == start:
+          break
+        corners.append(next_corner)
+        corner = next_corner
+      loops.append(loop_path(corners))
+    outlines[label] = "".join(loops)
+  return outlines
+
+def loop_path(corners):
+  """ path data for a closed loop of horizontal and vertical steps """
+
+  # only the corners where it turns
+  turns = []
+  for i in range(len(corners)):
+    (x0, y0), (x1, y1), (x2, y2) = corners[i-1], corners[i], corners[(i+1) % len(corners)]
+    if (x1-x0, y1-y0) != (x2-x1, y2-y1) and \
+       ((x1-x0)*(x2-x1) + (y1-y0)*(y2-y1)) <= 0:
+      turns.append(corners[i])
+
+  x, y = turns[0]
+  d = ["M%d %d" % (x, y)]
+  for tx, ty in turns[1:]:
+    if ty == y:
+      d.append("h%d" % (tx-x))
+    else:
+      d.append("v%d" % (ty-y))
+    x, y = tx, ty
+  d.append("z")
+  return "".join(d)
+
+def save_outlines(datafilesdir, outlines, source_hash):
+  fname = os.path.join(datafilesdir, OUTLINES)
+  tmp = "%s.%s.tmp" % (fname, os.getpid())
+  outf = open(tmp, "w")
+  outf.write("# PROVINCE OUTLINES, generated by svgdisp.py from %s\n"
+             % disp.LABELS_IMAGE)
+  outf.write("# Do not edit; this is rebuilt whenever the labels change\n\n")
+  outf.write("Source %s\n\n" % source_hash)
+  for label, path in sorted(outlines.items()):
+    outf.write("Region %s %s\n" % (label, path))
+  outf.close()
+  os.rename(tmp, fname)
+
+def read_outlines(datafilesdir, source_hash):
+  """ the saved outlines, or None if they're missing or out of date """
+
+  try:
+    inf = open(os.path.join(datafilesdir, OUTLINES))
+  except IOError:
+    return None
+
+  outlines = {}
+  source = None
+  for line in inf:
+    line = line.split(None, 2)
+    if not line or line[0].startswith("#"):
+      continue
+    if line[0] == "Source":
+      source = line[1]
+    elif line[0] == "Region":
+      outlines[int(line[1])] = line[2]
+  inf.close()
+
+  if source != source_hash:
+    return None
+  return outlines
+
+def load_outlines(datafilesdir, labels, source_hash):
+  """ get the region outlines, tracing and saving them if needed """
+
+  outlines = read_outlines(datafilesdir, source_hash)
+  if outlines is not None:
+    return outlines
+
+  sys.stderr.write("Tracing province outlines\n")
+  outlines = trace_outlines(labels[0])
+  try:
+    save_outlines(datafilesdir, outlines, source_hash)
+  except IOError:
+    pass # read only data dir; just trace them again next time
+  return outlines
+
+def load_assets(datafilesdir):
+  """ (coords, size, labels, outlines), what render needs
+
+  labels and outlines are None when disp can't use labels for this
+  map; ownership is then shown with a dot at each supply center.
+
+  """
+
+  coords = disp.parse_coords(os.path.join(datafilesdir, disp.COORDS))
+  size = Image.open(os.path.join(datafilesdir, disp.IMAGE)).size
+  source_hash = disp.labels_source_hash(datafilesdir)
+  labels = outlines = None
+  if disp.use_flood_fill:
+    labels = disp.load_labels(datafilesdir, source_hash)
+  if labels:
+    outlines = load_outlines(datafilesdir, labels, source_hash)
+  return coords, size, labels, outlines
+
+def color(rgb):
+  return "#%02x%02x%02x" % tuple(rgb)
+
+class Links(object):
+  """ where the SVG finds the data files """
+
+  def __init__(self, datafilesdir, svg_fname=None, href=None):
+    self.datafilesdir = os.path.abspath(datafilesdir)
+    self.href = href
+    self.svg_dir = os.path.dirname(os.path.abspath(svg_fname or "."))
+    self.ids = {}    # data file -> id in <defs>
+    self.defs = []
+
+  def link(self, fname):
+    fname = os.path.abspath(fname)
+    if self.href is not None:
+      name = os.path.relpath(fname, self.datafilesdir).replace(os.sep, "/")
+      return self.href + name
+    return os.path.relpath(fname, self.svg_dir).replace(os.sep, "/")
+
+  def icon(self, fname):
+    """ the id of the icon's shared <image>, adding it if it's new """
+
+    fname = os.path.abspath(fname)
+    if fname not in self.ids:
+      ico, mask, real = disp.get_icon(fname)
+      self.ids[fname] = "icon%d" % len(self.ids)
+      self.defs.append('<image id="%s" width="%d" height="%d" xlink:href=%s/>'
+                       % (self.ids[fname], ico.size[0], ico.size[1],
+                          quoteattr(self.link(fname))))
+    return self.ids[fname]
+
+def op_element(op, links):
+  """ the SVG for one of disp's drawing operations """
+
+  box, kind, args, kwargs = op
+  fill = kwargs.get("fill")
+  if kind == "icon":
+    return '<use xlink:href="#%s" x="%d" y="%d"/>' % (links.icon(args[0]),
+                                                     box[0], box[1])
+  if kind == "ellipse":
+    (x0, y0), (x1, y1) = args[0]
+    attrs = 'fill="none"'
+    if fill:
+      attrs = 'fill="%s"' % color(fill)
+    if kwargs.get("outline"):
+      attrs += ' stroke="%s"' % color(kwargs["outline"])
+    return '<ellipse cx="%g" cy="%g" rx="%g" ry="%g" %s/>' % (
+      (x0+x1)/2.0 + .5, (y0+y1)/2.0 + .5, abs(x1-x0)/2.0, abs(y1-y0)/2.0,
+      attrs)
+  if kind == "line":
+    (x0, y0), (x1, y1) = args[0]
+    return '<line x1="%d" y1="%d" x2="%d" y2="%d" stroke="%s"/>' % (
+      x0, y0, x1, y1, color(fill or (0,0,0)))
+  if kind == "text":
+    (x, y), txt = args
+    return text_element(x, y, txt, fill or (0,0,0))
+  raise Exception("Can't draw %s as SVG" % kind)
+
+def text_element(x, y, txt, fill):
+  # PIL's default font hangs below (x, y); SVG text sits on y
+  return '<text x="%d" y="%d" fill="%s">%s</text>' % (x, y+9, color(fill),
+                                                     escape(txt))
+
+def render(datafilesdir, assets, state, links):
+  """ the SVG of one gamestate.GameState, as a string """
+
+  coords, (width, height), labels, outlines = assets
+  ownership = disp.ownership_of(state)
+  body = []
+
+  body.append('<image width="%d" height="%d" xlink:href=%s/>'
+              % (width, height,
+                 quoteattr(links.link(os.path.join(datafilesdir, disp.IMAGE)))))
+
+  # ownership: the regions flood filling would recolor, one path per color
+  started = disp.stats.begin()
+  if disp.use_flood_fill and outlines:
+    label_im, provinces, region_colors, adjacent = labels
+    by_color = {}
+    for label, rgb in disp.replay_fills(coords, ownership, labels).items():
+      if rgb != region_colors[label] and label in outlines:
+        by_color.setdefault(rgb, []).append(outlines[label])
+    body.append('<g fill-rule="evenodd" shape-rendering="crispEdges">')
+    for rgb, paths in sorted(by_color.items()):
+      body.append('<path fill="%s" d="%s"/>' % (color(rgb), "".join(paths)))
+    body.append('</g>')
+  elif disp.use_flood_fill:
+    for name, rgb in sorted(ownership.items()):
+      x, y = coords[name][0]
+      body.append('<circle cx="%d" cy="%d" r="8" fill="%s"/>'
+                  % (x, y, color(rgb)))
+  disp.stats.end("flood_fill", started)
+
+  # the wormhole: darken red and green around the curve, as disp does
+  if "Wormhole" in state.options:
+    a, b = state.options["Wormhole"]
+    start, c1, c2, stop = disp.wormhole_control_points(coords[a.upper()][0],
+                                                       coords[b.upper()][0])
+    body.append('<path d="M%g %gC%g %g %g %g %g %g" fill="none"'
+                ' stroke="#d5d5ff" stroke-width="12" stroke-linecap="round"'
+                ' style="mix-blend-mode:multiply"/>'
+                % (start + c1 + c2 + stop))
+
+  if disp.use_names:
+    body.append('<g font-family="sans-serif" font-size="10">')
+    for name, (n, a, f, fs) in sorted(coords.items()):
+      body.append(text_element(n[0], n[1], name, (0,0,0)))
+    body.append('</g>')
+
+  started = disp.stats.begin()
+  ops = disp.plan_units(datafilesdir, coords, state)
+  body.append('<g font-family="sans-serif" font-size="10">')
+  body.extend([op_element(op, links) for op in ops])
+  body.append('</g>')
+  disp.stats.count("units", len(state))
+  disp.stats.end("powers", started)
+
+  header = ['<?xml version="1.0" encoding="UTF-8"?>',
+            '<svg xmlns="http://www.w3.org/2000/svg"'
+            ' xmlns:xlink="http://www.w3.org/1999/xlink"'
+            ' width="%d" height="%d" viewBox="0 0 %d %d">'
+            % (width, height, width, height)]
+  if links.defs:
+    header.append('<defs>')
+    header.extend(links.defs)
+    header.append('</defs>')
+  return "\n".join(header + body + ['</svg>']) + "\n"
+
+def start(datafilesdir, status_fname, svg_fname, href=None):
+  assets = load_assets(datafilesdir)
+
+  started = disp.stats.begin()
+  state = gamestate.load(status_fname, assets[0])
+  disp.stats.end("status", started)
+
+  svg = render(datafilesdir, assets, state, Links(datafilesdir, svg_fname, href))
+
+  started = disp.stats.begin()
+  outf = open(svg_fname, "w")
+  outf.write(svg)
+  outf.close()
+  disp.stats.end("save", started)
+
+if __name__ == "__main__":
+  opts, args = getopt.getopt(sys.argv[1:], "", ["href="])
+  opts = dict(opts)
+  if len(args) != 3:
+    sys.exit(__doc__)
+  start(*args, **{"href": opts.get("--href")})
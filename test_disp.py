@@ -0,0 +1,76 @@
+"""
+Usage:
+  $ python test_disp.py
+
+Checks disp.py against what it drew before it was sped up.  Run from
+the directory with the shipped data files.
+
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import disp
+
+def old_wormhole_curve(start, stop):
+  """ the curve pixels as the original draw_wormhole found them """
+
+  st_a = disp.mul(.4, disp.sub(start,stop))
+  st_b = disp.mul(.2, disp.sub(stop,start))
+  c1 = disp.add(start, disp.add(st_b, disp.perp(disp.mul(.5,st_b))))
+  c2 = disp.add(stop, disp.add(st_a, disp.perp(disp.mul(.5,st_a))))
+  control_points = [start, c1, c2, stop]
+  pts = set()
+  for x in range((len(control_points)-1)/3):
+    for pt in disp.calculate_bezier(control_points[3*x:3*x+4]):
+      pts.add(disp.mkint(pt))
+  return pts
+
+class WormholeTest(unittest.TestCase):
+
+  def test_curve_pixels(self):
+    coords = disp.parse_coords(disp.COORDS)
+    for a, b in [("SPA", "SEV"), ("NWY", "TUN"), ("LON", "MOS")]:
+      start, stop = coords[a][0], coords[b][0]
+      self.assertEqual(disp.wormhole_curve(start, stop),
+                       old_wormhole_curve(start, stop))
+
+class IncrementalTest(unittest.TestCase):
+
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def save(self, im, name, spec):
+    fname = os.path.join(self.tmpdir, name)
+    disp.save_image(im, fname, spec)
+    return fname
+
+  def test_exact_image(self):
+    im = disp.Image.new("RGB", (16, 16), (200, 100, 50))
+    specs = [("a.png", "default", True), ("b.png", "email", False),
+             ("c.jpg", "format=jpeg", False)]
+    disp.Image.init()
+    if "WEBP" in disp.Image.SAVE:
+      specs += [("d.webp", "webp", True),
+                ("e.webp", "format=webp,quality=80", False)]
+    for name, spec, exact in specs:
+      fname = self.save(im, name, spec)
+      self.assertEqual(disp.exact_image(disp.Image.open(fname), fname), exact)
+
+  def test_palette_previous_image(self):
+    # the same status, so nothing is redrawn: the palette image would
+    # come back as it was if it were patched
+    assets = disp.load_assets(".")
+    state = disp.gamestate.load("statusfile.txt", assets[0])
+    prev = self.save(disp.render(".", assets, state), "prev.png", "email")
+    out = os.path.join(self.tmpdir, "out.png")
+    disp.start_incremental(".", "statusfile.txt", prev, "statusfile.txt", out,
+                           verify=True)
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,230 @@
+"""
+Usage:
+  $ python tiledisp.py [--scale S] [--tile N] [--encoding SPEC]
+                       datafilesdir statusfile out.png
+
+Draws the same map as disp.py, a tile at a time, for maps too big to
+draw whole: big variant maps, or print renders at --scale S times the
+map's own size (2.5 for 2.5 times as wide and high).
+
+The output is made in bands of N by N tiles (512 by default).  Each
+tile is drawn from its own part of the map: only the provinces, names,
+wormhole and units that touch it are drawn, and it's scaled up to S
+times the size on its own.  Each band of tiles goes to the PNG encoder
+as soon as it's drawn, so memory grows with the tile size and the
+output's width, not the size of the output.  At --scale 1 the image
+is the same as disp.py's.
+
+The map's own images (the base map and the province labels) are still
+read whole, once.  Only PNG can be written this way; --encoding can set
+its compress_level.
+
+"""
+
+import sys
+import time
+import getopt
+import struct
+import zlib
+from math import floor, ceil
+import Image, ImageDraw
+
+import disp
+import gamestate
+from replay import png_chunk, png_chunks
+
+TILE_SIZE = 512
+
+# native pixels drawn around each tile, for scaling to look at
+MARGIN = 2
+
+def native_box(box, scale, size):
+  """ the part of the map, in its own pixels, an output box is drawn from """
+
+  left, top, right, bottom = box
+  margin = 0
+  if scale != 1:
+    margin = MARGIN
+  return (max(int(floor(left/scale)) - margin, 0),
+          max(int(floor(top/scale)) - margin, 0),
+          min(int(ceil(right/scale)) + margin, size[0]),
+          min(int(ceil(bottom/scale)) + margin, size[1]))
+
+class Plan(object):
+  """ what to draw, worked out once for the whole map """
+
+  def __init__(self, datafilesdir, assets, state):
+    coords, base, labels, source_hash = assets
+    self.base = base
+    self.labels = labels
+    self.coords = coords
+
+    # without labels filling is done on the whole map, as disp does
+    self.background = None
+    self.fills = None
+    if disp.use_flood_fill and not labels:
+      self.background = disp.get_background(datafilesdir, assets, state)
+    elif disp.use_flood_fill:
+      self.ownership = disp.ownership_of(state)
+      self.fills = disp.replay_fills(coords, self.ownership, labels)
+
+    self.curve = None
+    if "Wormhole" in state.options:
+      a, b = state.options["Wormhole"]
+      self.curve = disp.wormhole_curve(coords[a.upper()][0],
+                                       coords[b.upper()][0])
+
+    self.names = []
+    if disp.use_names:
+      self.names = [disp.text_op(n, name, fill=(0,0,0))
+                    for name, (n, a, f, fs) in coords.items()]
+
+    self.units = disp.plan_units(datafilesdir, coords, state)
+
+  def draw(self, box):
+    """ the part of the map in box, in its own pixels """
+
+    origin = box[:2]
+    if self.background is not None:
+      im = self.background.crop(box)
+    else:
+      im = self.base.crop(box)
+      if self.fills:
+        disp.stats.count("pixels_filled", disp.fill_ownership(
+          im, self.coords, self.ownership, self.labels, origin, self.fills))
+      if self.curve:
+        disp.darken_wormhole(self.curve, im, origin, self.base.size)
+    draw = ImageDraw.Draw(im)
+    for ops in [self.names, self.units]:
+      disp.draw_ops([disp.shift_op(op, origin) for op in ops
+                     if disp.touches(op[0], [box])], draw, im)
+    return im
+
+def filtered_rows(band):
+  """ band's rows as PNG scanlines, each with the filter PIL picks
+
+  The first row can't use a filter that looks at the row before, as
+  that's in the band before.
+
+  """
+
+  # not compressed, as it's only decompressed again
+  data = ""
+  for kind, body in png_chunks(band, compress_level=0):
+    if kind == "IDAT":
+      data += body
+  rows = zlib.decompress(data)
+  stride = 1 + band.size[0]*3
+  if rows[0] not in "\x00\x01": # none and sub only look at this row
+    first = band.crop((0, 0, band.size[0], 1))
+    if hasattr(first, "tobytes"):
+      first = first.tobytes()
+    else:
+      first = first.tostring() # old PIL
+    rows = "\x00" + first + rows[stride:]
+  return rows
+
+class PNGWriter(object):
+  """ writes an RGB PNG a band of rows at a time """
+
+  def __init__(self, outf, size, compress_level=6):
+    self.outf = outf
+    self.size = size
+    self.compress = zlib.compressobj(compress_level)
+    outf.write("\x89PNG\r\n\x1a\n")
+    # 8 bits, RGB, deflate, adaptive filtering, not interlaced
+    outf.write(png_chunk("IHDR", struct.pack(">IIBBBBB", size[0], size[1],
+                                             8, 2, 0, 0, 0)))
+
+  def write(self, band):
+    self.write_idat(self.compress.compress(filtered_rows(band)))
+
+  def close(self):
+    self.write_idat(self.compress.flush())
+    self.outf.write(png_chunk("IEND", ""))
+
+  def write_idat(self, data):
+    if data:
+      self.outf.write(png_chunk("IDAT", data))
+
+def parse_compress_level(spec):
+  """ the compress_level of an --encoding spec, which has to be PNG """
+
+  options = disp.parse_encoding(spec or disp.encoding)
+  if options.get("format", "PNG") != "PNG" or "colors" in options:
+    raise Exception("Tiled images can only be RGB PNGs, not %s" % spec)
+  return options.get("compress_level", 6)
+
+def render_tiled(datafilesdir, assets, state, outf, scale=1,
+                 tile_size=TILE_SIZE, compress_level=6):
+  """ draw state's map, scale times its size, as a PNG to outf
+
+  Returns the size of the image.
+
+  """
+
+  base = assets[1]
+  width = int(round(base.size[0]*scale))
+  height = int(round(base.size[1]*scale))
+
+  started = disp.stats.begin()
+  plan = Plan(datafilesdir, assets, state)
+  disp.stats.end("plan", started)
+
+  writer = PNGWriter(outf, (width, height), compress_level)
+  for top in range(0, height, tile_size):
+    bottom = min(top + tile_size, height)
+    band = Image.new("RGB", (width, bottom - top))
+    for left in range(0, width, tile_size):
+      right = min(left + tile_size, width)
+      box = (left, top, right, bottom)
+
+      started = disp.stats.begin()
+      nbox = native_box(box, scale, base.size)
+      im = plan.draw(nbox)
+      disp.stats.end("draw", started)
+
+      started = disp.stats.begin()
+      if scale != 1:
+        im = im.transform((right - left, bottom - top), Image.EXTENT,
+                          (left/scale - nbox[0], top/scale - nbox[1],
+                           right/scale - nbox[0], bottom/scale - nbox[1]),
+                          Image.BICUBIC)
+      band.paste(im, (left, 0))
+      disp.stats.end("scale", started)
+      disp.stats.count("tiles")
+
+    started = disp.stats.begin()
+    writer.write(band)
+    disp.stats.end("save", started)
+  writer.close()
+  return width, height
+
+def start(datafilesdir, status_fname, img_out, scale=1, tile_size=TILE_SIZE,
+          encoding=None):
+  compress_level = parse_compress_level(encoding)
+  assets = disp.load_assets(datafilesdir)
+
+  started = disp.stats.begin()
+  state = gamestate.load(status_fname, assets[0])
+  disp.stats.end("status", started)
+
+  outf = open(img_out, "wb")
+  try:
+    return render_tiled(datafilesdir, assets, state, outf, scale, tile_size,
+                        compress_level)
+  finally:
+    outf.close()
+
+if __name__ == "__main__":
+  opts, args = getopt.getopt(sys.argv[1:], "",
+                             ["scale=", "tile=", "encoding=", "stats="])
+  opts = dict(opts)
+  if len(args) != 3:
+    sys.exit(__doc__)
+  started = time.time()
+  size = start(args[0], args[1], args[2], float(opts.get("--scale", 1)),
+               int(opts.get("--tile", TILE_SIZE)), opts.get("--encoding"))
+  disp.stats.end("total", started)
+  sys.stderr.write("Wrote %s, %dx%d\n" % ((args[2],) + size))
+  disp.write_stats(opts.get("--stats"), image=args[2], status=args[1])
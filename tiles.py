@@ -0,0 +1,201 @@
+"""
+Usage:
+  $ python tiles.py [--tile-size N] [--threads N] image.png outdir
+
+Cuts a map into a zoomable pyramid of tiles for viewing in a browser,
+the way web maps are:
+
+  outdir/tiles.json       the index
+  outdir/Z/X/Y.png        tile X across and Y down at zoom level Z
+
+Zoom 0 fits the whole map in one tile and the highest zoom is full
+size, each level in between half the size of the next.  Tiles on the
+right and bottom edges are cut short rather than padded.
+
+tiles.json has the map's size, the tile size, the zoom levels and a
+hash of each tile's pixels.  Writing a pyramid over an old one only
+rewrites the tiles whose pixels changed, so after a turn where a few
+provinces changed only their tiles (and the smaller ones over them)
+are written.
+
+"""
+
+import sys
+import os
+import os.path
+import getopt
+import threading
+import json
+try:
+  from hashlib import md5
+except ImportError:
+  from md5 import md5 # old versions of python don't have hashlib
+import Image
+
+TILE_SIZE = 256
+INDEX = "tiles.json"
+
+def max_zoom(size, tile_size=TILE_SIZE):
+  """ the zoom level at which the map is full size """
+
+  zoom = 0
+  while max(size) > tile_size << zoom:
+    zoom += 1
+  return zoom
+
+def pyramid(im, tile_size=TILE_SIZE):
+  """ [(zoom, image)] from zoom 0 up to im itself """
+
+  levels = [(max_zoom(im.size, tile_size), im)]
+  while levels[0][0] > 0:
+    zoom, larger = levels[0]
+    x, y = larger.size
+    levels.insert(0, (zoom - 1, larger.resize((max(1, (x+1)//2),
+                                               max(1, (y+1)//2)),
+                                              Image.ANTIALIAS)))
+  return levels
+
+def pixels_hash(im):
+  h = md5()
+  h.update(im.mode)
+  h.update(repr(im.size))
+  if hasattr(im, "tobytes"):
+    h.update(im.tobytes())
+  else:
+    h.update(im.tostring()) # old PIL
+  return h.hexdigest()
+
+def tile_name(zoom, x, y, ext=".png"):
+  return "%d/%d/%d%s" % (zoom, x, y, ext)
+
+def cut(levels, tile_size=TILE_SIZE, ext=".png"):
+  """ [(name, tile image)] for every tile of pyramid's levels """
+
+  tiles = []
+  for zoom, level in levels:
+    width, height = level.size
+    for x in range(0, (width + tile_size - 1) // tile_size):
+      for y in range(0, (height + tile_size - 1) // tile_size):
+        box = (x*tile_size, y*tile_size,
+               min((x+1)*tile_size, width), min((y+1)*tile_size, height))
+        tiles.append((tile_name(zoom, x, y, ext), level.crop(box)))
+  return tiles
+
+def read_index(outdir):
+  """ the index of the pyramid in outdir, or None if there isn't one """
+
+  try:
+    inf = open(os.path.join(outdir, INDEX))
+  except IOError:
+    return None
+  try:
+    return json.load(inf)
+  finally:
+    inf.close()
+
+def write_index(outdir, index):
+  fname = os.path.join(outdir, INDEX)
+  tmp = "%s.%s.tmp" % (fname, os.getpid())
+  outf = open(tmp, "w")
+  json.dump(index, outf, indent=1, sort_keys=True)
+  outf.write("\n")
+  outf.close()
+  os.rename(tmp, fname)
+
+def save_png(im, fname):
+  im.save(fname, "PNG")
+
+def write_pyramid(im, outdir, tile_size=TILE_SIZE, threads=1, save=save_png,
+                  ext=".png", encoding=None):
+  """ write im's tiles and index to outdir
+
+  Tiles the index in outdir already has with the same pixels (and the
+  same encoding, which is anything describing how save writes them)
+  are left alone.  save(tile, fname) writes one tile; threads of them
+  run at once.  Tiles the old index had that this pyramid doesn't are
+  removed.
+
+  Returns (tiles written, tiles in the pyramid).
+
+  """
+
+  old = read_index(outdir) or {}
+  old_hashes = {}
+  if old.get("encoding") == encoding and old.get("tile_size") == tile_size:
+    old_hashes = old.get("tiles", {})
+
+  levels = pyramid(im, tile_size)
+  tiles = cut(levels, tile_size, ext)
+  hashes = {}
+  todo = []
+  for name, tile in tiles:
+    hashes[name] = pixels_hash(tile)
+    if old_hashes.get(name) != hashes[name] or \
+       not os.path.exists(os.path.join(outdir, name)):
+      todo.append((name, tile))
+  written = len(todo)
+
+  lock = threading.Lock()
+  errors = []
+
+  def work():
+    while True:
+      lock.acquire()
+      try:
+        if not todo or errors:
+          return
+        name, tile = todo.pop()
+      finally:
+        lock.release()
+      fname = os.path.join(outdir, name)
+      try:
+        if not os.path.isdir(os.path.dirname(fname)):
+          try:
+            os.makedirs(os.path.dirname(fname))
+          except OSError:
+            pass # another thread made it first
+        save(tile, fname)
+      except Exception, e:
+        errors.append((name, e))
+
+  workers = []
+  for n in range(max(1, min(threads, len(todo)))):
+    t = threading.Thread(target=work)
+    t.start()
+    workers.append(t)
+  for t in workers:
+    t.join()
+  if errors:
+    raise Exception("Could not write tile %s: %s" % errors[0])
+
+  for name in old.get("tiles", {}):
+    if name not in hashes and os.path.exists(os.path.join(outdir, name)):
+      os.remove(os.path.join(outdir, name))
+
+  level_sizes = []
+  for zoom, level in levels:
+    width, height = level.size
+    level_sizes.append({"zoom": zoom, "width": width, "height": height,
+                        "columns": (width + tile_size - 1) // tile_size,
+                        "rows": (height + tile_size - 1) // tile_size})
+  write_index(outdir, {"width": im.size[0],
+                       "height": im.size[1],
+                       "tile_size": tile_size,
+                       "min_zoom": 0,
+                       "max_zoom": max_zoom(im.size, tile_size),
+                       "levels": level_sizes,
+                       "ext": ext,
+                       "encoding": encoding,
+                       "tiles": hashes})
+  return written, len(tiles)
+
+if __name__ == "__main__":
+  opts, args = getopt.getopt(sys.argv[1:], "", ["tile-size=", "threads="])
+  opts = dict(opts)
+  if len(args) != 2:
+    sys.exit(__doc__)
+  img_fname, outdir = args
+  written, total = write_pyramid(Image.open(img_fname).convert("RGB"), outdir,
+                                 int(opts.get("--tile-size", TILE_SIZE)),
+                                 int(opts.get("--threads", 1)))
+  print "Wrote %d of %d tiles to %s" % (written, total, outdir)
@@ -0,0 +1,282 @@
+"""
+Usage:
+  python turn.py [--jobs N] [--encoding SPEC] [--queue N] [--keep-going]
+                 [--smtp host[:port]] [--user name] [--starttls]
+                 [--connections N] [--retries N]
+                 datafiledir emailfile statusfile.txt [ordersfile.txt]
+
+Does a turn's splitdisp and sendout in one go.  The files are split,
+then each race is mailed its text straight away while the maps are
+drawn, and each race's map is mailed as soon as it's drawn, so drawing
+and mailing overlap instead of one waiting for the other:
+
+  split ---> text mails ------------------------> senders ---> SMTP
+        \--> draw (--jobs processes) --> map mails --^
+
+At most --queue (4 by default) mails wait for a sender; drawing waits
+when they're all taken.  The mail options are sendout.py's.
+
+If a map can't be drawn or a mail can't be sent, the rest of the turn
+is cancelled: drawing stops and mails not yet sent aren't.  With
+--keep-going the other races carry on.  At the end a summary says what
+happened to each race's text and map; the exit status is 1 unless
+everything was sent.
+
+The files are named as splitdisp names them and listed in their own
+season's manifest (a season's orders and the status after them are of
+different seasons), so sendout.py can send any of them again later.
+
+"""
+
+import sys
+import time
+import getopt
+import threading
+import Queue
+
+import disp
+import splitdisp
+import sendout
+import manifest
+
+QUEUE_SIZE = 4
+
+SENT, FAILED, CANCELLED, SKIPPED = "sent", "FAILED", "cancelled", "skipped"
+
+class Turn(object):
+  """ one run of the pipeline, and what happened to each race's mails """
+
+  def __init__(self, emails, queue_size=QUEUE_SIZE, keep_going=False):
+    self.emails = emails
+    self.keep_going = keep_going
+    self.started = time.time()
+    self.outbox = Queue.Queue(queue_size) # (race, what, send_to, msg_string)
+    self.cancelled = threading.Event()
+    self.lock = threading.Lock()
+    self.results = {} # (race, "text" or "map") -> (status, detail, seconds)
+    self.senders = []
+
+  def record(self, race, what, status, detail=""):
+    self.lock.acquire()
+    try:
+      self.results[(race, what)] = (status, detail,
+                                    time.time() - self.started)
+    finally:
+      self.lock.release()
+    if status == FAILED and not self.keep_going:
+      self.cancelled.set()
+
+  def send(self):
+    """ a sender thread: mail what's in the outbox until told to stop """
+
+    transport = sendout.new_transport()
+    try:
+      while True:
+        item = self.outbox.get()
+        if item is None:
+          return
+        race, what, send_to, msg_string = item
+        if self.cancelled.isSet():
+          self.record(race, what, CANCELLED)
+          continue
+        name, send_to, error, tries, seconds = sendout.send_with_retries(
+          transport, race, self.emails["gm"], send_to, msg_string)
+        if error:
+          self.record(race, what, FAILED, "%s, tries: %d" % (error, tries))
+        else:
+          self.record(race, what, SENT)
+    finally:
+      transport.close()
+
+  def start_senders(self):
+    connections = sendout.smtp_connections
+    if not sendout.use_smtp:
+      connections = 1 # sendmail queues them itself
+    for n in range(max(1, connections)):
+      t = threading.Thread(target=self.send)
+      t.start()
+      self.senders.append(t)
+
+  def stop_senders(self):
+    """ wait for the outbox to be emptied and the senders to finish """
+
+    for t in self.senders:
+      self.outbox.put(None)
+    for t in self.senders:
+      t.join()
+
+  def mail(self, race, what, msg):
+    """ queue a message, waiting if the outbox is full """
+
+    if self.cancelled.isSet():
+      self.record(race, what, CANCELLED)
+    else:
+      self.outbox.put((race, what, [self.emails[race]], msg.as_string()))
+
+  def summary(self, races, mapped):
+    """ [(race, address, text result, map result)]
+
+    Each result is (status, detail, seconds into the turn).  mapped
+    are the races that have a map.
+
+    """
+
+    lines = []
+    for race in races:
+      line = [race, self.emails.get(race, "")]
+      for what in ["text", "map"]:
+        if race not in self.emails:
+          result = (SKIPPED, "no email addr", None)
+        elif what == "map" and race not in mapped:
+          result = (SKIPPED, "no map", None)
+        elif self.cancelled.isSet():
+          result = self.results.get((race, what), (CANCELLED, "", None))
+        else:
+          result = self.results.get((race, what), (FAILED, "not sent", None))
+        line.append(result)
+      lines.append(line)
+    return lines
+
+def subject(seasons, race):
+  """ the subject of a race's mail of files from seasons """
+
+  words = []
+  for season in seasons:
+    year, month, type = season.split("_")
+    words.append("%s %s %s" % (month, type, year))
+  return "Resolutions %s %s Edition" % (" and ".join(words), race)
+
+def start(datafiledir, emailfile, fnames, processes=1,
+          queue_size=QUEUE_SIZE, keep_going=False):
+  """ split, draw and mail fnames; returns the summary """
+
+  emails = sendout.parse_emails(emailfile)
+  turn = Turn(emails, queue_size, keep_going)
+  parts = sendout.PartCache()
+
+  texts = {} # race -> [fname_text]
+  images = [] # [(fname_text, fname_png)]
+  races = {} # fname_png -> race
+  # the files can be of different seasons, such as a season's orders
+  # and the status after them; each is listed in its own season's
+  # manifest, where sendout.py looks for it
+  seasons = [] # in the order of fnames
+  text_seasons = {} # race -> the seasons of its texts, in that order
+  image_seasons = {} # fname_png -> season
+  artifacts = {} # season -> [artifact], for the manifests
+  for fname in fnames:
+    season, kind, views = splitdisp.split(fname)
+    if season not in seasons:
+      seasons.append(season)
+    for race, fname_text in views:
+      texts.setdefault(race, []).append(fname_text)
+      if season not in text_seasons.setdefault(race, []):
+        text_seasons[race].append(season)
+      artifacts.setdefault(season, []).append(
+        manifest.artifact(season, kind, race, fname_text))
+      if kind == "status":
+        fname_png = splitdisp.image_fname(fname_text)
+        images.append((fname_text, fname_png))
+        races[fname_png] = race
+        image_seasons[fname_png] = season
+
+  turn.start_senders()
+  try:
+    for race in sorted(texts):
+      if race not in emails:
+        print "Skipping", race, "(no email addr)"
+        continue
+      print "Sending %s to %s" % (texts[race], emails[race])
+      turn.mail(race, "text", sendout.build_message(
+        send_from=emails["gm"], send_to=[emails[race]],
+        subject=subject(text_seasons[race], race),
+        text="Resolutions attached as text; the map follows\n",
+        files=sorted(texts[race]), parts=parts))
+
+    drawn = disp.iter_batch(datafiledir, images, processes)
+    try:
+      for fname_png, error in drawn:
+        race = races[fname_png]
+        if error:
+          print "Failed %s (%s):" % (fname_png, race)
+          print error
+          turn.record(race, "map", FAILED, error.strip().splitlines()[-1])
+        else:
+          print "Wrote %s" % fname_png
+          season = image_seasons[fname_png]
+          artifacts[season].append(
+            manifest.artifact(season, "status", race, fname_png))
+          if race in emails:
+            print "Sending %s to %s" % (fname_png, emails[race])
+            turn.mail(race, "map", sendout.build_message(
+              send_from=emails["gm"], send_to=[emails[race]],
+              subject=subject([season], race) + " Map",
+              text="The map for the resolutions\n",
+              files=[fname_png], parts=parts))
+        if turn.cancelled.isSet():
+          print "Cancelled, not drawing the rest"
+          break
+    finally:
+      drawn.close()
+  except:
+    turn.cancelled.set()
+    raise
+  finally:
+    turn.stop_senders()
+
+  for season in seasons:
+    if season in artifacts:
+      print "Wrote %s" % manifest.update(season, artifacts[season])
+
+  summary = turn.summary(sorted(texts), races.values())
+  print_summary(summary)
+  return summary
+
+def print_summary(summary):
+  print
+  print "Turn summary:"
+  sent = failed = 0
+  for race, address, text, map_result in summary:
+    results = []
+    for what, (status, detail, seconds) in [("text", text),
+                                            ("map", map_result)]:
+      result = "%s %s" % (what, status)
+      if seconds is not None:
+        result += " at %.1fs" % seconds
+      if detail:
+        result += " (%s)" % detail
+      results.append(result)
+      if status == SENT:
+        sent += 1
+      elif status != SKIPPED:
+        failed += 1
+    print "  %-12s %-30s %s" % (race, address, ", ".join(results))
+  print "%d sent, %d failed or cancelled" % (sent, failed)
+
+def all_sent(summary):
+  """ whether every mail that should have gone did """
+
+  for race, address, text, map_result in summary:
+    for status, detail, seconds in [text, map_result]:
+      if status not in (SENT, SKIPPED):
+        return False
+  return True
+
+if __name__ == "__main__":
+  opts, args = getopt.getopt(sys.argv[1:], "j:",
+                             ["jobs=", "encoding=", "queue=", "keep-going"]
+                             + sendout.OPTIONS)
+  opts = dict(opts)
+  if len(args) < 3:
+    sys.exit(__doc__)
+  sendout.configure(opts)
+  if "--encoding" in opts:
+    disp.parse_encoding(opts["--encoding"]) # complain before splitting
+    disp.encoding = opts["--encoding"]
+  processes = int(opts.get("-j", opts.get("--jobs", 1)))
+
+  datafiledir, emailfile, fnames = args[0], args[1], args[2:]
+  summary = start(datafiledir, emailfile, fnames, processes,
+                  int(opts.get("--queue", QUEUE_SIZE)), "--keep-going" in opts)
+  if not all_sent(summary):
+    sys.exit(1)